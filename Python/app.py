@@ -1,16 +1,50 @@
 import user
+import totp_guard
+import backup_catalog
+import log_index
+import log_search
+import git_history
+import jobs
+import service_status
+import messages
+import backup_upload
+import snapshots
+import retention
+import metrics
+import restore_plan
+import passwords
+import shared_state
+import host_sampler
+from config_store import ConfigStore, ConfigError
 import re
 import os
+import io
+import csv
+import json
+import shutil
 import subprocess
-import tarfile
 import datetime
+import base64
+import sys
+import shlex
+import time
+import uuid
 from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, get_flashed_messages, jsonify, Response
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.http import http_date
+from flask import Flask, render_template, request, redirect, url_for, session, flash, get_flashed_messages, jsonify, Response, stream_with_context, g
 
 
 app = Flask(__name__, static_folder='static')  # Correctly set static folder
-app.secret_key = "Test123"
+# Same secret in every worker process, or sessions would only be valid on the worker that issued them
+app.secret_key = shared_state.secret_key()
 app.debug = True
+# nginx forwards the client address in X-Forwarded-For; needed for per-IP throttling
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
+
+login_throttle = totp_guard.LoginThrottle(state=shared_state.state)
+# Measure the password hashing cost for this host now, not on the first new user
+passwords.calibrate_in_background()
 
 pw = "" #-> change Imidiatly
 
@@ -29,34 +63,192 @@ def _find_inventarsystem_base():
 
 BASE_DIR = _find_inventarsystem_base()
 
+BACKUP_DIR = backup_upload.BACKUP_DIR
+SNAPSHOT_STORE = snapshots.STORE_DIR
+SNAPSHOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots.py")
+RESTORE_PLAN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "restore_plan.py")
+# Plans handed to restore_plan.py; removed when the job is done
+RESTORE_PLAN_DIR = os.path.join(backup_catalog.INSTANCE_DIR, "restore")
+MONGODUMP_MISSING = ("Inkrementelle Backups sichern die Datenbank mit mongodump, das auf diesem Server fehlt. "
+                     "Bitte die MongoDB Database Tools installieren oder den Backup-Modus \"full\" verwenden.")
+
+def config_path():
+    # Prefer the config of the Inventarsystem checkout
+    cfg_candidates = []
+    if BASE_DIR:
+        cfg_candidates.append(os.path.join(BASE_DIR, "config.json"))
+    cfg_candidates.append(os.path.join(app.root_path, "config.json"))
+    return next((p for p in cfg_candidates if os.path.exists(p)), cfg_candidates[0])
+
+config_store = ConfigStore(config_path(), lock_path=os.path.join(backup_catalog.INSTANCE_DIR, "config.lock"))
+
+def read_config():
+    # In-memory copy; config.json is only read again after it changed
+    return config_store.get()
+
+
+"""-----------------------------Jobs Part-----------------------------------"""
+
+# What each maintenance script touches; jobs sharing a resource never run at once
+JOB_RESOURCES = {
+    "backup": ("backups",),
+    "restore": ("backups", "data", "service"),
+    "start": ("service",),
+    "stop": ("service",),
+    "restart": ("service",),
+    "fix": ("code", "data", "service"),
+    "update": ("code", "service"),
+    "pin": ("code", "service"),
+    "prune": ("backups",),
+    "verify": ("backups",),
+}
+# Longest log slice returned by one /jobs/<id>/log request
+JOB_LOG_MAX_BYTES = 256 * 1024
+
+def run_script_job(pw, kind, script, args="", on_done=None, prepare=None):
+    """Start one of the Inventarsystem scripts as a background job (raises jobs.JobConflict)."""
+    script_path = os.path.join(BASE_DIR, script)
+    cmd = f'cd "{BASE_DIR}" && bash "{script_path}" {args}'.rstrip()
+    if prepare:
+        cmd = f'cd "{BASE_DIR}" && {prepare} && bash "{script_path}" {args}'.rstrip()
+    if not pw:
+        return False
+    if "service" in JOB_RESOURCES[kind]:
+        # Units changed state; do not wait for the snapshot to expire
+        follow_up = on_done
+
+        def on_done(job):
+            service_status.monitor.invalidate()
+            if follow_up:
+                follow_up(job)
+    return jobs.submit(
+        kind,
+        ["sudo", "-S", "bash", "-lc", cmd],
+        JOB_RESOURCES[kind],
+        stdin=(pw + "\n").encode(),
+        on_done=on_done,
+    )
+
+def job_started(job, message, **extra):
+    payload = {"message": message, "job": job["id"] if job else None}
+    payload.update(extra)
+    return jsonify(payload), 202 if job else 200
+
+def job_conflict(e):
+    return jsonify({"error": f"Es läuft bereits ein Auftrag ({e.job['kind']}). Bitte warten, bis er beendet ist.",
+                    "job": e.job["id"]}), 409
+
+
+
+"""-----------------------------Download Part-------------------------------"""
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+def _read_span(f, length):
+    # Fallback for servers without wsgi.file_wrapper (development server)
+    with f:
+        while length > 0:
+            block = f.read(min(DOWNLOAD_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+def send_ranged(path, etag, download_name, mimetype="application/octet-stream", sha256=None, weak=False):
+    """
+    Send a file with Range/If-Range support and a strong ETag (derived from
+    inode, size and mtime when ``etag`` is None).
+    A ``weak`` ETag still answers If-None-Match, but If-Range never matches it,
+    so a resumed download of a file that may have changed starts over.
+    The body is handed to the server as a file wrapper at the right offset, so
+    gunicorn can use sendfile() and the bytes never pass through Python.
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return jsonify({"error": "Datei nicht gefunden"}), 404
+    st = os.fstat(f.fileno())
+    size = st.st_size
+    if etag is None:
+        # Without a content hash: inode, size and mtime change with every write or rotation
+        etag = f"{st.st_ino:x}-{size:x}-{st.st_mtime_ns:x}"
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'W/"{etag}"' if weak else f'"{etag}"',
+        "Last-Modified": http_date(st.st_mtime),
+        "Content-Disposition": f'attachment; filename="{download_name}"',
+    }
+    if request.if_none_match.contains_weak(etag) if weak else etag in request.if_none_match:
+        f.close()
+        return Response(status=304, headers=headers)
+    status = 200
+    start, length = 0, size
+    ranges = request.range
+    # If-Range: resume only if the client still has the same file, otherwise send it all
+    if ranges is not None and request.if_range.etag is not None and (weak or request.if_range.etag != etag):
+        ranges = None
+    if ranges is not None and request.if_range.date is not None and int(st.st_mtime) > request.if_range.date.timestamp():
+        ranges = None
+    if ranges is not None and len(ranges.ranges) == 1:
+        span = ranges.range_for_length(size)
+        if span is None:
+            f.close()
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, stop = span
+        length = stop - start
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    elif sha256:
+        headers["Digest"] = "sha-256=" + base64.b64encode(bytes.fromhex(sha256)).decode()
+    f.seek(start)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        # gunicorn sends exactly Content-Length bytes from the current offset
+        body = file_wrapper(f, DOWNLOAD_BLOCK_SIZE)
+    else:
+        body = _read_span(f, length)
+    response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = length
+    return response
 
 
 """-----------------------------Logs Part-----------------------------------"""
 
+# A tail stream holds a worker, so it ends after this long and the browser reconnects
+TAIL_MAX_SECONDS = 25
+RANGE_MAX_LINES = 1000
+
+def _log_path(log_type):
+    path = os.path.join(BASE_DIR, "logs", f"{secure_filename(log_type)}.log")
+    if os.path.isfile(path):
+        return path
+    return None
+
 def get_log():
     items = []
-    for i in os.listdir(os.path.join(BASE_DIR, "logs")):
+    for i in sorted(os.listdir(os.path.join(BASE_DIR, "logs"))):
+        # Rotated files (*.log.1, *.gz) are not listed here
+        if not i.endswith(".log"):
+            continue
         item = {"type": None, "length": None, "last_row": None, "last_row_prev": None}
         file_type = i.replace(".log", "")
         item["type"] = file_type
-        with open(os.path.join(BASE_DIR, "logs", f"{file_type}.log"), "r") as f:
-            file_content = f.read()
-            file_content_list = file_content.split("\n")
-            length = len(file_content_list)
-            item["length"] = length
-            last_row = file_content_list[length-2]
-            item["last_row"] = last_row
-            if len(last_row) >= 30:
-                item["last_row_prev"] = last_row[0:30]
-            else:
-                item["last_row_prev"] = last_row
+        summary = log_index.summarize(os.path.join(BASE_DIR, "logs", f"{file_type}.log"))
+        item["length"] = summary["length"]
+        last_row = summary["last_row"]
+        item["last_row"] = last_row
+        if len(last_row) >= 30:
+            item["last_row_prev"] = last_row[0:30]
+        else:
+            item["last_row_prev"] = last_row
         items.append(item)
     return items
 
 """------------------------------Backup Part---------------------------------"""
 
 def get_list_back():
-    list_directory = os.listdir("/var/backups")
+    list_directory = os.listdir(BACKUP_DIR)
     list_inv = []
     for i in list_directory:
         j = i.find("Inventarsystem")
@@ -64,111 +256,232 @@ def get_list_back():
             list_inv.append(i)
     return list_inv
 
-def get_back():
+def _backup_date(name):
+    date = name.replace("Inventarsystem-", "")
+    return date.replace(".tar.gz", "")
+
+def _backup_path(date):
+    return os.path.join(BACKUP_DIR, f"Inventarsystem-{date}.tar.gz")
+
+def get_back(order="desc", cursor=None, limit=None):
     items = []
-    for i in get_list_back():
-        item = {"date": None, "size": None, "content": None}
-        file_list = []
-        date = i.replace("Inventarsystem-", "")
-        date = date.replace(".tar.gz", "")
+    paths = [os.path.join(BACKUP_DIR, i) for i in get_list_back()]
+    # Summaries come from the catalog; only new or changed archives get decompressed.
+    entries = [
+        {"date": _backup_date(e["name"]), "size": e["size"], "member_count": e["member_count"],
+         "sha256": e["sha256"], "kind": "full", "stored_bytes": e["size"]}
+        for e in backup_catalog.refresh(paths)
+    ]
+    # Incremental snapshots are listed next to the archives; their size is the logical size
+    entries += [
+        {"date": m["name"], "size": m["size"], "member_count": m["member_count"],
+         "sha256": None, "kind": "snapshot", "stored_bytes": m["stored_bytes"]}
+        for m in snapshots.list_snapshots(SNAPSHOT_STORE)
+    ]
+    entries.sort(key=lambda e: e["date"], reverse=(order != "asc"))
+    for entry in entries:
+        item = {"date": None, "size": None, "size_bytes": None, "member_count": None, "sha256": None,
+                "kind": None, "stored_bytes": None}
+        date = entry["date"]
+        if cursor and (date >= cursor if order != "asc" else date <= cursor):
+            continue
         item["date"] = date
-        size_b = os.path.getsize(os.path.join("/var/backups",i))
+        size_b = entry["size"]
+        item["size_bytes"] = size_b
         size_gb = size_b / 1000000000
         size_gb = round(size_gb, 2)
-        with tarfile.open(os.path.join("/var/backups",i), 'r:gz') as tar:
-            for member in tar.getmembers():
-                file_list.append(member.name)
-                item["content"] = file_list
+        item["member_count"] = entry["member_count"]
+        item["sha256"] = entry["sha256"]
+        item["kind"] = entry["kind"]
+        item["stored_bytes"] = entry["stored_bytes"]
         if size_gb == 0.0:
             size_mb = size_b / 1000000
             item["size"] = f"{round(size_mb, 2)} MB"
         else:
             item["size"] = f"{size_gb} GB"
-        # jetzt noch content
         items.append(item)
+        if limit and len(items) >= limit:
+            break
     return items
 
-def create_backup(pw):
-    backup_path = os.path.join(BASE_DIR, "backup.sh")
-    if not backup_path:
-        return False
+def backup_inventory():
+    """All backups (archives and snapshots) in the form the retention rules work on"""
+    items = [{"name": b["date"], "kind": b["kind"], "size": b["size_bytes"], "stored_bytes": b["stored_bytes"]}
+             for b in get_back()]
+    # Keeps the size history for the forecast, also of backups that get pruned later
+    retention.record(items)
+    return items
 
-    cmd = f'cd "{BASE_DIR}" && bash "{backup_path}"'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-        )
-        return result.stdout
-    else: 
+def retention_settings():
+    scheduler = read_config().get("scheduler") or {}
+    rules = scheduler.get("retention")
+    return {
+        "rules": retention.normalize_rules(rules) if rules else None,
+        "auto": bool(rules) and (rules.get("auto", True) is not False),
+        "interval_hours": scheduler.get("backup_interval_hours") or 24,
+    }
+
+def prune_backups(pw):
+    """Delete what the retention rules do not keep, as a background job"""
+    result = retention.plan(backup_inventory(), retention_settings()["rules"])
+    archives = [_backup_path(b["name"]) for b in result["prune"] if b["kind"] == "full"]
+    names = [b["name"] for b in result["prune"] if b["kind"] == "snapshot"]
+    if not archives and not names:
+        return None
+    snapshot_argv = [sys.executable, SNAPSHOT_SCRIPT, "--store", SNAPSHOT_STORE, "delete", *names]
+
+    def refresh_catalog(_job):
+        backup_catalog.refresh([os.path.join(BACKUP_DIR, i) for i in get_list_back()])
+    if not archives:
+        # Snapshots belong to the service user, no sudo needed
+        return jobs.submit("prune", snapshot_argv, JOB_RESOURCES["prune"], on_done=refresh_catalog)
+    if not pw:
         return False
+    cmd = "rm -f -- " + " ".join(shlex.quote(a) for a in archives)
+    if names:
+        cmd += " && " + " ".join(shlex.quote(a) for a in snapshot_argv)
+    return jobs.submit("prune", ["sudo", "-S", "bash", "-lc", cmd], JOB_RESOURCES["prune"],
+                       stdin=(pw + "\n").encode(), on_done=refresh_catalog)
+
+def after_backup(_job):
+    # Index the new archive now so the next listing is instant
+    backup_catalog.refresh([os.path.join(BACKUP_DIR, i) for i in get_list_back()])
+    if retention_settings()["auto"]:
+        try:
+            prune_backups(pw)
+        except jobs.JobConflict:
+            pass
+
+def create_backup(pw):
+    return run_script_job(pw, "backup", "backup.sh", on_done=after_backup)
+
+def restore_target():
+    # Backup members start with the name of the Inventarsystem directory
+    return (read_config().get("backup") or {}).get("restore_root") or os.path.dirname(BASE_DIR.rstrip("/")) or "/"
+
+def build_restore_plan(date, paths=(), collections=()):
+    """Everything restore_plan.py needs to verify or restore one backup; None if it does not exist"""
+    mongo = dict(user.MONGO_DEFAULTS, **(read_config().get("mongodb") or {}))
+    plan = {
+        "paths": list(paths),
+        "collections": list(collections),
+        "target": restore_target(),
+        "mongo": {"host": mongo.get("host"), "port": mongo.get("port")},
+        "store": SNAPSHOT_STORE,
+    }
+    if snapshots.is_valid_name(date):
+        if snapshots.load_manifest(date, SNAPSHOT_STORE) is None:
+            return None
+        return dict(plan, kind="snapshot", source=date)
+    path = _backup_path(date)
+    if not os.path.exists(path):
+        return None
+    # Check against what was recorded when the archive was indexed, not a fresh scan of a possibly damaged file
+    entry = backup_catalog.lookup(path) or backup_catalog.index_archive(path)
+    return dict(plan, kind="full", source=path,
+                expected={"size": entry["size"], "sha256": entry["sha256"]},
+                members=backup_catalog.member_index(path))
+
+def restore_plan_members(plan):
+    if plan["kind"] == "snapshot":
+        return snapshots.load_manifest(plan["source"], SNAPSHOT_STORE)["entries"]
+    return plan["members"]
+
+def write_restore_plan(plan):
+    os.makedirs(RESTORE_PLAN_DIR, exist_ok=True)
+    path = os.path.join(RESTORE_PLAN_DIR, f"{uuid.uuid4().hex}.json")
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(plan, fh)
+
+    def remove_plan(_job):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return path, remove_plan
 
 def restore_backup(pw, date):
-    restore_path = os.path.join(BASE_DIR, "restore.sh")
-    if not restore_path:
+    plan = build_restore_plan(date)
+    if plan is None:
+        return None
+    if not pw:
         return False
-
-    cmd = f'cd "{BASE_DIR}" && bash "{restore_path}" --date={date} --force'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
+    plan_path, remove_plan = write_restore_plan(plan)
+    # Pre-flight: a damaged backup stops the job before restore.sh touches anything
+    verify = f'"{sys.executable}" "{RESTORE_PLAN_SCRIPT}" verify "{plan_path}"'
+    if plan["kind"] == "snapshot":
+        # restore.sh expects an archive; rebuild it from the snapshot, restore, then drop it
+        archive = _backup_path(date)
+        return run_script_job(
+            pw, "restore", "restore.sh", f'--date={date} --force; status=$?; rm -f "{archive}"; exit $status',
+            prepare=f'{verify} && "{sys.executable}" "{SNAPSHOT_SCRIPT}" --store "{SNAPSHOT_STORE}" export {date} "{archive}"',
+            on_done=remove_plan,
         )
-        return result.stdout
-    else: 
+    return run_script_job(pw, "restore", "restore.sh", f"--date={date} --force", prepare=verify, on_done=remove_plan)
+
+def restore_partial(pw, plan):
+    """Restore only the files and/or Mongo collections selected in a plan, verifying the backup first"""
+    if not pw:
+        return False
+    plan_path, remove_plan = write_restore_plan(plan)
+    cmd = " ".join(shlex.quote(a) for a in (sys.executable, RESTORE_PLAN_SCRIPT, "restore", plan_path))
+    # Writes into the installation and MongoDB, so it runs as root like restore.sh
+    return jobs.submit("restore", ["sudo", "-S", "bash", "-lc", cmd], JOB_RESOURCES["restore"],
+                       stdin=(pw + "\n").encode(), on_done=remove_plan)
+
+def verify_backup(pw, date):
+    """Check a backup against its catalog entry or snapshot manifest as a background job"""
+    plan = build_restore_plan(date)
+    if plan is None:
+        return None
+    plan_path, remove_plan = write_restore_plan(plan)
+    argv = [sys.executable, RESTORE_PLAN_SCRIPT, "verify", plan_path]
+    if plan["kind"] == "snapshot" or os.access(plan["source"], os.R_OK):
+        return jobs.submit("verify", argv, JOB_RESOURCES["verify"], on_done=remove_plan)
+    if not pw:
+        remove_plan(None)
         return False
+    return jobs.submit("verify", ["sudo", "-S", *argv], JOB_RESOURCES["verify"],
+                       stdin=(pw + "\n").encode(), on_done=remove_plan)
+
+def backup_settings():
+    backup_cfg = read_config().get("backup") or {}
+    return {
+        "mode": backup_cfg.get("mode") if backup_cfg.get("mode") in ("full", "incremental") else "full",
+        "sources": backup_cfg.get("sources") or ([BASE_DIR] if BASE_DIR else []),
+        "exclude": backup_cfg.get("exclude") or list(snapshots.DEFAULT_EXCLUDES),
+    }
+
+def create_snapshot():
+    """Start an incremental backup; None if mongodump is missing, without which the database would not be in it"""
+    if shutil.which("mongodump") is None:
+        return None
+    settings = backup_settings()
+    mongo = dict(user.MONGO_DEFAULTS, **(read_config().get("mongodb") or {}))
+    argv = [sys.executable, SNAPSHOT_SCRIPT, "--store", SNAPSHOT_STORE, "create",
+            "--mongo", f"{mongo['host']}:{mongo['port']}/{mongo['db']}"]
+    for source in settings["sources"]:
+        argv += ["--source", source]
+    for name in settings["exclude"]:
+        argv += ["--exclude", name]
+    # Runs as the service user: chunks stay writable for pruning and garbage collection
+    return jobs.submit("backup", argv, JOB_RESOURCES["backup"], cwd=BASE_DIR, on_done=after_backup)
 
 
 """------------------------------------------------------------------Start Part--------------------------------------------------------------------"""
 def exe_start(pw):
-    start_path = os.path.join(BASE_DIR, "start.sh")
-    if not start_path:
-        return False
-
-    cmd = f'cd "{BASE_DIR}" && bash "{start_path}"'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-        )
-        return result.stdout
-    else: 
-        return False
+    return run_script_job(pw, "start", "start.sh")
 
 def exe_stop(pw):
-    stop_path = os.path.join(BASE_DIR, "stop.sh")
-    if not stop_path:
-        return False
-
-    cmd = f'cd "{BASE_DIR}" && bash "{stop_path}"'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-        )
-        return result.stdout
-    else: 
-        return False
+    return run_script_job(pw, "stop", "stop.sh")
 
 def exe_restart(pw):
-    restart_path = os.path.join(BASE_DIR, "restart.sh")
-    if not restart_path:
-        return False
-
-    cmd = f'cd "{BASE_DIR}" && bash "{restart_path}"'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-        )
-        return result.stdout
-    else: 
-        return False
+    return run_script_job(pw, "restart", "restart.sh")
 
 def exe_mv(pw, path_from, path_to):
     cmd = f'mv {path_from} {path_to}'
     if pw:
-        result = subprocess.run(
+        result = metrics.run(
             ["sudo", "-S", "bash", "-lc", cmd],
             input=(pw + "\n").encode(),
         )
@@ -187,6 +500,42 @@ def is_valid_password(password):
         return False, "Password must be at least 6 characters long"
     return True, ""
 
+IMPORT_MAX_ROWS = 10000
+
+def parse_user_import(storage=None, payload=None):
+    """Read username/password rows from an uploaded CSV/JSON file or a JSON body"""
+    if storage is not None:
+        raw = storage.read().decode("utf-8-sig", errors="replace")
+        if storage.filename.lower().endswith(".json"):
+            payload = json.loads(raw)
+        else:
+            reader = csv.DictReader(io.StringIO(raw))
+            return [{(k or "").strip().lower(): (v or "").strip() for k, v in r.items()} for r in reader]
+    if isinstance(payload, dict):
+        payload = payload.get("users", [])
+    if not isinstance(payload, list):
+        raise ValueError("Expected a list of users")
+    return [{str(k).strip().lower(): str(v).strip() for k, v in r.items()} for r in payload if isinstance(r, dict)]
+
+def validate_user_import(rows):
+    """Split imported rows into valid ones and per-row errors (row numbers start at 1)"""
+    valid, errors, seen = [], [], set()
+    for i, r in enumerate(rows, start=1):
+        username = r.get("username", "")
+        password = r.get("password", "")
+        if not username or not password:
+            errors.append({"row": i, "username": username, "error": "Username and password are required"})
+        elif not is_valid_username(username):
+            errors.append({"row": i, "username": username, "error": "Username can only contain letters, numbers, and underscores"})
+        elif not user.check_password_strength(password):
+            errors.append({"row": i, "username": username, "error": "Password is too weak"})
+        elif username in seen:
+            errors.append({"row": i, "username": username, "error": "Duplicate username in import"})
+        else:
+            seen.add(username)
+            valid.append({"row": i, "username": username, "password": password})
+    return valid, errors
+
 def generate_user_interactive(username, password, confirm_password):
 
     if not username:
@@ -221,109 +570,37 @@ def generate_user_interactive(username, password, confirm_password):
 
 """---------------------------Fix Part-------------------------------------"""
 def exe_fix_all(pw):
-    fix_path = os.path.join(BASE_DIR, "fix-all.sh")
-    if not fix_path:
-        return False
-
-    cmd = f'cd "{BASE_DIR}" && bash "{fix_path}" --auto'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-        )
-        return result.stdout
-    else: 
-        return False
+    return run_script_job(pw, "fix", "fix-all.sh", "--auto")
 
 """--------------------Update/Version Controlling Part--------------------"""
 def exe_update(pw):
-    update_path = os.path.join(BASE_DIR, "update.sh")
-    if not update_path:
-        return False
-
-    cmd = f'cd "{BASE_DIR}" && bash "{update_path}"'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-            capture_output=True, 
-            text=True,
-        )
-        return result.stdout
-    else: 
-        return False
+    return run_script_job(pw, "update", "update.sh")
 
-def version_list():
+def version_list(offset=0, limit=30):
     list_index = []
-    list_commit = get_commit_history().split("\n")
-    list_commit.pop(len(list_commit)-1)
-    for i in list_commit:
-        item = {"hash": None, "date": None, "description": None, "description_prev": None}
-        commit_hash = i[0:7]
-        item["hash"] = commit_hash
-        commit_description = i[7:len(i)]
-        item["description"] = commit_description
-        if len(i) >= 30:
-            commit_description_prev = i[7:30]
-        else:
-            commit_description_prev = i[7:len(i)]
-        item["description_prev"] = commit_description_prev
-        try:
-            result = subprocess.run(
-                ["git", "show", "-s", "--format=%ci", f"{commit_hash}"],
-                cwd=BASE_DIR,
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            item["date"] = result.stdout
-        except subprocess.CalledProcessError as e:
-            item["date"] = "1212-12-12"
+    try:
+        # One git call per history change; later pages and reloads come from the cache
+        commits, has_more = git_history.get_commits(BASE_DIR, offset, limit)
+    except (subprocess.CalledProcessError, OSError):
+        return [], False
+    for commit in commits:
+        item = {"hash": None, "date": None, "author": None, "description": None, "description_prev": None}
+        item["hash"] = commit["hash"]
+        item["date"] = commit["date"]
+        item["author"] = commit["author"]
+        item["description"] = commit["subject"]
+        item["description_prev"] = commit["subject"][0:23]
         list_index.append(item)
-    return list_index
+    return list_index, has_more
 
 '''-------------------------------------------Downgrading-------------------------------------------'''
 
-def get_commit_history():
-    try:
-        result = subprocess.run(
-            ["git", "--no-pager", "log", "--oneline", "-n", "30"],
-            cwd=BASE_DIR,
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        return (e.stdout or "") + (e.stderr or str(e))
-
-
 def downgrading(pw, commit):
-    update_path = os.path.join(BASE_DIR, "manage-version.sh")
-    if not update_path:
-        return False
+    return run_script_job(pw, "pin", "manage-version.sh", f"pin {commit} --force --restart")
 
-    cmd = f'cd "{BASE_DIR}" && bash "{update_path}" pin {commit} --force --restart'
-    if pw:
-        result = subprocess.run(
-            ["sudo", "-S", "bash", "-lc", cmd],
-            input=(pw + "\n").encode(),
-            capture_output=True, 
-            text=True,
-        )
-        return result.stdout
-    else: 
-        return False
-
-def is_service_running(service="inventarsystem-gunicorn.service"):
-    try:
-        p = subprocess.run(
-            ["systemctl", "is-active", service],
-            capture_output=True, text=True, check=False
-        )
-        return p.stdout.strip() == "active"
-    except Exception:
-        return False
+def is_service_running(service="app"):
+    # Served from the shared snapshot; systemd is asked at most once per interval
+    return service_status.monitor.is_active(service)
 
 
 """--------------------Serving--------------------------------"""
@@ -340,23 +617,168 @@ def backup():
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
         return redirect(url_for('login'))
-    return render_template("backup.html")
+    settings = backup_settings()
+    return render_template("backup.html", backup_mode=settings["mode"],
+                           mongodump_missing=settings["mode"] == "incremental" and shutil.which("mongodump") is None,
+                           mongodump_missing_text=MONGODUMP_MISSING)
 
 @app.route("/get_backups", methods=["GET"])
 def get_backups():
-    items = get_back()
-    return {'items': items}
+    order = "asc" if request.args.get("order") == "asc" else "desc"
+    cursor = request.args.get("cursor") or None
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    except ValueError:
+        limit = 50
+    items = get_back(order, cursor, limit)
+    next_cursor = items[-1]["date"] if len(items) == limit else None
+    return {'items': items, 'next_cursor': next_cursor}
+
+@app.route("/get_backups/<date>/members", methods=["GET"])
+def get_backup_members(date):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    prefix = request.args.get("prefix") or None
+    if snapshots.is_valid_name(date):
+        manifest = snapshots.load_manifest(date, SNAPSHOT_STORE)
+        if manifest is None:
+            return jsonify({"error": "Backup nicht gefunden"}), 404
+        members = ({"name": e["name"], "size": e["size"], "type": "link" if "link" in e["type"] else e["type"]}
+                   for e in manifest["entries"] if not prefix or e["name"].startswith(prefix))
+    else:
+        path = _backup_path(secure_filename(date))
+        if not backup_catalog.index_archive(path):
+            return jsonify({"error": "Backup nicht gefunden"}), 404
+        members = backup_catalog.iter_members(path, prefix)
+
+    def generate():
+        for member in members:
+            yield json.dumps(member, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/backups/retention", methods=["GET"])
+def backup_retention():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    settings = retention_settings()
+    inventory = backup_inventory()
+    # Snapshots share chunks; what pruning frees follows from the chunk sets
+    chunks = snapshots.chunk_usage(SNAPSHOT_STORE)
+    # Dry run: what a prune would delete right now
+    result = retention.plan(inventory, settings["rules"], chunks)
+    try:
+        total, used = retention.disk_usage(BACKUP_DIR)
+        forecast = retention.forecast(inventory, settings["rules"], settings["interval_hours"], total, used,
+                                      chunks=chunks)
+    except OSError:
+        forecast = None
+    return jsonify({
+        "rules": settings["rules"],
+        "auto": settings["auto"],
+        "keep": [{"date": b["name"], "reasons": b["reasons"]} for b in result["keep"]],
+        "prune": [{"date": b["name"], "size_bytes": b["stored_bytes"]} for b in result["prune"]],
+        "freed_bytes": result["freed_bytes"],
+        "forecast": forecast,
+    }), 200
+
+@app.route("/backups/prune", methods=["POST"])
+def run_prune():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    if retention_settings()["rules"] is None:
+        return jsonify({"error": "Keine Aufbewahrungsregeln konfiguriert"}), 400
+    try:
+        job = prune_backups(pw)
+    except jobs.JobConflict as e:
+        return job_conflict(e)
+    if job is None:
+        return jsonify({"message": "Nichts zu löschen.", "job": None}), 200
+    return job_started(job, "Aufräumen gestartet.")
 
 @app.route("/download_backup/<date>", methods=["GET", "POST"])
 def download_backup(date):
-    backups = os.path.join("/var/backups/")
-    return send_from_directory(backups, f"Inventarsystem-{date}.tar.gz", as_attachment=True)
+    if snapshots.is_valid_name(date):
+        if snapshots.load_manifest(date, SNAPSHOT_STORE) is None:
+            return jsonify({"error": "Backup nicht gefunden"}), 404
+        # Rebuilt chunk by chunk while sending; the size is not known up front, so no ranges
+        return Response(stream_with_context(snapshots.iter_tar(date, SNAPSHOT_STORE)), mimetype="application/gzip",
+                        headers={"Content-Disposition": f'attachment; filename="Inventarsystem-{date}.tar.gz"',
+                                 "Accept-Ranges": "none"})
+    path = _backup_path(secure_filename(date))
+    st, entry = _indexed_backup(path)
+    if st is None:
+        return jsonify({"error": "Backup nicht gefunden"}), 404
+    if entry is None:
+        # Not hashed yet: size and mtime are only a weak validator until the catalog has it
+        return send_ranged(path, f"{st.st_size:x}-{st.st_mtime_ns:x}", os.path.basename(path),
+                           "application/gzip", weak=True)
+    # The content hash from the catalog is the strong validator for resumed downloads
+    return send_ranged(path, entry["sha256"], entry["name"], "application/gzip", entry["sha256"])
+
+def _indexed_backup(path):
+    # Requests never scan an archive themselves; one the catalog lacks is queued for it
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    entry = backup_catalog.lookup(path)
+    if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns or not entry["sha256"]:
+        backup_catalog.index_in_background(path)
+        return st, None
+    return st, entry
+
+@app.route("/download_backup/<date>/sha256", methods=["GET"])
+def backup_checksum(date):
+    st, entry = _indexed_backup(_backup_path(secure_filename(date)))
+    if st is None:
+        return jsonify({"error": "Backup nicht gefunden"}), 404
+    if entry is None:
+        return jsonify({"error": "Prüfsumme wird noch berechnet"}), 503, {"Retry-After": "30"}
+    # Same format as sha256sum, so `sha256sum -c` can check the download
+    return Response(f"{entry['sha256']}  {entry['name']}\n", mimetype="text/plain")
+
+@app.route("/backups/manifest.sha256", methods=["GET"])
+def backup_manifest():
+    # Only archives the catalog already hashed; the others are indexed in the background
+    entries = backup_catalog.refresh([os.path.join(BACKUP_DIR, i) for i in get_list_back()], scan=False)
+    lines = [f"{e['sha256']}  {e['name']}\n" for e in sorted(entries, key=lambda e: e["name"]) if e["sha256"]]
+    return Response("".join(lines), mimetype="text/plain")
 
 @app.route("/run_backup")
 def run_backup():
-    create_backup(pw)
+    try:
+        if backup_settings()["mode"] == "incremental":
+            if create_snapshot() is None:
+                flash(MONGODUMP_MISSING, 'error')
+        else:
+            create_backup(pw)
+    except jobs.JobConflict as e:
+        flash(f"Es läuft bereits ein Auftrag ({e.job['kind']}).", 'error')
     return redirect(url_for("backup"))
 
+def _upload_target_name(filename):
+    # If it already looks like a dated backup name, keep it; otherwise rename to today's date
+    if (filename.startswith('Inventarsystem-') and
+        filename.lower().endswith('.tar.gz') and
+        ('2025' in filename or '2026' in filename)):
+        return filename
+    return f"Inventarsystem-{datetime.date.today()}.tar.gz"
+
+def _finish_upload(upload_id, filename, expected_sha256=None):
+    result = backup_upload.commit(upload_id, _upload_target_name(filename), expected_sha256,
+                                  move=lambda src, dst: exe_mv(pw, src, dst))
+    # The upload already hashed every byte; only the member list is left to read
+    backup_catalog.index_in_background(result["path"], result["sha256"])
+    messages.publish("backup", f'Backup "{filename}" hochgeladen.', "success")
+    return result
+
+def upload_error(e):
+    payload = {"error": str(e)}
+    if e.offset is not None:
+        payload["offset"] = e.offset
+    return jsonify(payload), e.status
+
 @app.route('/upload_backup', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -368,25 +790,73 @@ def upload_file():
         # Work with the sanitized filename and check extension properly
         filename = secure_filename(file.filename)
         if filename.lower().endswith('.tar.gz'):
-            # Ensure temp upload directory exists
-            temp_dir = os.path.join(BASE_DIR, "temp_upload") if BASE_DIR else os.path.join(app.root_path, "temp_upload")
-            os.makedirs(temp_dir, exist_ok=True)
-            filepath = os.path.join(temp_dir, filename)
-            file.save(filepath)
-            # If it already looks like a dated backup name, keep it; otherwise rename to today's date
-            if (filename.startswith('Inventarsystem-') and
-                filename.lower().endswith('.tar.gz') and
-                ('2025' in filename or '2026' in filename)):
-                exe_mv(pw, filepath, os.path.join("/var/backups", f"{filename}"))
-                return jsonify({"message": f'Datei "{filename}" erfolgreich hochgeladen!'}), 200
-            else:
-                exe_mv(pw, filepath, os.path.join("/var/backups", f"Inventarsystem-{datetime.date.today()}.tar.gz"))
-                print("Hat alles toll gepklappt du bist so toll Maxi!!")
-                return jsonify({"message": f'Datei "{filename}" erfolgreich hochgeladen!'}), 200
+            # Same staging path as the chunked upload, so the archive is only renamed into place
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            try:
+                upload = backup_upload.create(filename, size)
+                for offset in range(0, size, upload["chunk_size"]):
+                    backup_upload.write_chunk(upload["id"], offset, file.stream,
+                                              min(upload["chunk_size"], size - offset))
+                _finish_upload(upload["id"], filename)
+            except backup_upload.UploadError as e:
+                return upload_error(e)
+            return jsonify({"message": f'Datei "{filename}" erfolgreich hochgeladen!'}), 200
         else:
             return jsonify({"error": f'Datei "{filename}" falsches format!'}), 204
     return jsonify({"error": 'Fehler beim Hochladen der Datei'}), 500
 
+@app.route("/backups/uploads", methods=["POST"])
+def start_upload():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get("filename", "")))
+    if not filename.lower().endswith('.tar.gz'):
+        return jsonify({"error": f'Datei "{filename}" falsches format!'}), 400
+    try:
+        size = int(data.get("size"))
+        return jsonify(backup_upload.create(filename, size)), 201
+    except (TypeError, ValueError):
+        return jsonify({"error": "Ungültige Dateigröße"}), 400
+    except backup_upload.UploadError as e:
+        return upload_error(e)
+
+@app.route("/backups/uploads/<upload_id>", methods=["GET", "PUT", "DELETE"])
+def upload_chunk(upload_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        if request.method == "GET":
+            return jsonify(backup_upload.status(upload_id)), 200
+        if request.method == "DELETE":
+            backup_upload.abort(upload_id)
+            return jsonify({"message": "Upload abgebrochen"}), 200
+        try:
+            offset = int(request.args.get("offset", ""))
+        except ValueError:
+            return jsonify({"error": "offset muss eine Zahl sein"}), 400
+        if request.content_length is None:
+            return jsonify({"error": "Content-Length fehlt"}), 411
+        # Read from the raw body stream; the chunk never sits in memory as a whole
+        return jsonify(backup_upload.write_chunk(upload_id, offset, request.stream, request.content_length)), 200
+    except backup_upload.UploadError as e:
+        return upload_error(e)
+
+@app.route("/backups/uploads/<upload_id>/commit", methods=["POST"])
+def commit_upload(upload_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    try:
+        filename = backup_upload.status(upload_id)["filename"]
+        result = _finish_upload(upload_id, filename, data.get("sha256") or None)
+    except backup_upload.UploadError as e:
+        return upload_error(e)
+    return jsonify({"message": f'Datei "{filename}" erfolgreich hochgeladen!', "sha256": result["sha256"],
+                    "date": _backup_date(os.path.basename(result["path"]))}), 200
+
 @app.errorhandler(413)
 def too_large(_e):
     # RequestEntityTooLarge
@@ -401,12 +871,20 @@ def version():
 
 @app.route("/get_versions", methods=["GET"])
 def get_versions():
-    items = version_list()
-    return {'items': items}
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = max(1, min(int(request.args.get("limit", 30)), 500))
+    except ValueError:
+        offset, limit = 0, 30
+    items, has_more = version_list(offset, limit)
+    return {'items': items, 'has_more': has_more}
 
 @app.route("/use_version/<version>", methods=["GET", "POST"])
 def use_version(version):
-    downgrading(pw, version)
+    try:
+        downgrading(pw, version)
+    except jobs.JobConflict as e:
+        flash(f"Es läuft bereits ein Auftrag ({e.job['kind']}).", 'error')
     return render_template("version.html")
 
 @app.route("/user_managment", methods=["GET", "POST"])
@@ -441,12 +919,85 @@ def user_managment():
 
     return render_template("user_managment.html")
 
+@app.route("/user_managment/users", methods=["GET"])
+def list_users():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    except ValueError:
+        limit = 50
+    fields = request.args.get("fields")
+    fields = tuple(f.strip() for f in fields.split(",")) if fields else user.LISTABLE_FIELDS
+    page = user.list_users(request.args.get("cursor") or None, request.args.get("prefix") or None, limit, fields)
+    return jsonify(page), 200
+
+@app.route("/user_managment/import", methods=["POST"])
+def import_users():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        rows = parse_user_import(request.files.get("file"), None if "file" in request.files else request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": f"Datei konnte nicht gelesen werden: {e}"}), 400
+    if len(rows) > IMPORT_MAX_ROWS:
+        return jsonify({"error": f"Maximal {IMPORT_MAX_ROWS} Zeilen pro Import"}), 413
+    valid, errors = validate_user_import(rows)
+    result = user.import_users(valid) if valid else {"inserted": 0, "errors": []}
+    errors = sorted(errors + result["errors"], key=lambda e: e["row"])
+    return jsonify({"inserted": result["inserted"], "failed": len(errors), "errors": errors}), 200
+
+@app.route("/user_managment/export", methods=["GET"])
+def export_users():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    if request.args.get("format") == "ndjson":
+        def generate():
+            for u in user.iter_users():
+                yield json.dumps(u, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                        headers={"Content-Disposition": "attachment; filename=users.ndjson"})
+
+    def generate_csv():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["username", "admin", "active"])
+        for u in user.iter_users():
+            writer.writerow([u["Username"], u["Admin"], u["Active"]])
+            if buf.tell() > 64 * 1024:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    return Response(stream_with_context(generate_csv()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=users.csv"})
+
+@app.route("/user_managment/batch", methods=["POST"])
+def batch_users():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    usernames = [str(u) for u in data.get("usernames", []) if u]
+    if not usernames:
+        return jsonify({"error": "Keine Benutzer angegeben"}), 400
+    if action == "delete":
+        count = user.delete_users(usernames)
+    elif action in ("deactivate", "activate"):
+        count = user.set_users_active(usernames, action == "activate")
+    else:
+        return jsonify({"error": "Unbekannte Aktion"}), 400
+    return jsonify({"action": action, "count": count}), 200
+
 @app.route("/du", methods=['GET', 'POST'])
 def du():
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
         return redirect(url_for('login'))
     if request.method == 'POST':
+        wait = login_throttle.acquire(request.remote_addr)
+        if wait:
+            return too_many_attempts(wait)
         totp = request.form['password_']
         if not totp:
             flash('Please fill all fields', 'error')
@@ -455,9 +1006,11 @@ def du():
         user_log = user.check_totp(totp)
 
         if user_log:
+            login_throttle.success(request.remote_addr)
             user.delete_all_user()
             return redirect(url_for('home'))
         else:
+            login_throttle.failure(request.remote_addr)
             flash('Invalid credentials', 'error')
             get_flashed_messages()
     return render_template('login.html')
@@ -467,8 +1020,11 @@ def start():
     if request.method == 'POST':
         if 'username' not in session:
             return jsonify({"error": "Unauthorized"}), 401
-        exe_start(pw)
-        return jsonify({"running": is_service_running(), "message": "Start ausgelöst."}), 200
+        try:
+            job = exe_start(pw)
+        except jobs.JobConflict as e:
+            return job_conflict(e)
+        return job_started(job, "Start ausgelöst.", running=is_service_running())
     # GET fallback renders page
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
@@ -480,8 +1036,11 @@ def stop():
     if request.method == 'POST':
         if 'username' not in session:
             return jsonify({"error": "Unauthorized"}), 401
-        exe_stop(pw)
-        return jsonify({"running": is_service_running(), "message": "Stop ausgelöst."}), 200
+        try:
+            job = exe_stop(pw)
+        except jobs.JobConflict as e:
+            return job_conflict(e)
+        return job_started(job, "Stop ausgelöst.", running=is_service_running())
     # GET fallback renders page
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
@@ -493,8 +1052,11 @@ def update_system():
     if request.method == 'POST':
         if 'username' not in session:
             return jsonify({"error": "Unauthorized"}), 401
-        exe_update(pw)
-        return jsonify({"message": "Update ausgelöst."}), 200
+        try:
+            job = exe_update(pw)
+        except jobs.JobConflict as e:
+            return job_conflict(e)
+        return job_started(job, "Update ausgelöst.")
     # GET fallback renders page
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
@@ -506,8 +1068,11 @@ def reload():
     if request.method == 'POST':
         if 'username' not in session:
             return jsonify({"error": "Unauthorized"}), 401
-        exe_restart(pw)
-        return jsonify({"running": is_service_running(), "message": "Reload ausgelöst."}), 200
+        try:
+            job = exe_restart(pw)
+        except jobs.JobConflict as e:
+            return job_conflict(e)
+        return job_started(job, "Reload ausgelöst.", running=is_service_running())
     # GET fallback renders page
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
@@ -519,19 +1084,209 @@ def fix():
     if request.method == 'POST':
         if 'username' not in session:
             return jsonify({"error": "Unauthorized"}), 401
-        exe_fix_all(pw)
-        return jsonify({"running": is_service_running(), "message": "Repair ausgelöst."}), 200
+        try:
+            job = exe_fix_all(pw)
+        except jobs.JobConflict as e:
+            return job_conflict(e)
+        return job_started(job, "Repair ausgelöst.", running=is_service_running())
     # GET fallback renders page
     if 'username' not in session:
         flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
         return redirect(url_for('login'))
     return render_template('home.html')
 
+"""-----------------------------Metrics Part------------------------------"""
+
+jobs.add_listener(metrics.observe_job)
+# /metrics and the profiler report the sum over all gunicorn workers
+metrics.share(os.path.join(backup_catalog.INSTANCE_DIR, "metrics"))
+# Host history for the dashboard; only one worker samples, all can serve it
+host_sampler.sampler.start({"backups": BACKUP_DIR, "logs": os.path.join(BASE_DIR, "logs") if BASE_DIR else None})
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.profiler.enter(request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses (SSE, downloads) are timed until their first byte
+    started = g.pop("request_started", None)
+    metrics.profiler.leave()
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+        metrics.REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+def metrics_allowed():
+    token = os.environ.get("INVENTAR_METRICS_TOKEN")
+    if token:
+        return request.headers.get("Authorization") == f"Bearer {token}" or 'username' in session
+    # Without a token only local scrapers and logged-in users
+    return request.remote_addr in ("127.0.0.1", "::1") or 'username' in session
+
+@app.route("/metrics", methods=["GET"])
+def metrics_export():
+    if not metrics_allowed():
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/profile", methods=["GET", "POST"])
+def metrics_profile():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    if request.method == "POST":
+        data = request.get_json(silent=True) or request.form
+        enabled = str(data.get("enabled", "")).lower() in ("1", "true", "on", "yes")
+        try:
+            slow_ms = int(data.get("slow_ms")) if data.get("slow_ms") not in (None, "") else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "Ungültiger Wert für slow_ms"}), 400
+        if str(data.get("reset", "")).lower() in ("1", "true", "on", "yes"):
+            metrics.profiler.reset()
+        if enabled:
+            metrics.profiler.start(slow_ms / 1000.0 if slow_ms is not None else None)
+        else:
+            metrics.profiler.stop()
+        return jsonify(metrics.profiler.status()), 200
+    if request.args.get("format") == "collapsed":
+        # Input for flamegraph.pl / speedscope
+        return Response(metrics.profiler.collapsed(), mimetype="text/plain")
+    return jsonify(metrics.profiler.status()), 200
+
 @app.route("/status", methods=['GET'])
 def status():
     if 'username' not in session:
         return jsonify({"running": False, "error": "Unauthorized"}), 401
-    return jsonify({"running": is_service_running()}), 200
+    snapshot = service_status.monitor.snapshot()
+    if snapshot["etag"] in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{snapshot["etag"]}"', "Cache-Control": "no-cache"})
+    response = jsonify(snapshot)
+    response.set_etag(snapshot["etag"])
+    response.headers["Cache-Control"] = "no-cache"
+    return response, 200
+
+@app.route("/host/metrics", methods=["GET"])
+def host_metrics():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        since = float(request.args.get("since") or 0)
+        limit = int(request.args.get("limit") or 0) or None
+        data = host_sampler.sampler.series(request.args.get("resolution", "1s"), since, limit)
+    except KeyError:
+        return jsonify({"error": "Auflösung muss 1s, 1m oder 1h sein"}), 400
+    except ValueError:
+        return jsonify({"error": "since und limit müssen Zahlen sein"}), 400
+    data["sampler"] = host_sampler.sampler.status()
+    response = jsonify(data)
+    response.headers["Cache-Control"] = "no-cache"
+    return response, 200
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 200))
+    except ValueError:
+        limit = 50
+    return jsonify({'items': jobs.list_jobs(limit, request.args.get("kind") or None)}), 200
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Auftrag nicht gefunden"}), 404
+    return jsonify(job), 200
+
+@app.route("/jobs/<job_id>/log", methods=["GET"])
+def get_job_log(job_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Auftrag nicht gefunden"}), 404
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        return jsonify({"error": "offset muss eine Zahl sein"}), 400
+    text, end = jobs.read_log(job_id, offset, JOB_LOG_MAX_BYTES)
+    return jsonify({"text": text, "offset": end, "state": job["state"], "exit_code": job["exit_code"]}), 200
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    if jobs.get(job_id) is None:
+        return jsonify({"error": "Auftrag nicht gefunden"}), 404
+    # The event id is the log offset, so a reconnect continues where it stopped
+    start = request.headers.get("Last-Event-ID") or request.args.get("offset") or ""
+    offset = int(start) if start.isdigit() else 0
+
+    def generate():
+        nonlocal offset
+        yield "retry: 1000\n\n"
+        deadline = time.monotonic() + TAIL_MAX_SECONDS
+        state = None
+        while time.monotonic() < deadline:
+            job = jobs.get(job_id)
+            text, offset = jobs.read_log(job_id, offset, JOB_LOG_MAX_BYTES)
+            if text:
+                yield f"id: {offset}\nevent: log\ndata: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+                continue
+            if job["state"] != state:
+                state = job["state"]
+                yield f"id: {offset}\nevent: state\ndata: {json.dumps(job)}\n\n"
+            if state not in jobs.ACTIVE_STATES:
+                yield "event: done\ndata: {}\n\n"
+                return
+            yield f"id: {offset}\n\n"
+            time.sleep(1)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+MESSAGES_MAX_WAIT = 25
+# How often a waiting client checks the logs for new error lines
+LOG_ALERT_SCAN_SECONDS = 5
+_last_log_scan = 0.0
+
+def _scan_logs_for_alerts():
+    global _last_log_scan
+    logs_dir = os.path.join(BASE_DIR, "logs")
+    now = time.monotonic()
+    if now - _last_log_scan < LOG_ALERT_SCAN_SECONDS or not os.path.isdir(logs_dir):
+        return
+    _last_log_scan = now
+    # Only reads what was appended; new error lines reach the bus through log_index
+    for name in os.listdir(logs_dir):
+        if name.endswith(".log"):
+            try:
+                log_index.summarize(os.path.join(logs_dir, name))
+            except OSError:
+                pass
+
+def _last_message_id():
+    start = request.args.get("after") or ""
+    return int(start) if start.isdigit() else 0
+
+@app.route("/messages", methods=["GET"])
+def get_messages():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    after = _last_message_id()
+    try:
+        wait = max(0, min(float(request.args.get("wait", MESSAGES_MAX_WAIT)), MESSAGES_MAX_WAIT))
+    except ValueError:
+        wait = MESSAGES_MAX_WAIT
+    # Long poll: answer as soon as something new exists, otherwise after ``wait`` seconds
+    items = messages.wait(after, wait, on_idle=_scan_logs_for_alerts) if wait else messages.since(after)
+    last_id = items[-1]["id"] if items else (after or messages.latest_id())
+    return jsonify({"messages": items, "last_id": last_id}), 200
 
 @app.route("/logs")
 def logs():
@@ -547,16 +1302,146 @@ def get_logs():
 
 @app.route("/download_logs/<type>", methods=["GET", "POST"])
 def download_logs(type):
-    backups = os.path.join(BASE_DIR, "logs")
-    return send_from_directory(backups, f"{type}.log", as_attachment=True)
+    path = _log_path(type)
+    if not path:
+        return jsonify({"error": "Log nicht gefunden"}), 404
+    return send_ranged(path, None, os.path.basename(path), "text/plain")
+
+@app.route("/logs/<type>/range", methods=["GET"])
+def log_range(type):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    path = _log_path(type)
+    if not path:
+        return jsonify({"error": "Log nicht gefunden"}), 404
+    try:
+        offset = request.args.get("offset")
+        offset = int(offset) if offset not in (None, "") else None
+        limit = int(request.args.get("limit", -100))
+    except ValueError:
+        return jsonify({"error": "offset und limit müssen Zahlen sein"}), 400
+    limit = max(-RANGE_MAX_LINES, min(limit, RANGE_MAX_LINES))
+    return jsonify(log_index.read_lines(path, offset, limit)), 200
+
+@app.route("/logs/<type>/tail", methods=["GET"])
+def log_tail(type):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    path = _log_path(type)
+    if not path:
+        return jsonify({"error": "Log nicht gefunden"}), 404
+    # EventSource sends Last-Event-ID on reconnect; the first request passes ?offset=
+    start = request.headers.get("Last-Event-ID") or request.args.get("offset") or ""
+    offset = int(start) if start.isdigit() else None
+
+    def generate():
+        yield "retry: 1000\n\n"
+        for end, lines in log_index.follow(path, offset, max_seconds=TAIL_MAX_SECONDS):
+            if lines:
+                payload = json.dumps({"lines": lines, "offset": end}, ensure_ascii=False)
+                yield f"id: {end}\ndata: {payload}\n\n"
+            else:
+                # Keep-alive that also moves the resume position forward
+                yield f"id: {end}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/logs/search", methods=["GET"])
+def search_logs():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        since = request.args.get("since")
+        since = datetime.datetime.fromisoformat(since).timestamp() if since else None
+        until = request.args.get("until")
+        until = datetime.datetime.fromisoformat(until).timestamp() if until else None
+        limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+    except ValueError:
+        return jsonify({"error": "Ungültiger Zeitraum oder Limit"}), 400
+    severities = [v.strip().upper() for v in request.args.get("severity", "").split(",") if v.strip()]
+    severities = [v for v in severities if v in log_search.SEVERITIES]
+    # Let the indexer catch up on appended bytes, but answer after a short wait at the latest
+    log_search.update(os.path.join(BASE_DIR, "logs"))
+    current = log_search.wait_idle(log_search.SEARCH_WAIT_SECONDS)
+    items = log_search.search(request.args.get("q", ""), since, until, severities,
+                              request.args.get("file") or None, limit)
+    return jsonify({'items': items, 'indexing': not current}), 200
 
 @app.route("/restore/<date>")
 def restore(date):
     try:
-        restore_backup(pw, date)
-        return redirect(render_template("backup.html"))
-    except:
-        return redirect(render_template("backup.html"))
+        if restore_backup(pw, secure_filename(date)) is None:
+            flash("Backup nicht gefunden.", 'error')
+    except jobs.JobConflict as e:
+        flash(f"Es läuft bereits ein Auftrag ({e.job['kind']}).", 'error')
+    return redirect(url_for("backup"))
+
+def _restore_selection():
+    data = request.get_json(silent=True) or request.values
+    selection = {}
+    for key in ("paths", "collections"):
+        value = data.get(key) or []
+        if isinstance(value, str):
+            value = value.split(",")
+        selection[key] = [v.strip() for v in value if isinstance(v, str) and v.strip()]
+    return selection
+
+@app.route("/restore/<date>/plan", methods=["GET"])
+def restore_preview(date):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    selection = _restore_selection()
+    plan = build_restore_plan(secure_filename(date), **selection)
+    if plan is None:
+        return jsonify({"error": "Backup nicht gefunden"}), 404
+    members = restore_plan_members(plan)
+    chosen = restore_plan.select(members, selection["paths"], selection["collections"])
+    return jsonify({
+        "kind": plan["kind"],
+        "target": plan["target"],
+        "collections": restore_plan.collections_in(members),
+        "files": len(chosen["files"]),
+        "dumps": len(chosen["dumps"]),
+        "bytes": chosen["bytes"],
+        "missing": chosen["missing"],
+    }), 200
+
+@app.route("/restore/<date>/verify", methods=["POST"])
+def restore_verify(date):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        job = verify_backup(pw, secure_filename(date))
+    except jobs.JobConflict as e:
+        return job_conflict(e)
+    if job is None:
+        return jsonify({"error": "Backup nicht gefunden"}), 404
+    if job is False:
+        return jsonify({"error": "Kein sudo-Passwort hinterlegt"}), 403
+    return job_started(job, "Prüfung gestartet.")
+
+@app.route("/restore/<date>/partial", methods=["POST"])
+def restore_selected(date):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    selection = _restore_selection()
+    if not selection["paths"] and not selection["collections"]:
+        return jsonify({"error": "Keine Dateien oder Collections ausgewählt"}), 400
+    plan = build_restore_plan(secure_filename(date), **selection)
+    if plan is None:
+        return jsonify({"error": "Backup nicht gefunden"}), 404
+    chosen = restore_plan.select(restore_plan_members(plan), selection["paths"], selection["collections"])
+    if chosen["missing"]:
+        return jsonify({"error": "Nicht im Backup enthalten: " + ", ".join(chosen["missing"])}), 400
+    try:
+        job = restore_partial(pw, plan)
+    except jobs.JobConflict as e:
+        return job_conflict(e)
+    if job is False:
+        return jsonify({"error": "Kein sudo-Passwort hinterlegt"}), 403
+    return job_started(job, "Wiederherstellung gestartet.", files=len(chosen["files"]),
+                       collections=selection["collections"], bytes=chosen["bytes"])
 
 
 @app.route("/config")
@@ -568,118 +1453,140 @@ def config():
 
 @app.route("/config_update", methods=["POST"])
 def config_update():
-    # Load config.json, apply any provided changes, and save back
-    import json
-
+    if 'username' not in session:
+        flash('Ihnen ist es nicht gestattet auf dieser Internetanwendung, die eben besuchte Adrrese zu nutzen, versuchen sie es erneut nach dem sie sich mit einem berechtigten Nutzer angemeldet haben!', 'error')
+        return redirect(url_for('login'))
     form = request.form
-    # Resolve config path (prefer BASE_DIR)
-    cfg_candidates = []
-    if BASE_DIR:
-        cfg_candidates.append(os.path.join(BASE_DIR, "config.json"))
-    cfg_candidates.append(os.path.join(app.root_path, "config.json"))
-    cfg_path = next((p for p in cfg_candidates if os.path.exists(p)), cfg_candidates[0])
 
-    # Load current config (or start from empty dict)
-    try:
-        with open(cfg_path, "r", encoding="utf-8") as fh:
-            cfg = json.load(fh)
-    except Exception:
-        cfg = {}
-
-    changed = False
-
-    # Update secret key
-    if "key" in form:
-        secret_key = (form.get("key") or "").strip()
-        if secret_key:
-            cfg["key"] = secret_key
-            changed = True
-
-    # Update Mongo DB name
-    if "db_name" in form:
-        db_name = (form.get("db_name") or "").strip()
-        if db_name:
-            cfg.setdefault("mongodb", {})["db"] = db_name
-            changed = True
-
-    # Scheduler intervals
-    if "min_interval" in form:
-        try:
-            val = int(form.get("min_interval"))
-            cfg.setdefault("scheduler", {}).update({"interval_minutes": max(1, val)})
-            changed = True
-        except (TypeError, ValueError):
-            pass
-    if "back_interval" in form:
-        try:
-            val = int(form.get("back_interval"))
-            cfg.setdefault("scheduler", {}).update({"backup_interval_hours": max(1, val)})
-            changed = True
-        except (TypeError, ValueError):
-            pass
+    # Applied to a fresh copy under the store's lock, then validated and written atomically
+    def apply_form(cfg):
+        changed = False
 
-    # Upload sizes (MB)
-    if "max_size" in form:
-        try:
-            val = int(form.get("max_size"))
-            cfg.setdefault("upload", {}).update({"max_size_mb": max(1, val)})
-            changed = True
-        except (TypeError, ValueError):
-            pass
-    if "max_image" in form:
-        try:
-            val = int(form.get("max_image"))
-            cfg.setdefault("upload", {}).update({"image_max_size_mb": max(1, val)})
-            changed = True
-        except (TypeError, ValueError):
-            pass
-    if "max_video" in form:
-        try:
-            val = int(form.get("max_video"))
-            cfg.setdefault("upload", {}).update({"video_max_size_mb": max(1, val)})
-            changed = True
-        except (TypeError, ValueError):
-            pass
+        # Update secret key
+        if "key" in form:
+            secret_key = (form.get("key") or "").strip()
+            if secret_key:
+                cfg["key"] = secret_key
+                changed = True
 
-    # Allowed extensions (comma/space/semicolon separated, strip leading dots)
-    if "al_ext1" in form:
-        raw = (form.get("al_ext1") or "").strip()
-        if raw:
-            parts = re.split(r"[\s,;]+", raw)
-            cleaned, seen = [], set()
-            for p in parts:
-                ext = p.lower().lstrip('.').strip()
-                if ext and ext not in seen:
-                    cleaned.append(ext)
-                    seen.add(ext)
-            if cleaned:
-                cfg["allowed_extensions"] = cleaned
+        # Update Mongo DB name
+        if "db_name" in form:
+            db_name = (form.get("db_name") or "").strip()
+            if db_name:
+                cfg.setdefault("mongodb", {})["db"] = db_name
                 changed = True
 
-    # School periods (st_1..st_10, en_1..en_10)
-    if any(k.startswith("st_") or k.startswith("en_") for k in form.keys()):
-        sp = cfg.setdefault("schoolPeriods", {})
-        for i in range(1, 11):
-            st = (form.get(f"st_{i}") or "").strip()
-            en = (form.get(f"en_{i}") or "").strip()
-            if st and en:
-                sp[str(i)] = {
-                    "start": st,
-                    "end": en,
-                    "label": f"{i}. Stunde ({st} - {en})"
-                }
+        # Scheduler intervals
+        if "min_interval" in form:
+            try:
+                val = int(form.get("min_interval"))
+                cfg.setdefault("scheduler", {}).update({"interval_minutes": max(1, val)})
+                changed = True
+            except (TypeError, ValueError):
+                pass
+        if "back_interval" in form:
+            try:
+                val = int(form.get("back_interval"))
+                cfg.setdefault("scheduler", {}).update({"backup_interval_hours": max(1, val)})
+                changed = True
+            except (TypeError, ValueError):
+                pass
+
+        # Retention rules live next to the backup interval
+        if any(k in form for k in ("ret_daily", "ret_weekly", "ret_monthly")):
+            ret = cfg.setdefault("scheduler", {}).setdefault("retention", {})
+            for key in ("daily", "weekly", "monthly"):
+                try:
+                    ret[key] = max(0, int(form.get(f"ret_{key}")))
+                    changed = True
+                except (TypeError, ValueError):
+                    pass
+
+        # Upload sizes (MB)
+        if "max_size" in form:
+            try:
+                val = int(form.get("max_size"))
+                cfg.setdefault("upload", {}).update({"max_size_mb": max(1, val)})
                 changed = True
+            except (TypeError, ValueError):
+                pass
+        if "max_image" in form:
+            try:
+                val = int(form.get("max_image"))
+                cfg.setdefault("upload", {}).update({"image_max_size_mb": max(1, val)})
+                changed = True
+            except (TypeError, ValueError):
+                pass
+        if "max_video" in form:
+            try:
+                val = int(form.get("max_video"))
+                cfg.setdefault("upload", {}).update({"video_max_size_mb": max(1, val)})
+                changed = True
+            except (TypeError, ValueError):
+                pass
+
+        # Allowed extensions (comma/space/semicolon separated, strip leading dots)
+        if "al_ext1" in form:
+            raw = (form.get("al_ext1") or "").strip()
+            if raw:
+                parts = re.split(r"[\s,;]+", raw)
+                cleaned, seen = [], set()
+                for p in parts:
+                    ext = p.lower().lstrip('.').strip()
+                    if ext and ext not in seen:
+                        cleaned.append(ext)
+                        seen.add(ext)
+                if cleaned:
+                    cfg["allowed_extensions"] = cleaned
+                    changed = True
+
+        # School periods (st_1..st_10, en_1..en_10)
+        if any(k.startswith("st_") or k.startswith("en_") for k in form.keys()):
+            sp = cfg.setdefault("schoolPeriods", {})
+            for i in range(1, 11):
+                st = (form.get(f"st_{i}") or "").strip()
+                en = (form.get(f"en_{i}") or "").strip()
+                if st and en:
+                    sp[str(i)] = {
+                        "start": st,
+                        "end": en,
+                        "label": f"{i}. Stunde ({st} - {en})"
+                    }
+                    changed = True
+
+        return changed
 
-    # Persist if anything changed
-    if changed:
-        try:
-            with open(cfg_path, "w", encoding="utf-8") as fh:
-                json.dump(cfg, fh, ensure_ascii=False, indent=4)
-        except Exception:
-            pass
+    try:
+        _cfg, written = config_store.update(apply_form)
+        if written:
+            flash("Konfiguration gespeichert.", "success")
+        else:
+            flash("Keine Änderungen.", "info")
+        if config_store.error:
+            # Values already in the file that this form did not touch
+            flash("Bereits gespeicherte Werte sind ungültig: " + config_store.error, "error")
+    except ConfigError as e:
+        flash("Ungültige Konfiguration: " + "; ".join(e.problems), "error")
+    except OSError as e:
+        flash(f"Konfiguration konnte nicht gespeichert werden: {e}", "error")
 
     return redirect(url_for("config"))
 
+@app.route("/config.json", methods=["GET"])
+def config_json():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    cfg, etag = config_store.snapshot()
+    if cfg.get("key"):
+        # The secret key of the main app never leaves the server
+        cfg = dict(cfg, key="********")
+    resp = jsonify(cfg)
+    resp.set_etag(etag or "empty")
+    resp.headers["Cache-Control"] = "private, no-cache"
+    if config_store.error:
+        resp.headers["X-Config-Warning"] = config_store.error.encode("ascii", "replace").decode()[:500]
+    return resp.make_conditional(request)
+
 @app.route("/help")
 def help():
     if 'username' not in session:
@@ -689,9 +1596,24 @@ def help():
 
 @app.route("/zurjsn", methods=['GET', 'POST'])
 def zurjsn():
-    user.generate_totp_qrcode()
-    uploads = os.path.join(app.root_path)
-    return send_from_directory(uploads, "qr.png")
+    png, etag = user.get_totp_qrcode()
+    resp = Response(png, mimetype="image/png")
+    resp.set_etag(etag)
+    # Browsers revalidate and get a 304 while the secret stays the same
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+def too_many_attempts(wait):
+    retry_after = max(1, int(wait + 0.999))
+    return Response(f"Zu viele Anmeldeversuche. Bitte in {retry_after} s erneut versuchen.\n",
+                    status=429, mimetype="text/plain", headers={"Retry-After": str(retry_after)})
+
+@app.route("/security/totp", methods=["GET"])
+def totp_stats():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"verifier": dict(user.totp_verifier.counters),
+                    "throttle": dict(login_throttle.counters)}), 200
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -705,6 +1627,10 @@ def login():
     if 'username' in session:
         return redirect(url_for('home'))
     if request.method == 'POST':
+        # Throttled clients get a plain 429 before any template work
+        wait = login_throttle.acquire(request.remote_addr)
+        if wait:
+            return too_many_attempts(wait)
         totp = request.form['password']
         if not totp:
             flash('Please fill all fields', 'error')
@@ -713,9 +1639,11 @@ def login():
         user_log = user.check_totp(totp)
 
         if user_log:
+            login_throttle.success(request.remote_addr)
             session['username'] = "Whatareyoulookingfor"
             return redirect(url_for('home'))
         else:
+            login_throttle.failure(request.remote_addr)
             flash('Invalid credentials', 'error')
             get_flashed_messages()
     return render_template('login.html')
@@ -0,0 +1,319 @@
+"""
+Persistent catalog of the backup archives in /var/backups.
+Stores the member list and SHA-256 of every archive in a small SQLite database
+keyed by (path, size, mtime), so listing backups does not decompress them again
+and downloads can be validated without hashing gigabytes per request.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import hashlib
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+
+INSTANCE_DIR = os.environ.get(
+    "INVENTAR_ADMIN_INSTANCE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance"),
+)
+CATALOG_PATH = os.path.join(INSTANCE_DIR, "backup_catalog.sqlite3")
+
+# Bump whenever the tables change; the catalog is derived data and is rebuilt.
+SCHEMA_VERSION = 3
+
+_SCHEMA = """
+DROP TABLE IF EXISTS members;
+DROP TABLE IF EXISTS archives;
+CREATE TABLE archives (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    member_count INTEGER NOT NULL,
+    sha256 TEXT,
+    error TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE members (
+    archive TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    offset_data INTEGER NOT NULL,
+    PRIMARY KEY (archive, seq)
+);
+CREATE INDEX members_by_name ON members (archive, name);
+"""
+
+# Serialises indexing inside one process so two requests never scan the same archive.
+_scan_lock = threading.Lock()
+
+
+def _connect():
+    os.makedirs(os.path.dirname(CATALOG_PATH), exist_ok=True)
+    conn = sqlite3.connect(CATALOG_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript(_SCHEMA)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+    return conn
+
+
+def _member_type(member):
+    if member.isdir():
+        return "dir"
+    if member.issym() or member.islnk():
+        return "link"
+    return "file"
+
+
+def _is_current(row, st):
+    return row is not None and row["size"] == st.st_size and row["mtime_ns"] == st.st_mtime_ns
+
+
+class _HashingReader:
+    """File wrapper that feeds every byte read through it into a SHA-256."""
+
+    def __init__(self, f):
+        self._f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.sha.update(data)
+        return data
+
+    def drain(self):
+        while self.read(1024 * 1024):
+            pass
+
+
+def _scan(conn, path, st, sha256=None):
+    """
+    Read the archive once, listing its members and hashing it in the same pass.
+    A known ``sha256`` (e.g. from the upload) is stored as is and not recomputed.
+    """
+    members = []
+    error = None
+    try:
+        with open(path, "rb") as raw:
+            reader = _HashingReader(raw) if sha256 is None else raw
+            try:
+                # Stream mode reads the gzip data strictly forward without seeking.
+                with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                    for seq, member in enumerate(tar):
+                        members.append((path, seq, member.name, member.size, _member_type(member),
+                                        member.offset, member.offset_data))
+            except (tarfile.TarError, EOFError) as e:
+                error = str(e)
+            if sha256 is None:
+                # tar stops at its end marker; hash the rest (padding) too
+                reader.drain()
+                sha256 = reader.sha.hexdigest()
+    except OSError as e:
+        error = str(e)
+
+    with conn:
+        conn.execute("DELETE FROM members WHERE archive = ?", (path,))
+        conn.executemany(
+            "INSERT INTO members (archive, seq, name, size, type, offset, offset_data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            members,
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO archives (path, name, size, mtime_ns, member_count, sha256, error, indexed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, os.path.basename(path), st.st_size, st.st_mtime_ns, len(members), sha256, error, time.time()),
+        )
+    return conn.execute("SELECT * FROM archives WHERE path = ?", (path,)).fetchone()
+
+
+def _ensure(conn, path, sha256=None):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    row = conn.execute("SELECT * FROM archives WHERE path = ?", (path,)).fetchone()
+    if _is_current(row, st):
+        return row
+    with _scan_lock:
+        # Another thread may have indexed it while we waited for the lock.
+        row = conn.execute("SELECT * FROM archives WHERE path = ?", (path,)).fetchone()
+        if _is_current(row, st):
+            return row
+        return _scan(conn, path, st, sha256)
+
+
+def index_archive(path, sha256=None):
+    """
+    Make sure an archive is indexed, scanning it only if it is new or changed.
+    Call this right after a backup has been written or uploaded.
+
+    Args:
+        path (str): Absolute path of the archive
+        sha256 (str): Checksum already known to the caller; saves hashing the archive again
+
+    Returns:
+        dict: Catalog entry, or None if the file does not exist
+    """
+    conn = _connect()
+    try:
+        row = _ensure(conn, path, sha256)
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def index_in_background(path, sha256=None):
+    """Like :func:`index_archive`, but in a thread, so the caller does not wait for the scan."""
+    threading.Thread(target=index_archive, args=(path, sha256), name="backup-catalog-index",
+                     daemon=True).start()
+
+
+def refresh(paths, scan=True):
+    """
+    Bring the catalog in line with the given archives.
+    Unchanged archives cost a single stat; entries for archives that are no
+    longer in the list are dropped.
+
+    Args:
+        paths (list): Absolute paths of all archives that currently exist
+        scan (bool): Scan new or changed archives now; if False they are
+            indexed in the background and left out of the result
+
+    Returns:
+        list: Catalog entries in the order of ``paths`` (missing files skipped)
+    """
+    conn = _connect()
+    try:
+        entries = []
+        known = set()
+        for path in paths:
+            if scan:
+                row = _ensure(conn, path)
+            else:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                row = conn.execute("SELECT * FROM archives WHERE path = ?", (path,)).fetchone()
+                if not _is_current(row, st):
+                    known.add(path)
+                    index_in_background(path)
+                    continue
+            if row:
+                known.add(path)
+                entries.append(dict(row))
+        stale = [r["path"] for r in conn.execute("SELECT path FROM archives") if r["path"] not in known]
+        if stale:
+            with conn:
+                conn.executemany("DELETE FROM members WHERE archive = ?", [(p,) for p in stale])
+                conn.executemany("DELETE FROM archives WHERE path = ?", [(p,) for p in stale])
+        return entries
+    finally:
+        conn.close()
+
+
+def invalidate(path):
+    """
+    Forget an archive so the next lookup scans it again.
+
+    Args:
+        path (str): Absolute path of the archive
+    """
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM members WHERE archive = ?", (path,))
+            conn.execute("DELETE FROM archives WHERE path = ?", (path,))
+    finally:
+        conn.close()
+
+
+def iter_members(path, prefix=None):
+    """
+    Stream the members of an indexed archive without materialising the list.
+
+    Args:
+        path (str): Absolute path of the archive
+        prefix (str): Only yield members whose name starts with this prefix
+
+    Yields:
+        dict: Member with name, size and type
+    """
+    conn = _connect()
+    try:
+        if prefix:
+            # Range scan on the (archive, name) index instead of a LIKE scan.
+            cursor = conn.execute(
+                "SELECT name, size, type FROM members WHERE archive = ? AND name >= ? AND name < ? ORDER BY name",
+                (path, prefix, prefix + "\U0010ffff"),
+            )
+        else:
+            cursor = conn.execute(
+                "SELECT name, size, type FROM members WHERE archive = ? ORDER BY seq", (path,)
+            )
+        for row in cursor:
+            yield {"name": row["name"], "size": row["size"], "type": row["type"]}
+    finally:
+        conn.close()
+
+
+def lookup(path):
+    """
+    Return the stored catalog entry of an archive without checking the file.
+    Used to verify an archive against what was recorded when it was indexed,
+    and by requests that must not wait for a scan (compare ``size`` and
+    ``mtime_ns`` with a stat to know whether the entry is still current).
+
+    Args:
+        path (str): Absolute path of the archive
+
+    Returns:
+        dict: Catalog entry, or None if the archive was never indexed
+    """
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM archives WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def member_index(path):
+    """
+    Return every member of an indexed archive with its offsets, in archive order.
+    ``offset`` is where the member's header starts in the uncompressed tar
+    stream, so a reader can seek straight to it.
+
+    Args:
+        path (str): Absolute path of the archive
+
+    Returns:
+        list: Dicts with seq, name, size, type, offset and offset_data
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT seq, name, size, type, offset, offset_data FROM members WHERE archive = ? ORDER BY seq", (path,)
+        ).fetchall()
+        return [dict(r) for r in rows]
+    finally:
+        conn.close()
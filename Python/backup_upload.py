@@ -0,0 +1,311 @@
+"""
+Resumable, chunked upload of backup archives.
+Chunks are written straight into a staging file on the same filesystem as
+/var/backups, so committing an upload is a single hard link (which, unlike a
+rename, never replaces an existing archive): every byte hits the disk once
+and no archive is held in memory. Writers of one upload take an
+flock on its staging file, so chunks and the commit are serialised across
+worker processes. The worker that receives the chunks in a row keeps a
+running SHA-256; if they were spread over workers, the commit hashes the
+staged file once instead.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+BACKUP_DIR = os.environ.get("INVENTAR_BACKUP_DIR") or "/var/backups"
+# Must be on the same filesystem as BACKUP_DIR, otherwise the commit is a copy (sudo mv).
+# start.sh creates it owned by the service user.
+STAGING_DIR = os.environ.get("INVENTAR_UPLOAD_STAGING") or os.path.join(BACKUP_DIR, ".incoming")
+CHUNK_SIZE = 8 * 1024 * 1024
+# Bytes copied from the request stream per write
+COPY_BUFFER = 1024 * 1024
+# Unfinished uploads untouched for this long are removed
+STALE_SECONDS = 24 * 3600
+
+_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_lock = threading.Lock()
+# upload id -> (bytes hashed, sha256) for the chunks this process wrote in a row
+_hashers = {}
+
+
+class UploadError(Exception):
+    """Raised for requests that do not fit the state of an upload."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _part_path(upload_id):
+    return os.path.join(STAGING_DIR, f"{upload_id}.part")
+
+
+def _meta_path(upload_id):
+    return os.path.join(STAGING_DIR, f"{upload_id}.json")
+
+
+def _load(upload_id):
+    if not _ID.match(upload_id or ""):
+        raise UploadError("Upload nicht gefunden", 404)
+    try:
+        with open(_meta_path(upload_id), "r", encoding="utf-8") as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        raise UploadError("Upload nicht gefunden", 404)
+    # The staged file is the truth: a crash after writing but before saving
+    # the metadata only loses the partial chunk, which is written again.
+    try:
+        meta["offset"] = min(os.path.getsize(_part_path(upload_id)), meta["offset"])
+    except OSError:
+        raise UploadError("Upload nicht gefunden", 404)
+    return meta
+
+
+def _save(meta):
+    tmp = _meta_path(meta["id"]) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(meta, fh)
+    os.replace(tmp, _meta_path(meta["id"]))
+
+
+def _public(meta):
+    return {k: meta[k] for k in ("id", "filename", "size", "offset", "chunk_size")}
+
+
+@contextlib.contextmanager
+def _locked(upload_id):
+    # Exclusive across processes and threads (every caller opens its own descriptor)
+    try:
+        f = open(_part_path(upload_id), "r+b")
+    except OSError:
+        raise UploadError("Upload nicht gefunden", 404)
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield f
+
+
+@contextlib.contextmanager
+def _commit_lock():
+    # One commit into BACKUP_DIR at a time, across processes
+    with open(os.path.join(STAGING_DIR, ".commit.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _take_hasher(upload_id, offset):
+    """The running hash of the first ``offset`` bytes, if this process has it."""
+    if offset == 0:
+        return hashlib.sha256()
+    with _lock:
+        entry = _hashers.pop(upload_id, None)
+    # Bytes before the offset never change again, so a hash that got that far is valid
+    return entry[1] if entry is not None and entry[0] == offset else None
+
+
+def _hash_file(upload_id, length):
+    sha = hashlib.sha256()
+    with open(_part_path(upload_id), "rb") as f:
+        remaining = length
+        while remaining:
+            block = f.read(min(COPY_BUFFER, remaining))
+            if not block:
+                break
+            sha.update(block)
+            remaining -= len(block)
+    return sha
+
+
+def _cleanup_stale(now):
+    try:
+        names = os.listdir(STAGING_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith("."):
+            continue
+        path = os.path.join(STAGING_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > STALE_SECONDS:
+                os.remove(path)
+                with _lock:
+                    _hashers.pop(name.split(".", 1)[0], None)
+        except OSError:
+            pass
+
+
+def create(filename, size):
+    """
+    Start a new upload.
+
+    Args:
+        filename (str): Name of the archive (already sanitized)
+        size (int): Total size in bytes
+
+    Returns:
+        dict: id, filename, size, offset (0) and chunk_size
+    """
+    if size < 0:
+        raise UploadError("Ungültige Dateigröße")
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    _cleanup_stale(time.time())
+    meta = {"id": uuid.uuid4().hex, "filename": filename, "size": size, "offset": 0,
+            "chunk_size": CHUNK_SIZE, "created_at": time.time()}
+    open(_part_path(meta["id"]), "wb").close()
+    _save(meta)
+    return _public(meta)
+
+
+def status(upload_id):
+    """
+    Return the state of an upload; ``offset`` is where the client continues.
+
+    Raises:
+        UploadError: If the upload does not exist
+    """
+    return _public(_load(upload_id))
+
+
+def write_chunk(upload_id, offset, stream, length):
+    """
+    Append one chunk read from ``stream``.
+    Chunks have to arrive in order; a chunk at the wrong offset is refused
+    with the offset the client has to continue from.
+
+    Args:
+        upload_id (str): Upload id
+        offset (int): Offset the chunk starts at
+        stream: File-like object with the chunk bytes (the request body)
+        length (int): Number of bytes in the chunk
+
+    Returns:
+        dict: State of the upload after the chunk
+
+    Raises:
+        UploadError: For unknown uploads, wrong offsets or sizes
+    """
+    _load(upload_id)
+    with _locked(upload_id) as f:
+        meta = _load(upload_id)
+        if offset != meta["offset"]:
+            raise UploadError("Falscher Offset", 409, meta["offset"])
+        last = offset + length == meta["size"]
+        if length <= 0 or length > meta["chunk_size"] or offset + length > meta["size"] \
+                or (length != meta["chunk_size"] and not last):
+            raise UploadError("Ungültige Blockgröße", 400, meta["offset"])
+        sha = _take_hasher(upload_id, offset)
+        written = 0
+        f.seek(offset)
+        f.truncate()
+        while written < length:
+            block = stream.read(min(COPY_BUFFER, length - written))
+            if not block:
+                break
+            f.write(block)
+            if sha is not None:
+                sha.update(block)
+            written += len(block)
+        if written != length:
+            # Connection dropped mid-chunk: keep nothing of it, the client resends
+            f.truncate(offset)
+            raise UploadError("Block unvollständig", 400, offset)
+        f.flush()
+        meta["offset"] = offset + written
+        _save(meta)
+        if sha is not None:
+            with _lock:
+                _hashers[upload_id] = (meta["offset"], sha)
+        return _public(meta)
+
+
+def commit(upload_id, target_name, expected_sha256=None, move=None):
+    """
+    Finish an upload: check size and checksum, then rename it into BACKUP_DIR.
+
+    Args:
+        upload_id (str): Upload id
+        target_name (str): File name inside BACKUP_DIR
+        expected_sha256 (str): Checksum computed by the client, if any
+        move (callable): Called as ``move(src, dst)`` when the service user
+            may not write to BACKUP_DIR itself (e.g. ``sudo mv``)
+
+    Returns:
+        dict: ``path`` of the archive and its ``sha256``
+
+    Raises:
+        UploadError: If the upload is incomplete, the checksum differs or an
+            archive with that name already exists
+    """
+    _load(upload_id)
+    with _locked(upload_id) as f:
+        meta = _load(upload_id)
+        if meta["offset"] != meta["size"]:
+            raise UploadError("Upload unvollständig", 409, meta["offset"])
+        sha = _take_hasher(upload_id, meta["size"]) or _hash_file(upload_id, meta["size"])
+        digest = sha.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != digest:
+            # Keep the hash for a retry with the right checksum
+            with _lock:
+                _hashers[upload_id] = (meta["size"], sha)
+            raise UploadError("Prüfsumme stimmt nicht überein", 422)
+        os.fsync(f.fileno())
+        src = _part_path(upload_id)
+        dst = os.path.join(BACKUP_DIR, target_name)
+        exists = UploadError(f'Ein Backup "{target_name}" existiert bereits', 409)
+        try:
+            # Unlike a rename, link never replaces an archive that is already there
+            os.link(src, dst)
+            os.remove(src)
+        except FileExistsError:
+            raise exists
+        except PermissionError:
+            if move is None:
+                raise
+            # move() cannot refuse to overwrite; the commit lock closes the gap after the check
+            with _commit_lock():
+                if os.path.lexists(dst):
+                    raise exists
+                move(src, dst)
+            if not os.path.exists(dst):
+                raise UploadError("Archiv konnte nicht verschoben werden", 500)
+        _discard(upload_id)
+    return {"path": dst, "sha256": digest}
+
+
+def _discard(upload_id):
+    for path in (_part_path(upload_id), _meta_path(upload_id)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    with _lock:
+        _hashers.pop(upload_id, None)
+
+
+def abort(upload_id):
+    """Drop an unfinished upload and its staged bytes."""
+    _load(upload_id)
+    _discard(upload_id)
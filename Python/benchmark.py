@@ -0,0 +1,313 @@
+"""
+Benchmarks for the hot paths of the admin backend.
+Builds synthetic fixtures in a temporary directory (backup archives, large log
+files, a git repository with a deep history and a user collection), points the
+app at them through its environment variables and times:
+
+    get_back, get_log, version_list, get_all_users, get_user, GET/POST /login
+
+The first call of each path is reported separately as ``cold`` (catalogs and
+caches are empty), the following ``--repeat`` calls as ``warm``. Results are
+written as JSON, so runs on two commits can be compared with ``--compare``:
+
+    python benchmark.py --out before.json
+    git checkout <other commit>
+    python benchmark.py --out after.json --compare before.json
+
+Users are stored in MongoDB when ``--mongo host:port`` is given, otherwise in
+mongomock if it is installed; without either the user benchmarks are skipped.
+With a real MongoDB, ``get_user_connect_per_call`` times the same lookup with
+a new client per call, so one run shows the cost the shared client saves.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULT_VERSION = 1
+LOG_LEVELS = ("INFO", "INFO", "INFO", "DEBUG", "WARNING", "ERROR")
+
+
+def _say(text):
+    print(text, file=sys.stderr, flush=True)
+
+
+"""------------------------------Fixtures------------------------------------"""
+
+def make_backups(directory, count, size_mb, members, seed):
+    """
+    Write ``count`` archives named like backup.sh does, each with ``members``
+    files adding up to ``size_mb`` MiB of random (incompressible) data.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    member_size = max(1, int(size_mb * 1024 * 1024) // max(1, members))
+    day = datetime.date(2024, 1, 1)
+    for i in range(count):
+        path = os.path.join(directory, f"Inventarsystem-{day + datetime.timedelta(days=i)}.tar.gz")
+        with tarfile.open(path, "w:gz", compresslevel=1) as tar:
+            for m in range(members):
+                data = rng.randbytes(member_size)
+                info = tarfile.TarInfo(f"Inventarsystem/uploads/{m // 100:04d}/file-{m:06d}.bin")
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+    return count
+
+
+def make_logs(directory, files, size_mb, seed):
+    """Write ``files`` log files of ``size_mb`` MiB each in the format of the Inventarsystem logs."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    target = int(size_mb * 1024 * 1024)
+    start = datetime.datetime(2024, 1, 1)
+    for f in range(files):
+        lines = []
+        written = 0
+        n = 0
+        with open(os.path.join(directory, f"bench{f}.log"), "w", encoding="utf-8") as fh:
+            while written < target:
+                stamp = start + datetime.timedelta(seconds=n)
+                line = (f"{stamp:%Y-%m-%d %H:%M:%S},{n % 1000:03d} {rng.choice(LOG_LEVELS)} "
+                        f"app: request {n} for /item/{rng.randrange(100000)} took {rng.random():.4f}s\n")
+                lines.append(line)
+                written += len(line)
+                n += 1
+                if len(lines) >= 10000:
+                    fh.write("".join(lines))
+                    lines = []
+            fh.write("".join(lines))
+
+
+def make_git_repo(directory, commits):
+    """Create a repository with ``commits`` commits quickly through git fast-import."""
+    os.makedirs(directory, exist_ok=True)
+    env = dict(os.environ, GIT_CONFIG_NOSYSTEM="1", HOME=directory)
+    subprocess.run(["git", "init", "-q", directory], check=True, env=env)
+    # Commits on one branch are chained by fast-import itself
+    stream = io.BytesIO()
+    stamp = 1700000000
+    for i in range(commits):
+        content = f"version {i}\n".encode()
+        message = f"Change {i}: adjust inventory handling".encode()
+        stream.write(b"commit refs/heads/master\n")
+        stream.write(f"committer Bench <bench@example.invalid> {stamp + i * 60} +0000\n".encode())
+        stream.write(f"data {len(message)}\n".encode() + message + b"\n")
+        stream.write(f"M 644 inline VERSION\ndata {len(content)}\n".encode() + content + b"\n")
+    subprocess.run(["git", "fast-import", "--quiet"], input=stream.getvalue(), cwd=directory, check=True, env=env)
+    subprocess.run(["git", "checkout", "-q", "-f", "master"], cwd=directory, check=True, env=env)
+
+
+def make_users(db, count):
+    """Insert ``count`` users with the document layout of user.add_user."""
+    import user
+    users = db["users"]
+    users.delete_many({})
+    batch = []
+    # One hash for all: hashing is deliberately slow and not what is measured here
+    password_hash = user.hashing("bench-password")
+    for i in range(count):
+        batch.append(user._new_user_doc(f"bench_user_{i:06d}", password_hash))
+        if len(batch) >= 1000:
+            users.insert_many(batch)
+            batch = []
+    if batch:
+        users.insert_many(batch)
+
+
+"""------------------------------Timing--------------------------------------"""
+
+def measure(func, repeat):
+    """Time one cold call and ``repeat`` warm calls of ``func``."""
+    started = time.perf_counter()
+    func()
+    cold = time.perf_counter() - started
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - started)
+    runs.sort()
+    return {
+        "cold": cold,
+        "runs": runs,
+        "min": runs[0] if runs else cold,
+        "median": statistics.median(runs) if runs else cold,
+        "mean": statistics.fmean(runs) if runs else cold,
+        "p95": runs[min(len(runs) - 1, int(len(runs) * 0.95))] if runs else cold,
+    }
+
+
+def run_benchmarks(args, work):
+    """Import the app against the fixtures in ``work`` and time every path."""
+    base = os.path.join(work, "base")
+    os.environ["INVENTAR_BASE"] = base
+    os.environ["INVENTAR_ADMIN_INSTANCE"] = os.path.join(work, "instance")
+    os.environ["INVENTAR_BACKUP_DIR"] = os.path.join(work, "backups")
+    os.environ["INVENTAR_SNAPSHOT_DIR"] = os.path.join(work, "backups", "snapshots")
+    sys.path.insert(0, HERE)
+    import user
+    import app as admin
+
+    results = {}
+    _say("timing get_back")
+    results["get_back"] = measure(lambda: admin.get_back(), args.repeat)
+    _say("timing get_log")
+    results["get_log"] = measure(lambda: admin.get_log(), args.repeat)
+    _say("timing version_list")
+    results["version_list"] = measure(lambda: admin.version_list(0, 30), args.repeat)
+    results["version_list_deep_page"] = measure(lambda: admin.version_list(max(0, args.commits - 60), 30), args.repeat)
+
+    db = None
+    if args.mongo:
+        user.MONGO_DEFAULTS.update(host=args.mongo.rsplit(":", 1)[0], port=int(args.mongo.rsplit(":", 1)[1]),
+                                   db=f"inventar_bench_{os.getpid()}")
+        db = user.get_db()
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            _say("no --mongo and no mongomock: user benchmarks skipped")
+        else:
+            user.MongoClient = lambda *a, **kw: mongomock.MongoClient()
+            db = user.get_db()
+    if db is not None:
+        _say(f"creating {args.users} users")
+        make_users(db, args.users)
+        results["get_all_users"] = measure(user.get_all_users, args.repeat)
+        names = [f"bench_user_{random.Random(args.seed + i).randrange(args.users):06d}" for i in range(args.repeat + 1)]
+        lookups = iter(names)
+        results["get_user"] = measure(lambda: user.get_user(next(lookups)), args.repeat)
+        if args.mongo:
+            host, port = args.mongo.rsplit(":", 1)
+            lookups = iter(names)
+
+            def get_user_connect_per_call():
+                # What user.py did before the shared client: connect, query, close
+                client = user.MongoClient(host, int(port))
+                try:
+                    client[db.name]["users"].find_one({"Username": next(lookups)})
+                finally:
+                    client.close()
+            _say("timing get_user with a client per call")
+            results["get_user_connect_per_call"] = measure(get_user_connect_per_call, args.repeat)
+            db.client.drop_database(db.name)
+    else:
+        results["get_all_users"] = results["get_user"] = {"skipped": "no MongoDB"}
+
+    client = admin.app.test_client()
+    _say("timing /login")
+    results["login_get"] = measure(lambda: client.get("/login"), args.repeat)
+    counter = iter(range(10 ** 9))
+
+    def failed_login():
+        # A fresh client address per attempt, so the throttle never answers instead
+        n = next(counter)
+        client.post("/login", data={"password": "000000"},
+                    headers={"X-Forwarded-For": f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"})
+    results["login_post_invalid"] = measure(failed_login, args.repeat)
+    return results
+
+
+"""------------------------------Output--------------------------------------"""
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    """Print the change of the median (and cold) time of every benchmark."""
+    print(f"{'benchmark':<26}{'before':>12}{'after':>12}{'change':>10}   cold before/after")
+    for name, result in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not old or "median" not in result or "median" not in old:
+            continue
+        change = (result["median"] - old["median"]) / old["median"] * 100 if old["median"] else 0.0
+        print(f"{name:<26}{old['median'] * 1000:>10.2f}ms{result['median'] * 1000:>10.2f}ms{change:>+9.1f}%"
+              f"   {old['cold'] * 1000:.1f}/{result['cold'] * 1000:.1f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the admin backend on synthetic fixtures")
+    parser.add_argument("--out", default="benchmark-results.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="Earlier results to compare with")
+    parser.add_argument("--repeat", type=int, default=10, help="Warm runs per benchmark")
+    parser.add_argument("--backups", type=int, default=20)
+    parser.add_argument("--backup-size-mb", type=float, default=8)
+    parser.add_argument("--members", type=int, default=2000, help="Files per backup archive")
+    parser.add_argument("--logs", type=int, default=2, help="Number of log files")
+    parser.add_argument("--log-mb", type=float, default=256, help="Size of each log file (use 2048+ for multi-GB)")
+    parser.add_argument("--commits", type=int, default=5000, help="Depth of the git history")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--mongo", help="host:port of a MongoDB to use (a throwaway database is created)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="Directory for the fixtures (default: a temporary one)")
+    parser.add_argument("--keep", action="store_true", help="Keep the fixtures afterwards")
+    args = parser.parse_args(argv)
+
+    work = args.workdir or tempfile.mkdtemp(prefix="inventar-bench-")
+    base = os.path.join(work, "base")
+    fixtures = {}
+    try:
+        started = time.perf_counter()
+        _say(f"fixtures in {work}")
+        make_git_repo(base, args.commits)
+        make_logs(os.path.join(base, "logs"), args.logs, args.log_mb, args.seed)
+        make_backups(os.path.join(work, "backups"), args.backups, args.backup_size_mb, args.members, args.seed)
+        fixtures["seconds"] = round(time.perf_counter() - started, 3)
+        results = run_benchmarks(args, work)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    output = {
+        "version": RESULT_VERSION,
+        "commit": _git_commit(),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "workdir", "keep")},
+        "fixtures": fixtures,
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as fh:
+        json.dump(output, fh, indent=2)
+    _say(f"results written to {args.out}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            compare(output, json.load(fh))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
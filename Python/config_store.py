@@ -0,0 +1,319 @@
+"""
+Cached, validated access to the Inventarsystem config.json.
+Readers get the parsed copy held in memory; the file is only looked at again
+when its mtime, size or inode changes (checked at most once per interval).
+Writes validate what they change, then replace the file atomically (temp file
+with the original mode and owner, plus rename) under a thread lock and an flock, so concurrent writers in any
+worker process never interleave and readers never see a half-written file.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+
+# Seconds between two stat() calls on the file
+CHECK_INTERVAL = 1.0
+
+# Known keys and their types. Keys not listed here belong to the main
+# Inventarsystem and are kept as they are.
+#   type        -> value must have that type
+#   (int, lo, hi) -> int within the bounds (None: open)
+#   set          -> one of the values
+#   [spec]       -> list of items matching spec
+#   {"*": spec}  -> mapping with any keys
+SCHEMA = {
+    "key": str,
+    "mongodb": {
+        "host": str,
+        "port": (int, 1, 65535),
+        "db": str,
+        "max_pool_size": (int, 1, None),
+        "timeout_ms": (int, 1, None),
+    },
+    "scheduler": {
+        "interval_minutes": (int, 1, None),
+        "backup_interval_hours": (int, 1, None),
+        "retention": {
+            "daily": (int, 0, None),
+            "weekly": (int, 0, None),
+            "monthly": (int, 0, None),
+            "auto": bool,
+        },
+    },
+    "upload": {
+        "max_size_mb": (int, 1, None),
+        "image_max_size_mb": (int, 1, None),
+        "video_max_size_mb": (int, 1, None),
+    },
+    "allowed_extensions": [str],
+    "schoolPeriods": {"*": {"start": str, "end": str, "label": str}},
+    "backup": {
+        "mode": {"full", "incremental"},
+        "sources": [str],
+        "exclude": [str],
+        "restore_root": str,
+    },
+}
+
+
+class ConfigError(ValueError):
+    """Raised when a config does not match SCHEMA; ``problems`` lists every mismatch."""
+
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+def _type_name(spec):
+    return {str: "Text", bool: "true/false", int: "Zahl", list: "Liste", dict: "Objekt"}.get(spec, spec.__name__)
+
+
+def _check(value, spec, path, problems):
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            problems.append(f"{path}: Objekt erwartet")
+            return
+        for key, item in value.items():
+            sub = spec.get(key, spec.get("*"))
+            if sub is not None:
+                _check(item, sub, f"{path}.{key}" if path else key, problems)
+    elif isinstance(spec, list):
+        if not isinstance(value, list):
+            problems.append(f"{path}: Liste erwartet")
+            return
+        for i, item in enumerate(value):
+            _check(item, spec[0], f"{path}[{i}]", problems)
+    elif isinstance(spec, set):
+        if value not in spec:
+            problems.append(f"{path}: muss einer von {', '.join(sorted(spec))} sein")
+    elif isinstance(spec, tuple):
+        _type, lo, hi = spec
+        # bool is an int in Python, but not in a config file
+        if not isinstance(value, int) or isinstance(value, bool):
+            problems.append(f"{path}: Zahl erwartet")
+        elif (lo is not None and value < lo) or (hi is not None and value > hi):
+            problems.append(f"{path}: {value} liegt außerhalb von {lo}..{hi if hi is not None else '∞'}")
+    elif spec is int:
+        if not isinstance(value, int) or isinstance(value, bool):
+            problems.append(f"{path}: Zahl erwartet")
+    elif not isinstance(value, spec):
+        problems.append(f"{path}: {_type_name(spec)} erwartet")
+
+
+def _delta(old, new):
+    # The parts of ``new`` that differ from ``old``; mappings are compared key by key
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return new
+    return {key: _delta(old.get(key), value) for key, value in new.items() if key not in old or old[key] != value}
+
+
+def validate(cfg, schema=SCHEMA):
+    """
+    Check a config against the schema.
+
+    Args:
+        cfg (dict): Parsed config.json
+        schema (dict): Expected structure (default: SCHEMA)
+
+    Returns:
+        list: Problems found, empty if the config is valid
+    """
+    problems = []
+    _check(cfg, schema, "", problems)
+    return problems
+
+
+class ConfigStore:
+    """
+    In-memory copy of one config file.
+
+    Args:
+        path (str): Path of config.json (may not exist yet)
+        lock_path (str): File used to serialise writers across processes
+            (default: next to the config)
+        check_interval (float): Minimum seconds between two checks of the file
+        schema (dict): Structure enforced on writes
+    """
+
+    def __init__(self, path, lock_path=None, check_interval=CHECK_INTERVAL, schema=SCHEMA):
+        self.path = path
+        self.lock_path = lock_path or path + ".lock"
+        self.check_interval = check_interval
+        self.schema = schema
+        self._lock = threading.Lock()
+        self._data = {}
+        self._etag = None
+        self._signature = None
+        self._checked = None
+        self.error = None
+        self.counters = {"reloads": 0, "writes": 0, "invalid": 0}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _set(self, data, raw, signature):
+        self._data = data
+        self._etag = hashlib.sha1(raw).hexdigest()[:16]
+        self._signature = signature
+
+    def _load(self, signature):
+        if signature is None:
+            self._set({}, b"", None)
+            self.error = None
+            return
+        try:
+            with open(self.path, "rb") as fh:
+                raw = fh.read()
+            data = json.loads(raw.decode("utf-8"))
+        except (OSError, ValueError) as e:
+            # Keep serving the last good copy; the next change is picked up again
+            self.counters["invalid"] += 1
+            self.error = str(e)
+            self._signature = signature
+            return
+        if not isinstance(data, dict):
+            self.counters["invalid"] += 1
+            self.error = "config.json enthält kein Objekt"
+            self._signature = signature
+            return
+        problems = validate(data, self.schema)
+        self.counters["reloads"] += 1
+        # A file edited by hand may not match the schema; it is still served, writes are checked
+        self.error = "; ".join(problems) or None
+        self._set(data, raw, signature)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if self._checked is not None and time.monotonic() - self._checked < self.check_interval:
+                return
+            signature = self._stat()
+            if signature != self._signature or self._checked is None:
+                self._load(signature)
+            self._checked = time.monotonic()
+
+    def snapshot(self):
+        """
+        Return the current config and its ETag.
+        The dict is shared: callers must not change it (use :meth:`get` for a copy).
+
+        Returns:
+            tuple: (config dict, etag)
+        """
+        self._refresh()
+        return self._data, self._etag
+
+    def get(self):
+        """Return a copy of the current config that the caller may change."""
+        return copy.deepcopy(self.snapshot()[0])
+
+    def update(self, change):
+        """
+        Change the config atomically.
+        The file is re-read under the lock, so edits made meanwhile (by hand or
+        by another worker) are not lost.
+
+        Only the values the change touches are validated; problems with
+        values already in the file stay in :attr:`error` and do not block
+        the write.
+
+        Args:
+            change (callable): Called with a copy of the config to modify in
+                place; returns False to skip writing
+
+        Returns:
+            tuple: (config now in effect, whether the file was written)
+
+        Raises:
+            ConfigError: If a changed value does not match the schema
+            OSError: If the file cannot be written
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._load(self._stat())
+            data = copy.deepcopy(self._data)
+            if change(data) is False or data == self._data:
+                return self._data, False
+            problems = validate(_delta(self._data, data), self.schema)
+            if problems:
+                raise ConfigError(problems)
+            raw = json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8")
+            self._write(raw)
+            self.counters["writes"] += 1
+            self.error = "; ".join(validate(data, self.schema)) or None
+            self._set(data, raw, self._stat())
+            self._checked = time.monotonic()
+            return self._data, True
+
+    def _write_in_place(self, raw):
+        # Still serialised by the lock; a reader catching it half-written keeps its last good copy
+        with open(self.path, "r+b") as fh:
+            fh.truncate(0)
+            fh.write(raw)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _write(self, raw):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=".config-", suffix=".tmp", dir=directory)
+        except PermissionError:
+            # Only the file itself is writable for us: rewrite it in place
+            self._write_in_place(raw)
+            return
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(raw)
+                fh.flush()
+                os.fsync(fh.fileno())
+            if st is None:
+                os.chmod(tmp, 0o644)
+            else:
+                # The main Inventarsystem reads the file too: keep its mode and owner
+                os.chmod(tmp, stat.S_IMODE(st.st_mode))
+                if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                    try:
+                        os.chown(tmp, st.st_uid, st.st_gid)
+                    except PermissionError:
+                        # Renaming would hand the file to us; rewriting keeps the owner
+                        os.remove(tmp)
+                        self._write_in_place(raw)
+                        return
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
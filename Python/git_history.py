@@ -0,0 +1,107 @@
+"""
+Commit history of the Inventarsystem checkout for the version page.
+Loads hash, date, author and subject with a single ``git log`` call and caches
+the result until HEAD or the refs change.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import os
+import threading
+
+import metrics
+
+# Commits fetched per git call; deeper pages double the window in one new call.
+INITIAL_WINDOW = 200
+
+_FIELD_SEP = "\x1f"
+_RECORD_SEP = "\x1e"
+_FORMAT = _FIELD_SEP.join(["%H", "%h", "%ci", "%an", "%s"]) + _RECORD_SEP
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _stat_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _fingerprint(repo_dir):
+    """Identify the current history without starting git: HEAD plus the refs it points to."""
+    git_dir = os.path.join(repo_dir, ".git")
+    head_path = os.path.join(git_dir, "HEAD")
+    try:
+        with open(head_path, "r", encoding="utf-8") as fh:
+            head = fh.read().strip()
+    except OSError:
+        return None
+    ref_mtime = None
+    if head.startswith("ref: "):
+        ref_mtime = _stat_ns(os.path.join(git_dir, head[5:]))
+    return head, ref_mtime, _stat_ns(os.path.join(git_dir, "packed-refs"))
+
+
+def _run_git_log(repo_dir, count):
+    result = metrics.run(
+        ["git", "--no-pager", "log", f"--format={_FORMAT}", "-n", str(count)],
+        cwd=repo_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    commits = []
+    for record in result.stdout.split(_RECORD_SEP):
+        record = record.strip("\n")
+        if not record:
+            continue
+        full, short, date, author, subject = record.split(_FIELD_SEP, 4)
+        commits.append({"hash": short, "full_hash": full, "date": date, "author": author, "subject": subject})
+    return commits
+
+
+def get_commits(repo_dir, offset=0, limit=30):
+    """
+    Return a page of the commit history, newest first.
+    Served from the cache while HEAD and the refs are unchanged; a page past
+    the loaded window reloads once with a window large enough to cover it.
+
+    Args:
+        repo_dir (str): Path of the git checkout
+        offset (int): Number of commits to skip
+        limit (int): Page size
+
+    Returns:
+        tuple: (list of commit dicts, bool whether more commits exist)
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+    """
+    fingerprint = _fingerprint(repo_dir)
+    needed = offset + limit + 1
+    with _lock:
+        entry = _cache.get(repo_dir)
+        if (entry is None or fingerprint is None or entry["fingerprint"] != fingerprint
+                or (len(entry["commits"]) < needed and not entry["complete"])):
+            window = INITIAL_WINDOW
+            while window < needed:
+                window *= 2
+            commits = _run_git_log(repo_dir, window)
+            entry = {"fingerprint": fingerprint, "commits": commits, "complete": len(commits) < window}
+            _cache[repo_dir] = entry
+        commits = entry["commits"]
+    return commits[offset:offset + limit], len(commits) > offset + limit
@@ -0,0 +1,344 @@
+"""
+Resource history of the host for the dashboard.
+A background thread reads /proc and statvfs once per second (CPU, load,
+memory, used space of the backup and log filesystems, RSS of mongod) and
+writes the values into fixed-size ring buffers at three resolutions:
+
+    1s  - every sample,        last 15 minutes
+    1m  - mean per minute,     last 24 hours
+    1h  - mean per hour,       last 90 days
+
+The rings are one array of doubles in a memory-mapped file in the instance
+directory, so the size never grows with uptime, the history survives
+restarts and every worker process can read it. Only one process samples: the
+one holding an flock on the file; the others take over if it goes away.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import array
+import fcntl
+import math
+import mmap
+import os
+import threading
+import time
+
+from backup_catalog import INSTANCE_DIR
+
+SERIES_PATH = os.path.join(INSTANCE_DIR, "host_series.bin")
+# Seconds between samples; 0 disables the sampler
+SAMPLE_SECONDS = float(os.environ.get("INVENTAR_HOST_SAMPLE_SECONDS") or 1)
+# How often a process that does not sample checks whether it should take over
+TAKEOVER_SECONDS = 30.0
+# Seconds between two searches for the mongod process while it is not running
+MONGOD_RESCAN_SECONDS = 30.0
+
+FIELDS = ("ts", "cpu_percent", "load1", "mem_used", "mem_total", "backups_used", "backups_total",
+          "logs_used", "logs_total", "mongod_rss")
+# name, seconds per slot, slots
+RESOLUTIONS = (("1s", 1, 900), ("1m", 60, 1440), ("1h", 3600, 2160))
+
+_MAGIC = 0x1A5E5
+_VERSION = 1
+_HEADER = 4           # magic, version, fields, resolutions
+_RING_HEADER = 2      # head, count
+
+
+def _layout():
+    offsets = {}
+    position = _HEADER
+    for name, step, slots in RESOLUTIONS:
+        offsets[name] = position
+        position += _RING_HEADER + slots * len(FIELDS)
+    return offsets, position
+
+
+_OFFSETS, _SIZE = _layout()
+_STEPS = {name: step for name, step, _ in RESOLUTIONS}
+_SLOTS = {name: slots for name, _, slots in RESOLUTIONS}
+
+
+class RingFile:
+    """
+    The ring buffers as one array of doubles in a file.
+    The writer maps the file; readers copy it into an ``array`` per call.
+    A slot's timestamp is cleared while it is rewritten and set last, so a
+    reader never takes a half-written slot for a complete one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._view = None
+
+    def open_for_writing(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a+b")
+        nbytes = _SIZE * 8
+        current = os.fstat(self._file.fileno()).st_size
+        if current != nbytes:
+            self._file.truncate(0)
+            self._file.truncate(nbytes)
+        mm = mmap.mmap(self._file.fileno(), nbytes)
+        self._view = memoryview(mm).cast("d")
+        if tuple(self._view[:_HEADER]) != (_MAGIC, _VERSION, len(FIELDS), len(RESOLUTIONS)):
+            # Other layout (or a new file): start empty
+            self._view[:] = array.array("d", [0.0]) * _SIZE
+            self._view[:_HEADER] = array.array("d", (_MAGIC, _VERSION, len(FIELDS), len(RESOLUTIONS)))
+
+    def append(self, name, values):
+        """Write one slot (``values`` in FIELDS order) to the ring ``name``."""
+        base = _OFFSETS[name]
+        slots = _SLOTS[name]
+        head, count = int(self._view[base]), int(self._view[base + 1])
+        start = base + _RING_HEADER + head * len(FIELDS)
+        self._view[start] = 0.0
+        self._view[start + 1:start + len(FIELDS)] = array.array("d", values[1:])
+        self._view[start] = values[0]
+        self._view[base] = (head + 1) % slots
+        self._view[base + 1] = min(count + 1, slots)
+
+    def read(self, name, since=0.0):
+        """
+        Return the slots of one ring newer than ``since``, oldest first.
+
+        Returns:
+            list: Tuples in FIELDS order
+        """
+        try:
+            with open(self.path, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return []
+        if len(data) != _SIZE * 8:
+            return []
+        values = array.array("d")
+        values.frombytes(data)
+        if tuple(values[:_HEADER]) != (_MAGIC, _VERSION, len(FIELDS), len(RESOLUTIONS)):
+            return []
+        base = _OFFSETS[name] + _RING_HEADER
+        slots = _SLOTS[name]
+        width = len(FIELDS)
+        rows = [tuple(values[base + i * width:base + (i + 1) * width]) for i in range(slots)]
+        return sorted(r for r in rows if r[0] > since)
+
+
+class _Bucket:
+    # Running mean of the 1s samples falling into one slot of a coarser ring
+    def __init__(self, step):
+        self.step = step
+        self.index = None
+        self.sums = [0.0] * len(FIELDS)
+        self.counts = [0] * len(FIELDS)
+
+    def add(self, values):
+        """Add a sample; returns the finished previous slot when a new one starts."""
+        index = int(values[0] // self.step)
+        finished = None
+        if self.index is not None and index != self.index:
+            finished = [self.index * self.step] + [
+                s / c if c else math.nan for s, c in zip(self.sums[1:], self.counts[1:])]
+            self.sums = [0.0] * len(FIELDS)
+            self.counts = [0] * len(FIELDS)
+        self.index = index
+        for i, value in enumerate(values[1:], 1):
+            if not math.isnan(value):
+                self.sums[i] += value
+                self.counts[i] += 1
+        return finished
+
+
+def _read_cpu_times():
+    with open("/proc/stat", "r") as fh:
+        parts = fh.readline().split()[1:]
+    times = [int(p) for p in parts]
+    # idle + iowait count as not busy
+    idle = times[3] + (times[4] if len(times) > 4 else 0)
+    return sum(times), idle
+
+
+def _read_meminfo():
+    info = {}
+    with open("/proc/meminfo", "r") as fh:
+        for line in fh:
+            key, _, rest = line.partition(":")
+            if key in ("MemTotal", "MemAvailable"):
+                info[key] = int(rest.split()[0]) * 1024
+    return info.get("MemTotal", 0), info.get("MemAvailable", 0)
+
+
+def _disk(path):
+    try:
+        st = os.statvfs(path)
+    except (OSError, TypeError):
+        return math.nan, math.nan
+    total = st.f_blocks * st.f_frsize
+    return float(total - st.f_bfree * st.f_frsize), float(total)
+
+
+def _find_process(name):
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/comm", "r") as fh:
+                if fh.read().strip() == name:
+                    return int(entry)
+        except OSError:
+            continue
+    return None
+
+
+class HostSampler:
+    """
+    Samples the host into the ring file and serves the series from it.
+
+    Args:
+        path (str): Ring file
+        interval (float): Seconds between samples (0: never sample)
+        disks (dict): ``backups`` and ``logs`` -> directory whose filesystem is measured
+    """
+
+    def __init__(self, path=SERIES_PATH, interval=SAMPLE_SECONDS, disks=None):
+        self.path = path
+        self.interval = interval
+        self.disks = dict(disks or {})
+        self.rings = RingFile(path)
+        self.sampling = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._cpu = None
+        self._mongod = None
+        self._mongod_checked = 0.0
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self.counters = {"samples": 0, "errors": 0}
+
+    def start(self, disks=None):
+        """Start the background thread (once per process)."""
+        if disks:
+            self.disks.update(disks)
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="host-sampler", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        lock_path = self.path + ".lock"
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        lock_file = open(lock_path, "a")
+        # One sampler per host: whoever holds the lock; the others check now and then
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                time.sleep(TAKEOVER_SECONDS)
+        self.sampling = True
+        self.rings.open_for_writing()
+        buckets = {name: _Bucket(step) for name, step, _ in RESOLUTIONS[1:]}
+        next_at = time.monotonic()
+        while True:
+            try:
+                values = self.sample()
+            except OSError:
+                self.counters["errors"] += 1
+            else:
+                if values is not None:
+                    self.rings.append(RESOLUTIONS[0][0], values)
+                    for name, bucket in buckets.items():
+                        finished = bucket.add(values)
+                        if finished is not None:
+                            self.rings.append(name, finished)
+                    self.counters["samples"] += 1
+            next_at += self.interval
+            delay = next_at - time.monotonic()
+            if delay < 0:
+                # Fell behind (suspend, overload): skip the missed ticks
+                next_at = time.monotonic()
+                delay = 0
+            time.sleep(delay)
+
+    def _mongod_rss(self):
+        now = time.monotonic()
+        if self._mongod is None and now - self._mongod_checked >= MONGOD_RESCAN_SECONDS:
+            self._mongod_checked = now
+            self._mongod = _find_process("mongod")
+        if self._mongod is None:
+            return math.nan
+        try:
+            with open(f"/proc/{self._mongod}/statm", "r") as fh:
+                return float(int(fh.read().split()[1]) * self._page_size)
+        except (OSError, IndexError, ValueError):
+            # Restarted or gone; look again on the next sample
+            self._mongod = None
+            self._mongod_checked = 0.0
+            return math.nan
+
+    def sample(self):
+        """
+        Take one sample.
+
+        Returns:
+            list: Values in FIELDS order (NaN where unknown), or None for the
+            very first call, which only primes the CPU counters
+        """
+        total, idle = _read_cpu_times()
+        previous, self._cpu = self._cpu, (total, idle)
+        if previous is None:
+            return None
+        busy = total - previous[0]
+        cpu = 100.0 * (1 - (idle - previous[1]) / busy) if busy > 0 else 0.0
+        mem_total, mem_available = _read_meminfo()
+        backups_used, backups_total = _disk(self.disks.get("backups"))
+        logs_used, logs_total = _disk(self.disks.get("logs"))
+        return [time.time(), cpu, os.getloadavg()[0], float(mem_total - mem_available), float(mem_total),
+                backups_used, backups_total, logs_used, logs_total, self._mongod_rss()]
+
+    def series(self, resolution="1s", since=0.0, limit=None):
+        """
+        Columnar series of one resolution for charts.
+
+        Args:
+            resolution (str): ``1s``, ``1m`` or ``1h``
+            since (float): Only points after this Unix time
+            limit (int): Only the newest points
+
+        Returns:
+            dict: ``resolution``, ``step`` and ``series`` (field -> list,
+            None where a value is unknown)
+
+        Raises:
+            KeyError: For an unknown resolution
+        """
+        step = _STEPS[resolution]
+        rows = self.rings.read(resolution, since)
+        if limit:
+            rows = rows[-limit:]
+        columns = list(zip(*rows)) if rows else [()] * len(FIELDS)
+        return {
+            "resolution": resolution,
+            "step": step,
+            "series": {field: [None if math.isnan(v) else v for v in column]
+                       for field, column in zip(FIELDS, columns)},
+        }
+
+    def status(self):
+        return {"sampling": self.sampling, "interval": self.interval, "pid": os.getpid(), **self.counters}
+
+
+sampler = HostSampler()
@@ -0,0 +1,310 @@
+"""
+Background jobs for long-running maintenance scripts (backup, restore, update, ...).
+Jobs run in a small worker pool, their output goes to a per-job log file and
+their records (state, start/end, exit code) are kept in SQLite. Jobs that need
+the same resources never run at the same time.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+
+from backup_catalog import INSTANCE_DIR
+
+JOBS_DB_PATH = os.path.join(INSTANCE_DIR, "jobs.sqlite3")
+JOB_LOG_DIR = os.path.join(INSTANCE_DIR, "jobs")
+MAX_WORKERS = 2
+# Finished jobs kept (with their logs) before the oldest are removed
+KEEP_JOBS = 200
+SCHEMA_VERSION = 2
+
+ACTIVE_STATES = ("queued", "running")
+
+_SCHEMA = """
+DROP TABLE IF EXISTS jobs;
+CREATE TABLE jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    resources TEXT NOT NULL,
+    pid INTEGER,
+    child_pid INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    exit_code INTEGER,
+    error TEXT
+);
+CREATE INDEX jobs_by_state ON jobs (state);
+CREATE INDEX jobs_by_created ON jobs (created_at);
+"""
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_listeners = []
+
+
+class JobConflict(Exception):
+    """Raised when a job needs resources that a queued or running job holds."""
+
+    def __init__(self, job):
+        super().__init__(f"{job['kind']} job {job['id']} is still {job['state']}")
+        self.job = job
+
+
+def _connect():
+    os.makedirs(os.path.dirname(JOBS_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript(_SCHEMA)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return conn
+
+
+def _to_dict(row):
+    job = dict(row)
+    job["resources"] = json.loads(job["resources"])
+    return job
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _group_alive(pgid):
+    # The command leads its own process group, so sudo's children count too
+    if not pgid:
+        return False
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _get_executor():
+    # Thread pools do not survive a fork, so every worker process gets its own.
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="job")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def add_listener(callback):
+    """
+    Register a callback for every finished job (after its own ``on_done``).
+
+    Args:
+        callback (callable): Called with the finished job record
+    """
+    _listeners.append(callback)
+
+
+def log_path(job_id):
+    """Path of the output log of a job."""
+    return os.path.join(JOB_LOG_DIR, f"{job_id}.log")
+
+
+def _finish(job_id, state, exit_code=None, error=None):
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET state = ?, finished_at = ?, exit_code = ?, error = ? WHERE id = ?",
+            (state, time.time(), exit_code, error, job_id),
+        )
+    finally:
+        conn.close()
+
+
+def _run(job_id, argv, stdin, cwd, on_done):
+    conn = _connect()
+    try:
+        conn.execute("UPDATE jobs SET state = 'running', started_at = ? WHERE id = ?", (time.time(), job_id))
+    finally:
+        conn.close()
+    try:
+        with open(log_path(job_id), "ab") as out:
+            proc = subprocess.Popen(
+                argv, cwd=cwd, stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                stdout=out, stderr=subprocess.STDOUT, start_new_session=True,
+            )
+            conn = _connect()
+            try:
+                conn.execute("UPDATE jobs SET child_pid = ? WHERE id = ?", (proc.pid, job_id))
+            finally:
+                conn.close()
+            if stdin:
+                proc.stdin.write(stdin)
+                proc.stdin.close()
+            exit_code = proc.wait()
+        _finish(job_id, "succeeded" if exit_code == 0 else "failed", exit_code)
+    except OSError as e:
+        _finish(job_id, "failed", error=str(e))
+    for callback in ([on_done] if on_done else []) + _listeners:
+        try:
+            callback(get(job_id))
+        except Exception as e:
+            with open(log_path(job_id), "a", encoding="utf-8") as out:
+                out.write(f"\n[job] follow-up step failed: {e}\n")
+
+
+def _prune(conn):
+    old = conn.execute(
+        "SELECT id FROM jobs WHERE state NOT IN ('queued', 'running') ORDER BY created_at DESC LIMIT -1 OFFSET ?",
+        (KEEP_JOBS,),
+    ).fetchall()
+    for row in old:
+        conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+        try:
+            os.remove(log_path(row["id"]))
+        except OSError:
+            pass
+
+
+def submit(kind, argv, resources, stdin=None, cwd=None, on_done=None):
+    """
+    Queue a command as a background job.
+
+    Args:
+        kind (str): Job type shown in the UI (e.g. ``backup``)
+        argv (list): Command to run
+        resources (iterable): Names of what the job changes; jobs sharing one
+            never overlap
+        stdin (bytes): Data written to the command's stdin (e.g. the sudo password)
+        cwd (str): Working directory
+        on_done (callable): Called with the finished job record
+
+    Returns:
+        dict: The new job record
+
+    Raises:
+        JobConflict: If a queued or running job holds one of the resources
+    """
+    resources = sorted(set(resources))
+    job_id = uuid.uuid4().hex[:12]
+    os.makedirs(JOB_LOG_DIR, exist_ok=True)
+    conn = _connect()
+    try:
+        # BEGIN IMMEDIATE makes check-and-insert atomic across worker processes.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in conn.execute("SELECT * FROM jobs WHERE state IN ('queued', 'running')").fetchall():
+                # A dead worker can leave its command (sudo, mongorestore) running
+                if not _pid_alive(row["pid"]) and not _group_alive(row["child_pid"]):
+                    conn.execute(
+                        "UPDATE jobs SET state = 'interrupted', finished_at = ? WHERE id = ?",
+                        (time.time(), row["id"]),
+                    )
+                    continue
+                if set(json.loads(row["resources"])) & set(resources):
+                    raise JobConflict(_to_dict(row))
+            conn.execute(
+                "INSERT INTO jobs (id, kind, state, resources, pid, created_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(resources), os.getpid(), time.time()),
+            )
+            _prune(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    _get_executor().submit(_run, job_id, argv, stdin, cwd, on_done)
+    return get(job_id)
+
+
+def get(job_id):
+    """
+    Return one job record.
+
+    Args:
+        job_id (str): Job id
+
+    Returns:
+        dict: Job record or None
+    """
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _to_dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def list_jobs(limit=50, kind=None):
+    """
+    Return the most recent jobs, newest first.
+
+    Args:
+        limit (int): Maximum number of jobs
+        kind (str): Only jobs of this type
+
+    Returns:
+        list: Job records
+    """
+    conn = _connect()
+    try:
+        if kind:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT ?", (kind, limit)
+            )
+        else:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [_to_dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def read_log(job_id, offset=0, max_bytes=64 * 1024):
+    """
+    Read a slice of a job's output.
+
+    Args:
+        job_id (str): Job id
+        offset (int): Byte offset to start from
+        max_bytes (int): Maximum number of bytes
+
+    Returns:
+        tuple: (text, offset after the returned bytes)
+    """
+    try:
+        with open(log_path(job_id), "rb") as f:
+            f.seek(offset)
+            data = f.read(max_bytes)
+    except OSError:
+        return "", offset
+    return data.decode("utf-8", errors="replace"), offset + len(data)
@@ -0,0 +1,258 @@
+"""
+Load test for the multi-worker deployment.
+Starts gunicorn with the gthread worker class once per worker count, logs in
+once, then lets several client processes hit a mix of endpoints for a fixed
+time and reports requests per second and latency percentiles:
+
+    python loadtest.py --workers 1,2,4 --threads 8 --duration 15
+
+Throughput should grow with the number of workers up to the number of cores.
+The fixtures are the synthetic ones of benchmark.py, smaller by default. With
+``--url`` an already running instance is measured instead (pass a session
+cookie with ``--cookie`` for the endpoints that need a login).
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+import benchmark
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATHS = ("/get_backups", "/get_versions?offset=500", "/logs/search?q=request&limit=100")
+
+
+def _say(text):
+    print(text, file=sys.stderr, flush=True)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+"""------------------------------Server--------------------------------------"""
+
+def start_server(work, workers, threads, port):
+    """Start gunicorn on the fixtures in ``work``; returns the process once it answers."""
+    env = dict(
+        os.environ,
+        INVENTAR_BASE=os.path.join(work, "base"),
+        # A fresh instance directory per run: own secret, catalogs and used TOTP codes
+        INVENTAR_ADMIN_INSTANCE=os.path.join(work, f"instance-{workers}"),
+        INVENTAR_BACKUP_DIR=os.path.join(work, "backups"),
+        INVENTAR_SNAPSHOT_DIR=os.path.join(work, "backups", "snapshots"),
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+         "--workers", str(workers), "--worker-class", "gthread", "--threads", str(threads),
+         "--log-level", "warning"],
+        cwd=HERE, env=env,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/login")
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    stop_server(proc)
+    raise RuntimeError("gunicorn did not answer within 60 seconds")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def login(url):
+    """Log in with the current TOTP code and return the session cookie."""
+    import pyotp
+    import user
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+    body = urllib.parse.urlencode({"password": pyotp.TOTP(user.totp_key).now()})
+    conn.request("POST", "/login", body=body, headers={"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader("Set-Cookie", "")
+    if response.status != 302 or "session=" not in cookie:
+        raise RuntimeError(f"login failed with status {response.status}")
+    return cookie.split(";", 1)[0]
+
+
+"""------------------------------Clients-------------------------------------"""
+
+def _client(url, paths, cookie, threads, duration):
+    # Runs in its own process so the client side is not limited by one GIL
+    parts = urllib.parse.urlsplit(url)
+    headers = {"Cookie": cookie} if cookie else {}
+    deadline = time.monotonic() + duration
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(n):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        own, own_statuses = [], {}
+        i = n
+        while time.monotonic() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = "error"
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+            own.append(time.perf_counter() - started)
+            own_statuses[status] = own_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(own)
+            for status, count in own_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return latencies, statuses
+
+
+def run_load(url, paths, cookie, concurrency, clients, duration):
+    """Keep ``concurrency`` requests in flight for ``duration`` seconds and summarise them."""
+    clients = max(1, min(clients, concurrency))
+    per_client = [concurrency // clients + (1 if i < concurrency % clients else 0) for i in range(clients)]
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(_client, [url] * clients, [paths] * clients, [cookie] * clients,
+                                per_client, [duration] * clients))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(l for result in results for l in result[0])
+    statuses = {}
+    for _, counts in results:
+        for status, count in counts.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    ok = sum(c for s, c in statuses.items() if s.startswith("2"))
+    return {
+        "requests": len(latencies),
+        "ok": ok,
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "rps": round(ok / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else None,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+    }
+
+
+"""------------------------------Main----------------------------------------"""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure throughput of the admin app per worker count")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to compare")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per gthread worker")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight")
+    parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Client processes generating the load")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per run")
+    parser.add_argument("--path", action="append", help="Endpoint to request (repeatable)")
+    parser.add_argument("--url", help="Measure this running instance instead of starting gunicorn")
+    parser.add_argument("--cookie", help="Session cookie (session=...) for --url")
+    parser.add_argument("--backups", type=int, default=20)
+    parser.add_argument("--log-mb", type=float, default=32)
+    parser.add_argument("--commits", type=int, default=2000)
+    parser.add_argument("--out", help="Write the results as JSON")
+    args = parser.parse_args(argv)
+    paths = args.path or list(DEFAULT_PATHS)
+
+    runs = []
+    if args.url:
+        runs.append(dict(run_load(args.url, paths, args.cookie, args.concurrency, args.clients, args.duration),
+                         workers=None))
+    else:
+        work = tempfile.mkdtemp(prefix="inventar-load-")
+        try:
+            _say(f"fixtures in {work}")
+            benchmark.make_git_repo(os.path.join(work, "base"), args.commits)
+            benchmark.make_logs(os.path.join(work, "base", "logs"), 1, args.log_mb, 1)
+            benchmark.make_backups(os.path.join(work, "backups"), args.backups, 1, 200, 1)
+            for workers in (int(n) for n in args.workers.split(",")):
+                port = _free_port()
+                proc = start_server(work, workers, args.threads, port)
+                try:
+                    url = f"http://127.0.0.1:{port}"
+                    cookie = login(url)
+                    # Warm-up: catalogs, log index and git cache are built once per instance
+                    run_load(url, paths, cookie, len(paths), 1, 2)
+                    _say(f"{workers} worker(s): {args.concurrency} concurrent for {args.duration}s")
+                    runs.append(dict(run_load(url, paths, cookie, args.concurrency, args.clients, args.duration),
+                                     workers=workers))
+                finally:
+                    stop_server(proc)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+    base = runs[0]["rps"] or None
+    print(f"{'workers':>8}{'req/s':>10}{'scaling':>9}{'p50':>10}{'p95':>10}{'p99':>10}  errors")
+    for run in runs:
+        run["scaling"] = round(run["rps"] / base, 2) if base else None
+        errors = run["requests"] - run["ok"]
+        print(f"{run['workers'] or '-':>8}{run['rps']:>10.1f}{run['scaling'] or 0:>8.2f}x"
+              f"{run['p50_ms'] or 0:>8.1f}ms{run['p95_ms'] or 0:>8.1f}ms{run['p99_ms'] or 0:>8.1f}ms  {errors}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump({
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "cpus": os.cpu_count(),
+                "platform": platform.platform(),
+                "threads": args.threads,
+                "concurrency": args.concurrency,
+                "paths": paths,
+                "runs": runs,
+            }, fh, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
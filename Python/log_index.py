@@ -0,0 +1,265 @@
+"""
+Incremental summaries of the log files in BASE_DIR/logs.
+Remembers how far every log has been read, so each call only scans the bytes
+appended since the last one instead of reading whole files.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import os
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+# Bytes kept from just before the read offset to notice a file that was
+# truncated and then grew past the old offset again (copytruncate rotation).
+SIGNATURE_SIZE = 64
+# Longest last line we are willing to seek back for.
+MAX_LINE_BYTES = 64 * 1024
+
+_states = {}
+_lock = threading.Lock()
+_listeners = []
+
+
+class _LogState:
+    __slots__ = ("inode", "offset", "newlines", "last_line", "signature")
+
+    def __init__(self, inode):
+        self.inode = inode
+        self.offset = 0
+        self.newlines = 0
+        self.last_line = b""
+        self.signature = b""
+
+
+def add_listener(callback):
+    """
+    Register a callback for every block of bytes read from a log.
+    Used by the search index so it is fed by the same reads as the summaries
+    and the live tail.
+
+    Args:
+        callback (callable): Called as ``callback(path, offset, data)``
+    """
+    _listeners.append(callback)
+
+
+def _notify(path, offset, data):
+    for callback in _listeners:
+        callback(path, offset, data)
+
+
+def _read_signature(f, offset):
+    start = max(0, offset - SIGNATURE_SIZE)
+    f.seek(start)
+    return f.read(offset - start)
+
+
+def _line_ending_at(f, nl_pos):
+    """Return the line terminated by the newline at byte ``nl_pos``, seeking backwards from there."""
+    pos = nl_pos
+    buf = b""
+    while pos > 0 and len(buf) < MAX_LINE_BYTES:
+        step = min(4096, pos)
+        pos -= step
+        f.seek(pos)
+        buf = f.read(step) + buf
+        start = buf.rfind(b"\n")
+        if start != -1:
+            return buf[start + 1:]
+    return buf[-MAX_LINE_BYTES:]
+
+
+def _advance(path, state, f, size):
+    f.seek(state.offset)
+    last_nl = -1
+    pos = state.offset
+    while pos < size:
+        chunk = f.read(min(CHUNK_SIZE, size - pos))
+        if not chunk:
+            break
+        _notify(path, pos, chunk)
+        count = chunk.count(b"\n")
+        if count:
+            state.newlines += count
+            last_nl = pos + chunk.rindex(b"\n")
+        pos += len(chunk)
+    if last_nl != -1:
+        state.last_line = _line_ending_at(f, last_nl)
+    state.offset = pos
+    state.signature = _read_signature(f, pos)
+
+
+def summarize(path):
+    """
+    Return line count and last complete line of a log file.
+    The first call scans the file once; later calls only read appended bytes.
+    A changed inode, a shrunken file or a mismatching signature before the old
+    offset (rotation or truncation) starts the count over.
+
+    Args:
+        path (str): Path of the log file
+
+    Returns:
+        dict: ``length`` (number of newline-separated parts, like
+        ``len(content.split("\\n"))``) and ``last_row`` (last complete line)
+    """
+    st = os.stat(path)
+    with _lock:
+        state = _states.get(path)
+        with open(path, "rb") as f:
+            if (state is None or state.inode != st.st_ino or st.st_size < state.offset
+                    or _read_signature(f, state.offset) != state.signature):
+                state = _LogState(st.st_ino)
+                _states[path] = state
+            if st.st_size > state.offset:
+                _advance(path, state, f, st.st_size)
+        return {
+            "length": state.newlines + 1,
+            "last_row": state.last_line.decode("utf-8", errors="replace"),
+        }
+
+
+def forget(path):
+    """
+    Drop the remembered state of a log file.
+
+    Args:
+        path (str): Path of the log file
+    """
+    with _lock:
+        _states.pop(path, None)
+
+
+def _decode(line):
+    return line.decode("utf-8", errors="replace")
+
+
+def read_lines(path, offset=None, limit=100):
+    """
+    Page through a log by byte offset without reading the whole file.
+    Only complete (newline-terminated) lines are returned; an offset inside a
+    line is moved to the next line start when reading forwards and to the
+    previous one when reading backwards.
+
+    Args:
+        path (str): Path of the log file
+        offset (int): Byte offset to page from (default: end of file)
+        limit (int): Number of lines; positive reads forwards from ``offset``,
+            negative reads backwards from it
+
+    Returns:
+        dict: ``lines``, the byte range ``start``/``end`` they cover and the
+        current file ``size``
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset is None:
+            offset = size
+        offset = max(0, min(offset, size))
+        if limit >= 0:
+            return _read_forward(f, size, offset, limit)
+        return _read_backward(f, size, offset, -limit)
+
+
+def _read_forward(f, size, offset, limit):
+    if offset > 0:
+        f.seek(offset - 1)
+        if f.read(1) != b"\n":
+            # Skip the rest of the line the offset points into.
+            f.seek(offset)
+            rest = f.readline(MAX_LINE_BYTES)
+            offset += len(rest)
+    f.seek(offset)
+    lines = []
+    end = offset
+    while len(lines) < limit and end < size:
+        line = f.readline()
+        if not line.endswith(b"\n"):
+            break
+        lines.append(_decode(line[:-1]))
+        end += len(line)
+    return {"lines": lines, "start": offset, "end": end, "size": size}
+
+
+def _read_backward(f, size, offset, limit):
+    pos = offset
+    buf = b""
+    # Anything after the last newline before ``offset`` is an incomplete line.
+    while pos > 0:
+        step = min(64 * 1024, pos)
+        pos -= step
+        f.seek(pos)
+        buf = f.read(step) + buf
+        if buf.count(b"\n") > limit or pos == 0:
+            break
+    cut = buf.rfind(b"\n")
+    end = pos + cut + 1 if cut != -1 else pos
+    body = buf[:cut + 1] if cut != -1 else b""
+    lines = body.split(b"\n")[:-1]
+    if pos > 0:
+        # The first element may start in the middle of a line.
+        lines = lines[1:]
+    lines = lines[-limit:] if limit else []
+    start = end - sum(len(line) + 1 for line in lines)
+    return {"lines": [_decode(line) for line in lines], "start": start, "end": end, "size": size}
+
+
+def follow(path, offset=None, poll_interval=1.0, max_seconds=None):
+    """
+    Yield batches of newly appended complete lines, following the file by offset.
+    Starts again at byte 0 when the file is rotated or truncated.
+
+    Args:
+        path (str): Path of the log file
+        offset (int): Byte offset to continue from (default: end of the last
+            complete line)
+        poll_interval (float): Seconds between size checks
+        max_seconds (float): Stop following after this many seconds
+
+    Yields:
+        tuple: (end offset, list of lines); an empty list is a keep-alive
+    """
+    st = os.stat(path)
+    inode = st.st_ino
+    if offset is None or offset > st.st_size:
+        # Begin after the last newline so a half-written line is not cut;
+        # a backwards read from EOF ends exactly there.
+        offset = read_lines(path, None, -1)["end"] if st.st_size else 0
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    pending = b""
+    while deadline is None or time.monotonic() < deadline:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            time.sleep(poll_interval)
+            continue
+        if st.st_ino != inode or st.st_size < offset:
+            inode, offset, pending = st.st_ino, 0, b""
+        if st.st_size > offset:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read(min(CHUNK_SIZE, st.st_size - offset))
+            _notify(path, offset, data)
+            offset += len(data)
+            data = pending + data
+            cut = data.rfind(b"\n")
+            pending = data[cut + 1:]
+            if cut != -1:
+                yield offset - len(pending), [_decode(line) for line in data[:cut].split(b"\n")]
+            continue
+        yield offset - len(pending), []
+        time.sleep(poll_interval)
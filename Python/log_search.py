@@ -0,0 +1,478 @@
+"""
+Full-text search over the logs in BASE_DIR/logs, including rotated .gz files.
+Lines are kept in an SQLite FTS5 index together with their file, byte offset,
+timestamp and severity. A background thread per process does the indexing:
+log_index only tells it which plain log grew, and it reads the appended
+bytes itself in bounded transactions, so neither the summaries nor a search
+wait for it. Compressed archives are indexed once per (size, mtime). The
+index keeps at most MAX_LINES lines (counted per file, so checking the
+bound costs no table scan); the oldest are dropped first, and the rows of
+logs that rotated away are removed.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import datetime
+import fcntl
+import gzip
+import os
+import re
+import sqlite3
+import threading
+
+import log_index
+from backup_catalog import INSTANCE_DIR
+
+INDEX_PATH = os.path.join(INSTANCE_DIR, "log_search.sqlite3")
+SCHEMA_VERSION = 2
+# Longer lines are stored cut off; the byte offset still points at the full line.
+MAX_TEXT_CHARS = 4096
+SEVERITIES = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# Upper bound of indexed lines over all files
+MAX_LINES = int(os.environ.get("INVENTAR_LOG_INDEX_MAX_LINES") or 2_000_000)
+# Bytes of a plain log indexed per transaction
+BATCH_BYTES = log_index.CHUNK_SIZE
+# Lines removed per statement when the index is over MAX_LINES
+PRUNE_BATCH = 50_000
+# How long a search waits for the indexer before answering from what is there
+SEARCH_WAIT_SECONDS = 2.0
+
+_SCHEMA = """
+DROP TABLE IF EXISTS lines_fts;
+DROP TABLE IF EXISTS lines;
+DROP TABLE IF EXISTS files;
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    offset INTEGER NOT NULL DEFAULT 0,
+    signature BLOB NOT NULL DEFAULT x'',
+    last_ts REAL,
+    last_severity TEXT,
+    line_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE lines (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    ts REAL,
+    severity TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX lines_by_file ON lines (file_id, offset);
+CREATE INDEX lines_by_ts ON lines (ts);
+CREATE VIRTUAL TABLE lines_fts USING fts5(text, content='lines', content_rowid='id');
+CREATE TRIGGER lines_ai AFTER INSERT ON lines BEGIN
+    INSERT INTO lines_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER lines_ad AFTER DELETE ON lines BEGIN
+    INSERT INTO lines_fts (lines_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+# gunicorn error log / Python logging: 2025-01-31 12:00:00
+_ISO_TS = re.compile(rb"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})")
+# gunicorn access log: [31/Jan/2025:12:00:00 +0000]
+_CLF_TS = re.compile(rb"\[(\d{2}/[A-Za-z]{3}/\d{4}):(\d{2}:\d{2}:\d{2})")
+_SEVERITY = re.compile(rb"\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b")
+_SEVERITY_ALIASES = {"WARN": "WARNING", "FATAL": "CRITICAL"}
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+_feed_lock = threading.Lock()
+# Paths waiting for the indexer (dict as an ordered set) and whether it is busy
+_queue = threading.Condition()
+_pending = {}
+_active = False
+_thread = None
+_thread_pid = None
+
+
+def _connect():
+    os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+    conn = sqlite3.connect(INDEX_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        # The indexer thread, searches and other workers all connect; one rebuilds
+        with open(INDEX_PATH + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                conn.executescript(_SCHEMA)
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                conn.commit()
+    return conn
+
+
+def _parse_ts(line):
+    m = _ISO_TS.search(line, 0, 64)
+    fmt = "%Y-%m-%d %H:%M:%S"
+    if not m:
+        m = _CLF_TS.search(line, 0, 128)
+        fmt = "%d/%b/%Y %H:%M:%S"
+    if not m:
+        return None
+    try:
+        return datetime.datetime.strptime(f"{m.group(1).decode()} {m.group(2).decode()}", fmt).timestamp()
+    except ValueError:
+        return None
+
+
+def _parse_severity(line):
+    m = _SEVERITY.search(line, 0, 160)
+    if not m:
+        return None
+    sev = m.group(1).decode()
+    return _SEVERITY_ALIASES.get(sev, sev)
+
+
+def _file_row(conn, path):
+    row = conn.execute("SELECT * FROM files WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        conn.execute("INSERT INTO files (path) VALUES (?)", (path,))
+        row = conn.execute("SELECT * FROM files WHERE path = ?", (path,)).fetchone()
+    return row
+
+
+def _reset_file(conn, file_id, inode=None):
+    conn.execute("DELETE FROM lines WHERE file_id = ?", (file_id,))
+    conn.execute(
+        "UPDATE files SET inode = ?, offset = 0, signature = x'', last_ts = NULL, last_severity = NULL, "
+        "line_count = 0 WHERE id = ?", (inode, file_id),
+    )
+
+
+def _index_lines(conn, row, base, buf):
+    """
+    Insert every complete line of ``buf`` (which starts at byte ``base``).
+    Lines without their own timestamp or severity (tracebacks, continuation
+    lines) inherit those of the line before.
+
+    Returns:
+        tuple: Bytes consumed (up to and including the last newline), lines inserted
+    """
+    cut = buf.rfind(b"\n")
+    if cut == -1:
+        return 0, 0
+    ts, severity = row["last_ts"], row["last_severity"]
+    rows = []
+    pos = 0
+    for line in buf[:cut].split(b"\n"):
+        line_ts = _parse_ts(line)
+        if line_ts is not None:
+            ts = line_ts
+            severity = _parse_severity(line)
+        else:
+            severity = _parse_severity(line) or severity
+        text = line.decode("utf-8", errors="replace")[:MAX_TEXT_CHARS]
+        rows.append((row["id"], base + pos, ts, severity, text))
+        pos += len(line) + 1
+    conn.executemany("INSERT INTO lines (file_id, offset, ts, severity, text) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.execute("UPDATE files SET last_ts = ?, last_severity = ?, line_count = line_count + ? WHERE id = ?",
+                 (ts, severity, len(rows), row["id"]))
+    return cut + 1, len(rows)
+
+
+def _signature(f, offset):
+    start = max(0, offset - log_index.SIGNATURE_SIZE)
+    f.seek(start)
+    return f.read(offset - start)
+
+
+def index_file(path):
+    """
+    Index the bytes appended to a plain log since the last call.
+    Reads from the stored cursor in BATCH_BYTES steps, one transaction each,
+    and re-indexes a rotated or truncated file from the start. Only whole
+    lines are indexed; a trailing partial line waits for its newline.
+
+    Args:
+        path (str): Path of the log file
+
+    Returns:
+        int: Number of lines added to the index
+    """
+    total = 0
+    while True:
+        with _feed_lock:
+            conn = _connect()
+            try:
+                # IMMEDIATE: another worker indexing the same file waits here
+                # instead of inserting the same lines again
+                conn.execute("BEGIN IMMEDIATE")
+                with conn, open(path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    row = _file_row(conn, path)
+                    if (row["inode"] != st.st_ino or st.st_size < row["offset"]
+                            or _signature(f, row["offset"]) != row["signature"]):
+                        _reset_file(conn, row["id"], st.st_ino)
+                        row = _file_row(conn, path)
+                    cursor = row["offset"]
+                    f.seek(cursor)
+                    data = f.read(BATCH_BYTES)
+                    if data and not data.endswith(b"\n"):
+                        # Finish the last line, however long it is
+                        data += f.readline()
+                    consumed, added = _index_lines(conn, row, cursor, data)
+                    total += added
+                    if consumed:
+                        conn.execute(
+                            "UPDATE files SET offset = ?, signature = ?, size = ?, mtime_ns = ? WHERE id = ?",
+                            (cursor + consumed, _signature(f, cursor + consumed), st.st_size,
+                             st.st_mtime_ns, row["id"]),
+                        )
+            finally:
+                conn.close()
+        if not consumed or cursor + consumed >= st.st_size:
+            return total
+
+
+def _forget(path):
+    # A log that rotated away: its lines go with it
+    with _feed_lock:
+        conn = _connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+                if row is not None:
+                    conn.execute("DELETE FROM lines WHERE file_id = ?", (row["id"],))
+                    conn.execute("DELETE FROM files WHERE id = ?", (row["id"],))
+        finally:
+            conn.close()
+
+
+def _prune():
+    # Drop the oldest lines above MAX_LINES; the per-file counts spare a count(*)
+    with _feed_lock:
+        conn = _connect()
+        try:
+            excess = (conn.execute("SELECT sum(line_count) FROM files").fetchone()[0] or 0) - MAX_LINES
+            while excess > 0:
+                oldest = conn.execute("SELECT id, file_id FROM lines ORDER BY ts, id LIMIT ?",
+                                      (min(excess, PRUNE_BATCH),)).fetchall()
+                if not oldest:
+                    break
+                removed = {}
+                for row in oldest:
+                    removed[row["file_id"]] = removed.get(row["file_id"], 0) + 1
+                with conn:
+                    conn.executemany("DELETE FROM lines WHERE id = ?", [(row["id"],) for row in oldest])
+                    conn.executemany("UPDATE files SET line_count = max(0, line_count - ?) WHERE id = ?",
+                                     [(count, file_id) for file_id, count in removed.items()])
+                excess -= len(oldest)
+        finally:
+            conn.close()
+
+
+def _run():
+    global _active
+    while True:
+        with _queue:
+            while not _pending:
+                _queue.wait()
+            path = next(iter(_pending))
+            del _pending[path]
+            _active = True
+        try:
+            added = 0
+            try:
+                if path.endswith(".gz"):
+                    added = index_compressed(path)
+                else:
+                    added = index_file(path)
+            except FileNotFoundError:
+                _forget(path)
+            except (sqlite3.Error, OSError):
+                # Unreadable for now; tried again on the next change
+                pass
+            if added:
+                _prune()
+        except sqlite3.Error:
+            pass
+        finally:
+            with _queue:
+                _active = False
+                _queue.notify_all()
+
+
+def schedule(path):
+    """
+    Queue a log for the indexer thread and return at once.
+
+    Args:
+        path (str): Plain or compressed log file
+    """
+    global _thread, _thread_pid
+    with _queue:
+        _pending[path] = None
+        if _thread is None or _thread_pid != os.getpid() or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="log-search-indexer", daemon=True)
+            _thread_pid = os.getpid()
+            _thread.start()
+        _queue.notify_all()
+
+
+def wait_idle(timeout):
+    """
+    Wait until the indexer has nothing left to do.
+
+    Args:
+        timeout (float): Seconds to wait at most
+
+    Returns:
+        bool: True if the index is up to date, False if it is still catching up
+    """
+    with _queue:
+        return _queue.wait_for(lambda: not _pending and not _active, timeout)
+
+
+def _on_read(path, offset, data):
+    # Called by log_index while it holds its lock: only note the file
+    schedule(path)
+
+
+log_index.add_listener(_on_read)
+
+
+def index_compressed(path):
+    """
+    Index a rotated .gz log once; it is read again only if size or mtime change.
+    Offsets refer to the uncompressed stream.
+
+    Args:
+        path (str): Path of the compressed log
+
+    Returns:
+        int: Number of lines added to the index
+    """
+    st = os.stat(path)
+    total = 0
+    with _feed_lock:
+        conn = _connect()
+        try:
+            with conn:
+                row = _file_row(conn, path)
+                if row["size"] == st.st_size and row["mtime_ns"] == st.st_mtime_ns:
+                    return 0
+                _reset_file(conn, row["id"], st.st_ino)
+                row = _file_row(conn, path)
+                base = 0
+                pending = b""
+                try:
+                    with gzip.open(path, "rb") as f:
+                        while True:
+                            chunk = f.read(log_index.CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            buf = pending + chunk
+                            consumed, added = _index_lines(conn, row, base, buf)
+                            total += added
+                            row = _file_row(conn, path)
+                            base += consumed
+                            pending = buf[consumed:]
+                    if pending:
+                        total += _index_lines(conn, row, base, pending + b"\n")[1]
+                except (OSError, EOFError):
+                    # Corrupt or still being written; keep what was readable.
+                    pass
+                conn.execute(
+                    "UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?",
+                    (st.st_size, st.st_mtime_ns, row["id"]),
+                )
+        finally:
+            conn.close()
+    return total
+
+
+def update(logs_dir):
+    """
+    Queue every file in the log directory for the indexer, and the indexed
+    files that are no longer there, whose rows it then drops.
+    The indexer only reads what was appended or changed.
+
+    Args:
+        logs_dir (str): Directory holding the logs
+    """
+    present = set()
+    for name in os.listdir(logs_dir):
+        path = os.path.join(logs_dir, name)
+        if os.path.isfile(path):
+            present.add(path)
+            schedule(path)
+    conn = _connect()
+    try:
+        indexed = [row["path"] for row in conn.execute("SELECT path FROM files")]
+    finally:
+        conn.close()
+    for path in indexed:
+        if path not in present and os.path.dirname(path) == logs_dir:
+            schedule(path)
+
+
+def search(query="", since=None, until=None, severities=None, file=None, limit=100):
+    """
+    Search the indexed log lines, newest first.
+
+    Args:
+        query (str): Words that must all occur in the line (empty: no text filter)
+        since (float): Only lines at or after this Unix timestamp
+        until (float): Only lines before this Unix timestamp
+        severities (list): Only lines with one of these severities
+        file (str): Only lines from files whose name starts with this
+        limit (int): Maximum number of results
+
+    Returns:
+        list: Dicts with file, offset, ts, severity and line
+    """
+    sql = ("SELECT f.path, l.offset, l.ts, l.severity, l.text FROM lines l "
+           "JOIN files f ON f.id = l.file_id")
+    where, params = [], []
+    tokens = _TOKEN.findall(query or "")
+    if tokens:
+        sql += " JOIN lines_fts ON lines_fts.rowid = l.id"
+        # Quote every word so user input can never be parsed as FTS5 syntax.
+        where.append("lines_fts MATCH ?")
+        params.append(" ".join(f'"{t}"' for t in tokens))
+    if since is not None:
+        where.append("l.ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("l.ts < ?")
+        params.append(until)
+    if severities:
+        where.append(f"l.severity IN ({', '.join('?' for _ in severities)})")
+        params.extend(severities)
+    if file:
+        where.append("f.path LIKE ? ESCAPE '\\'")
+        params.append("%/" + re.sub(r"([%_\\])", r"\\\1", file) + "%")
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY l.ts DESC, l.id DESC LIMIT ?"
+    params.append(limit)
+    conn = _connect()
+    try:
+        return [
+            {
+                "file": os.path.basename(r["path"]),
+                "offset": r["offset"],
+                "ts": r["ts"],
+                "severity": r["severity"],
+                "line": r["text"],
+            }
+            for r in conn.execute(sql, params)
+        ]
+    finally:
+        conn.close()
@@ -0,0 +1,232 @@
+"""
+Notifications for the admin interface (finished jobs, backups, log alerts).
+Messages are stored in SQLite with increasing ids, so a client that passes the
+last id it has seen gets exactly what it missed, also after a reconnect.
+Waiting clients sleep on a condition instead of polling the server.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import jobs
+import log_index
+import shared_state
+from backup_catalog import INSTANCE_DIR
+
+MESSAGES_DB_PATH = os.path.join(INSTANCE_DIR, "messages.sqlite3")
+SCHEMA_VERSION = 1
+# Messages kept before the oldest are dropped
+KEEP_MESSAGES = 500
+# Other worker processes cannot wake our waiters, so they re-check this often
+CROSS_PROCESS_POLL = 1.0
+# At most one log alert per file in this many seconds
+ALERT_COOLDOWN = 30.0
+LEVELS = ("info", "success", "warning", "error")
+
+_SCHEMA = """
+DROP TABLE IF EXISTS messages;
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    level TEXT NOT NULL,
+    text TEXT NOT NULL,
+    data TEXT
+);
+"""
+
+_ALERT_LINE = re.compile(rb"^.*\b(ERROR|CRITICAL|FATAL|Traceback)\b.*$", re.M)
+
+_new_message = threading.Condition()
+
+JOB_TEXTS = {
+    "backup": "Backup",
+    "restore": "Wiederherstellung",
+    "start": "Start",
+    "stop": "Stop",
+    "restart": "Neustart",
+    "fix": "Reparatur",
+    "update": "Update",
+    "pin": "Versionswechsel",
+    "prune": "Aufräumen der Backups",
+    "verify": "Backup-Prüfung",
+}
+
+
+def _connect():
+    os.makedirs(os.path.dirname(MESSAGES_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(MESSAGES_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript(_SCHEMA)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+    return conn
+
+
+def _to_dict(row):
+    message = dict(row)
+    message["data"] = json.loads(message["data"]) if message["data"] else None
+    return message
+
+
+def publish(kind, text, level="info", data=None):
+    """
+    Add a message and wake every waiting client.
+
+    Args:
+        kind (str): Source, e.g. ``job``, ``backup`` or ``log``
+        text (str): Text shown to the user
+        level (str): One of LEVELS
+        data (dict): Extra details (job id, file, ...)
+
+    Returns:
+        int: Id of the new message
+    """
+    conn = _connect()
+    try:
+        with conn:
+            cur = conn.execute(
+                "INSERT INTO messages (ts, kind, level, text, data) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), kind, level if level in LEVELS else "info", text,
+                 json.dumps(data) if data is not None else None),
+            )
+            message_id = cur.lastrowid
+            conn.execute("DELETE FROM messages WHERE id <= ?", (message_id - KEEP_MESSAGES,))
+    finally:
+        conn.close()
+    with _new_message:
+        _new_message.notify_all()
+    return message_id
+
+
+def since(after=0, limit=100):
+    """
+    Return the messages newer than ``after``, oldest first.
+
+    Args:
+        after (int): Last message id the client has (0: only the newest ``limit``)
+        limit (int): Maximum number of messages
+
+    Returns:
+        list: Message dicts with id, ts, kind, level, text and data
+    """
+    conn = _connect()
+    try:
+        if after:
+            rows = conn.execute("SELECT * FROM messages WHERE id > ? ORDER BY id LIMIT ?", (after, limit)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM messages ORDER BY id DESC LIMIT ?", (limit,)).fetchall()[::-1]
+        return [_to_dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def latest_id():
+    """Id of the newest message, 0 if there is none."""
+    conn = _connect()
+    try:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def wait(after, timeout, limit=100, on_idle=None):
+    """
+    Block until messages newer than ``after`` exist or ``timeout`` passes.
+
+    Args:
+        after (int): Last message id the client has
+        timeout (float): Seconds to wait at most
+        limit (int): Maximum number of messages returned
+        on_idle (callable): Called between checks, e.g. to pick up new log lines
+
+    Returns:
+        list: The new messages (empty on timeout)
+    """
+    deadline = time.monotonic() + timeout
+    if not after:
+        # A fresh client only wants what happens from now on
+        after = latest_id()
+    while True:
+        messages = since(after, limit)
+        remaining = deadline - time.monotonic()
+        if messages or remaining <= 0:
+            return messages
+        with _new_message:
+            _new_message.wait(min(remaining, CROSS_PROCESS_POLL))
+        if on_idle:
+            on_idle()
+
+
+def _job_finished(job):
+    name = JOB_TEXTS.get(job["kind"], job["kind"])
+    if job["state"] == "succeeded":
+        publish("job", f"{name} abgeschlossen.", "success", {"job": job["id"], "kind": job["kind"]})
+    else:
+        detail = job["error"] or f"Exit-Code {job['exit_code']}"
+        publish("job", f"{name} fehlgeschlagen ({detail}).", "error", {"job": job["id"], "kind": job["kind"]})
+
+
+def _scan_log(path, offset, data):
+    """
+    Turn error lines appended to a log into an alert.
+    Bytes that were in the file before we first saw it are history and never
+    alert; bytes handed in twice (summary and live tail) are checked once.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+
+    def check(state):
+        # {"inode", "offset" already checked, "last_alert"}, shared by all workers
+        # so every worker tailing the same log does not alert again
+        if state is None or state["inode"] != st.st_ino:
+            known = st.st_size if state is None else 0
+            state = {"inode": st.st_ino, "offset": known, "last_alert": 0.0}
+        end = offset + len(data)
+        if end <= state["offset"]:
+            return state, None
+        block = data[max(0, state["offset"] - offset):]
+        # Only complete lines; the rest is checked with the next block
+        cut = block.rfind(b"\n")
+        if cut == -1:
+            return state, None
+        block = block[:cut + 1]
+        state["offset"] = max(state["offset"], offset) + len(block)
+        hits = _ALERT_LINE.findall(block)
+        if not hits or time.time() - state["last_alert"] < ALERT_COOLDOWN:
+            return state, None
+        state["last_alert"] = time.time()
+        return state, (len(hits), _ALERT_LINE.search(block).group(0).decode("utf-8", errors="replace")[:300])
+
+    alert = shared_state.state.update("log_alerts", path, check)
+    if alert is None:
+        return
+    count, first = alert
+    name = os.path.basename(path)
+    publish("log", f"{name}: {first}", "warning", {"file": name, "count": count})
+
+
+jobs.add_listener(_job_finished)
+log_index.add_listener(_scan_log)
@@ -0,0 +1,595 @@
+"""
+In-process metrics in the Prometheus text format.
+Histograms keep one fixed array of bucket counts per label set, so recording
+a value is a bisect and a few additions under a lock; nothing is allocated on
+the hot path once a label set has been seen. The module only depends on the
+standard library, so every other module can record into it.
+
+An optional sampling profiler looks at the stacks of requests that have been
+running longer than a threshold and counts them in the collapsed-stack format
+understood by flamegraph tools.
+
+With several worker processes, :func:`share` makes every process write its
+values (and profiler stacks) to a directory every SHARE_INTERVAL seconds;
+:func:`render` and the profiler report the sum over all of them, including
+processes that have exited since, so counters never go backwards.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import bisect
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Seconds; covers fast JSON endpoints up to long-running scripts
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Profiler settings (overridable at runtime through :data:`profiler`)
+PROFILE_INTERVAL = 0.01
+PROFILE_SLOW_SECONDS = float(os.environ.get("INVENTAR_PROFILE_SLOW_MS") or 500) / 1000.0
+# Distinct stacks kept by the profiler before new ones are dropped
+PROFILE_MAX_STACKS = 5000
+# Seconds between two writes of a process's values into the shared directory
+SHARE_INTERVAL = 5.0
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic counter per label set."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+    @staticmethod
+    def merge(values, snapshot):
+        for key, value in snapshot:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        """Text lines for this metric; ``values`` (key -> value) replaces the own ones."""
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        items = sorted(values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_format(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """
+    Histogram with fixed buckets per label set.
+
+    Args:
+        name (str): Metric name
+        documentation (str): HELP text
+        labelnames (tuple): Label names
+        buckets (tuple): Upper bounds in ascending order (+Inf is added)
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # counts per bucket (last one is +Inf), sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), [list(v[0]), v[1]]] for k, v in self._values.items()]
+
+    @staticmethod
+    def merge(values, snapshot):
+        for key, (counts, total) in snapshot:
+            key = tuple(key)
+            entry = values.get(key)
+            if entry is None:
+                values[key] = [list(counts), total]
+            elif len(entry[0]) == len(counts):
+                # Other bucket bounds (an older version of this module) cannot be added up
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+
+    def render(self, values=None):
+        """Text lines for this metric; ``values`` (key -> [counts, sum]) replaces the own ones."""
+        if values is None:
+            with self._lock:
+                values = {k: [list(v[0]), v[1]] for k, v in self._values.items()}
+        items = sorted((k, (v[0], v[1])) for k, v in values.items())
+        lines = self.header()
+        bounds = self.buckets + (float("inf"),)
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = f'le="{_format(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def render():
+    """
+    Return all registered metrics in the Prometheus text exposition format.
+    After :func:`share`, the values are the sum over all worker processes.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    shared = _collect()
+    lines = []
+    for metric in metrics:
+        if shared is None:
+            lines.extend(metric.render())
+        else:
+            values = {}
+            for payload in shared:
+                metric.merge(values, payload.get("metrics", {}).get(metric.name, []))
+            lines.extend(metric.render(values))
+    return "\n".join(lines) + "\n"
+
+
+"""------------------------------Sharing-------------------------------------"""
+
+_share_dir = None
+_share_pid = None
+_share_id = None
+_share_lock_file = None
+_share_mutex = threading.Lock()
+
+
+def share(directory):
+    """
+    Aggregate the metrics and the profiler over all worker processes.
+    Each process holds an flock on ``<directory>/<id>.lock`` while it lives
+    and writes its values to ``<id>.json``; the values of processes whose
+    lock is free again are added to ``retired.json``.
+
+    Args:
+        directory (str): Directory shared by the workers (created if missing)
+    """
+    global _share_dir
+    _share_dir = directory
+    _ensure_sharing()
+
+
+def _path(name):
+    return os.path.join(_share_dir, name)
+
+
+class _DirLock:
+    # flock on merge.lock: shared to add or read files, exclusive to retire them
+    def __init__(self, mode):
+        self.mode = mode
+
+    def __enter__(self):
+        self.file = open(_path("merge.lock"), "a")
+        fcntl.flock(self.file, self.mode)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        return False
+
+
+def _ensure_sharing():
+    global _share_pid, _share_id, _share_lock_file
+    if _share_dir is None or _share_pid == os.getpid():
+        return
+    with _share_mutex:
+        if _share_pid == os.getpid():
+            return
+        if _share_pid is not None:
+            # Forked from a process that already shares: its values are in its own file
+            if _share_lock_file is not None:
+                _share_lock_file.close()
+            with _registry_lock:
+                for metric in _registry:
+                    metric._values.clear()
+            profiler._clear()
+        os.makedirs(_share_dir, exist_ok=True)
+        share_id = f"{os.getpid()}-{os.urandom(4).hex()}"
+        with _DirLock(fcntl.LOCK_SH):
+            lock_file = open(_path(f"{share_id}.lock"), "a")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        _share_id, _share_lock_file, _share_pid = share_id, lock_file, os.getpid()
+    profiler._apply_control()
+    threading.Thread(target=_share_loop, name="metrics-share", daemon=True).start()
+
+
+def _share_loop():
+    pid = os.getpid()
+    while _share_pid == pid:
+        time.sleep(SHARE_INTERVAL)
+        try:
+            profiler._apply_control()
+            _publish()
+        except (OSError, ValueError):
+            pass
+
+
+def _read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, payload):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(payload, fh)
+    os.replace(tmp, path)
+
+
+def _publish():
+    with _registry_lock:
+        metrics = list(_registry)
+    _write_json(_path(f"{_share_id}.json"), {
+        "pid": os.getpid(),
+        "metrics": {m.name: m.snapshot() for m in metrics},
+        "profile": profiler._snapshot(),
+    })
+
+
+def _merge_payload(target, payload):
+    with _registry_lock:
+        kinds = {m.name: type(m) for m in _registry}
+    merged = {}
+    for name, snapshot in payload.get("metrics", {}).items():
+        kind = kinds.get(name)
+        if kind is None:
+            continue
+        values = {}
+        kind.merge(values, target.get("metrics", {}).get(name, []))
+        kind.merge(values, snapshot)
+        merged[name] = [[list(k), v] for k, v in values.items()]
+    target["metrics"] = dict(target.get("metrics", {}), **merged)
+    mine, theirs = target.get("profile"), payload.get("profile")
+    if theirs and (not mine or theirs["generation"] > mine["generation"]):
+        target["profile"] = theirs
+    elif theirs and theirs["generation"] == mine["generation"]:
+        stacks = mine["stacks"]
+        for stack, count in theirs["stacks"].items():
+            stacks[stack] = stacks.get(stack, 0) + count
+        mine["samples"] += theirs["samples"]
+
+
+def _retire_dead():
+    own = f"{_share_id}.lock"
+    with _DirLock(fcntl.LOCK_EX):
+        retired = None
+        for name in os.listdir(_share_dir):
+            if name == own or not (name.endswith(".lock") and name != "merge.lock"):
+                continue
+            lock_file = open(_path(name), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            # Nobody holds it any more: the process has exited
+            with lock_file:
+                data = _path(name[:-5] + ".json")
+                payload = _read_json(data)
+                if payload is not None:
+                    if retired is None:
+                        retired = _read_json(_path("retired.json")) or {}
+                    _merge_payload(retired, payload)
+                    _write_json(_path("retired.json"), retired)
+                for path in (data, _path(name)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+
+def _collect():
+    # Payloads of all processes (own one freshly written), or None without sharing
+    if _share_dir is None:
+        return None
+    _ensure_sharing()
+    _publish()
+    _retire_dead()
+    with _DirLock(fcntl.LOCK_SH):
+        payloads = []
+        for name in os.listdir(_share_dir):
+            if name.endswith(".json") and name != "profile.json":
+                payload = _read_json(_path(name))
+                if payload is not None:
+                    payloads.append(payload)
+        return payloads
+
+
+REQUEST_SECONDS = Histogram("admin_http_request_duration_seconds",
+                            "Time until the response is handed to the server, per route.", ("route", "method"))
+REQUESTS = Counter("admin_http_requests_total", "Finished requests per route and status.", ("route", "method", "status"))
+SUBPROCESS_SECONDS = Histogram("admin_subprocess_duration_seconds", "Run time of subprocesses.", ("command",))
+SUBPROCESS_EXITS = Counter("admin_subprocess_exits_total",
+                           "Finished subprocesses per exit code (-1: could not be started or timed out).",
+                           ("command", "code"))
+JOB_SECONDS = Histogram("admin_job_duration_seconds", "Run time of background jobs.", ("kind",))
+JOBS = Counter("admin_jobs_total", "Finished background jobs per final state.", ("kind", "state"))
+MONGO_SECONDS = Histogram("admin_mongo_command_duration_seconds", "Duration of MongoDB commands.", ("command",))
+MONGO_FAILURES = Counter("admin_mongo_command_failures_total", "Failed MongoDB commands.", ("command",))
+
+
+def command_label(argv):
+    """
+    Short, low-cardinality name for a command line, e.g. ``git`` or ``sudo bash``.
+
+    Args:
+        argv (list): Command as passed to subprocess
+    """
+    if isinstance(argv, str):
+        argv = argv.split()
+    words = [os.path.basename(a) for a in argv if not a.startswith("-")]
+    if not words:
+        return "unknown"
+    if words[0] == "sudo" and len(words) > 1:
+        return f"sudo {words[1]}"
+    return words[0]
+
+
+def run(argv, **kwargs):
+    """
+    ``subprocess.run`` that records its duration and exit code.
+    Takes and returns the same as :func:`subprocess.run`.
+    """
+    label = command_label(argv)
+    started = time.perf_counter()
+    code = -1
+    try:
+        result = subprocess.run(argv, **kwargs)
+        code = result.returncode
+        return result
+    except subprocess.CalledProcessError as e:
+        code = e.returncode
+        raise
+    finally:
+        SUBPROCESS_SECONDS.observe(time.perf_counter() - started, command=label)
+        SUBPROCESS_EXITS.inc(command=label, code=code)
+
+
+def observe_job(job):
+    """Jobs listener: record the run time and final state of a finished job."""
+    if job.get("started_at") and job.get("finished_at"):
+        JOB_SECONDS.observe(max(0.0, job["finished_at"] - job["started_at"]), kind=job["kind"])
+    JOBS.inc(kind=job["kind"], state=job["state"])
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of slow requests while enabled.
+    Request handlers call :meth:`enter` and :meth:`leave`; a background thread
+    wakes every ``interval`` seconds and, for each request older than
+    ``slow_seconds``, counts its current stack. After :func:`share`, start,
+    stop and reset reach every worker within SHARE_INTERVAL through
+    ``profile.json``, and the stacks of all workers are added up.
+
+    Args:
+        interval (float): Seconds between samples
+        slow_seconds (float): Only requests running longer are sampled
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, slow_seconds=PROFILE_SLOW_SECONDS):
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.enabled = False
+        self._active = {}
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.samples = 0
+        # Bumped by every reset; stacks of older generations are not added up
+        self.generation = 0
+
+    def enter(self, route):
+        if self.enabled:
+            self._active[threading.get_ident()] = (route, time.monotonic())
+
+    def leave(self):
+        self._active.pop(threading.get_ident(), None)
+
+    def start(self, slow_seconds=None):
+        """Enable sampling (optionally with a new threshold)."""
+        self._start(slow_seconds)
+        self._write_control()
+
+    def stop(self):
+        """Disable sampling; collected stacks are kept until :meth:`reset`."""
+        self._stop()
+        self._write_control()
+
+    def reset(self):
+        """Drop the collected stacks (of every worker after :func:`share`)."""
+        self._clear()
+        if _share_dir is not None:
+            control = _read_json(_path("profile.json")) or {}
+            self.generation = max(self.generation, control.get("generation", 0)) + 1
+            self._write_control()
+
+    def _start(self, slow_seconds=None):
+        if slow_seconds is not None:
+            self.slow_seconds = slow_seconds
+        with self._lock:
+            self.enabled = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="sampling-profiler", daemon=True)
+                self._thread.start()
+
+    def _stop(self):
+        self.enabled = False
+        self._active.clear()
+
+    def _clear(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _write_control(self):
+        if _share_dir is not None:
+            _write_json(_path("profile.json"), {"enabled": self.enabled, "slow_seconds": self.slow_seconds,
+                                                "generation": self.generation})
+
+    def _apply_control(self):
+        # Follow start/stop/reset done through another worker
+        control = _read_json(_path("profile.json"))
+        if not control:
+            return
+        if control["generation"] != self.generation:
+            self._clear()
+            self.generation = control["generation"]
+        if control["enabled"]:
+            if not self.enabled or control["slow_seconds"] != self.slow_seconds:
+                self._start(control["slow_seconds"])
+        elif self.enabled:
+            self._stop()
+
+    def _snapshot(self):
+        with self._lock:
+            return {"generation": self.generation, "samples": self.samples, "stacks": dict(self._stacks)}
+
+    def _shared_stacks(self):
+        # (samples, stacks) of this process, or summed over all workers after share()
+        shared = _collect()
+        if shared is None:
+            with self._lock:
+                return self.samples, dict(self._stacks)
+        samples, stacks = 0, {}
+        for payload in shared:
+            profile = payload.get("profile")
+            if not profile or profile["generation"] != self.generation:
+                continue
+            samples += profile["samples"]
+            for stack, count in profile["stacks"].items():
+                stacks[stack] = stacks.get(stack, 0) + count
+        return samples, stacks
+
+    def _loop(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            slow = {tid: route for tid, (route, since) in list(self._active.items())
+                    if now - since >= self.slow_seconds}
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for tid, route in slow.items():
+                    frame = frames.get(tid)
+                    if frame is None:
+                        continue
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    stack = ";".join([route] + names[::-1])
+                    if stack in self._stacks or len(self._stacks) < PROFILE_MAX_STACKS:
+                        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                    self.samples += 1
+
+    def collapsed(self):
+        """Sampled stacks as ``route;frame;frame count`` lines, most frequent first."""
+        _samples, stacks = self._shared_stacks()
+        items = sorted(stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def status(self):
+        samples, stacks = self._shared_stacks()
+        return {"enabled": self.enabled, "slow_ms": int(self.slow_seconds * 1000),
+                "interval_ms": int(self.interval * 1000), "samples": samples, "stacks": len(stacks)}
+
+
+profiler = SamplingProfiler()
+if os.environ.get("INVENTAR_PROFILE_SLOW_MS"):
+    profiler.start()
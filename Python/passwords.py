@@ -0,0 +1,335 @@
+"""
+Password hashing for the users of the Inventarsystem.
+New hashes stay unsalted SHA-512, the only format the main app can verify
+so far; WRITABLE_SCHEMES keeps ``INVENTAR_PASSWORD_SCHEME=scrypt`` (hashlib)
+and ``argon2`` (argon2-cffi) switched off until it can. Both salted KDFs are
+stored self-describing, e.g.
+
+    $scrypt$ln=15,r=8,p=1$<salt>$<hash>
+
+so the parameters can grow over time and old records stay verifiable. Plain
+128-digit hex strings are the old unsalted SHA-512 hashes; they still verify
+and are reported for an upgrade. The cost parameters are calibrated once per
+host to take about TARGET_MS (scrypt's memory is capped at SCRYPT_MAX_MEMORY,
+the rest of the cost goes into p), and the hashing itself runs in a small
+process pool with a bounded queue, so request threads only wait for their own
+hash.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import platform
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import argon2
+except ImportError:  # optional; scrypt from hashlib is always there
+    argon2 = None
+
+from backup_catalog import INSTANCE_DIR
+
+SCHEMES = ("sha512", "scrypt", "argon2")
+# Formats new hashes may use: only what the main app's login can verify. Neither
+# login here checks a password (the admin login is TOTP-only), so no hash is ever
+# upgraded on login yet; scrypt and argon2 join once the main app calls
+# user.verify_user_password.
+WRITABLE_SCHEMES = ("sha512",)
+SCHEME = os.environ.get("INVENTAR_PASSWORD_SCHEME") or "sha512"
+if SCHEME not in SCHEMES:
+    raise RuntimeError(f"INVENTAR_PASSWORD_SCHEME muss einer von {', '.join(SCHEMES)} sein, nicht {SCHEME!r}")
+if SCHEME not in WRITABLE_SCHEMES:
+    raise RuntimeError(f"INVENTAR_PASSWORD_SCHEME={SCHEME} wird noch nicht unterstützt: die Hauptanwendung "
+                       "kann nur SHA-512-Hashes prüfen, Benutzer könnten sich nicht mehr anmelden")
+if SCHEME == "argon2" and argon2 is None:
+    raise RuntimeError("INVENTAR_PASSWORD_SCHEME=argon2 braucht das Paket argon2-cffi")
+# Time one hash should take on this host
+TARGET_MS = int(os.environ.get("INVENTAR_HASH_TARGET_MS") or 250)
+# Lower bounds that calibration never goes below (OWASP minimum for scrypt: N=2^17 at r=8 is
+# recommended, 2^14 is the floor for slow hosts)
+SCRYPT_MIN_LN = 14
+# Memory per hash; beyond it calibration raises p (more time, no more memory)
+SCRYPT_MAX_MEMORY = 64 * 1024 * 1024
+SCRYPT_R = 8
+SALT_BYTES = 16
+HASH_BYTES = 32
+ARGON2_MEMORY_KIB = 64 * 1024
+# Processes hashing in parallel across the whole deployment, split over the
+# gunicorn workers (WEB_CONCURRENCY, set by start.sh), so at most
+# POOL_TOTAL * SCRYPT_MAX_MEMORY is in use however many workers run
+POOL_TOTAL = max(1, min(4, (os.cpu_count() or 2) // 2))
+try:
+    _WEB_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY") or 1))
+except ValueError:
+    _WEB_WORKERS = 1
+POOL_WORKERS = max(1, POOL_TOTAL // _WEB_WORKERS)
+# Hashes allowed to wait for the pool
+MAX_PENDING = POOL_WORKERS * 4
+PARAMS_PATH = os.path.join(INSTANCE_DIR, "password_params.json")
+
+_LEGACY = re.compile(r"^[0-9a-f]{128}$")
+_SCRYPT = re.compile(r"^\$scrypt\$ln=(\d+),r=(\d+),p=(\d+)\$([A-Za-z0-9+/]+)\$([A-Za-z0-9+/]+)$")
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+_params = None
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _unb64(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password, salt, ln, r, p):
+    n = 1 << ln
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=HASH_BYTES)
+
+
+def _scrypt_encode(password, ln, r, p):
+    salt = os.urandom(SALT_BYTES)
+    return f"$scrypt$ln={ln},r={r},p={p}${_b64(salt)}${_b64(_scrypt(password, salt, ln, r, p))}"
+
+
+def _argon2_hasher(params):
+    return argon2.PasswordHasher(time_cost=params["t"], memory_cost=params["m"], parallelism=1)
+
+
+def _hash_job(password, scheme, params):
+    # Runs in a pool process
+    if scheme == "argon2":
+        return _argon2_hasher(params).hash(password)
+    if scheme == "sha512":
+        return hashlib.sha512(password.encode()).hexdigest()
+    return _scrypt_encode(password, params["ln"], params["r"], params["p"])
+
+
+def _verify_job(password, stored):
+    # Runs in a pool process
+    match = _SCRYPT.match(stored)
+    if match:
+        ln, r, p = (int(v) for v in match.group(1, 2, 3))
+        expected = _unb64(match.group(5))
+        return hmac.compare_digest(_scrypt(password, _unb64(match.group(4)), ln, r, p), expected)
+    if stored.startswith("$argon2") and argon2 is not None:
+        try:
+            return argon2.PasswordHasher().verify(stored, password)
+        except argon2.exceptions.VerificationError:
+            return False
+        except argon2.exceptions.InvalidHashError:
+            return False
+    return False
+
+
+def identify(stored):
+    """
+    Name the scheme of a stored hash.
+
+    Returns:
+        str: ``scrypt``, ``argon2``, ``sha512`` (old records) or None if unknown
+    """
+    if not isinstance(stored, str):
+        return None
+    if _SCRYPT.match(stored):
+        return "scrypt"
+    if stored.startswith("$argon2"):
+        return "argon2"
+    if _LEGACY.match(stored):
+        return "sha512"
+    return None
+
+
+def _host_key():
+    return f"{platform.node()}/{platform.machine()}/{os.cpu_count()}/{SCHEME}/{TARGET_MS}"
+
+
+def calibrate(target_ms=TARGET_MS, scheme=SCHEME):
+    """
+    Find cost parameters that take about ``target_ms`` per hash on this host.
+    scrypt doubles N (memory and time) up to SCRYPT_MAX_MEMORY, then raises p;
+    argon2 raises the number of passes at a fixed memory cost.
+
+    Returns:
+        dict: Parameters for :func:`hash_password` (``ln``/``r``/``p`` or ``t``/``m``)
+    """
+    target = target_ms / 1000.0
+    if scheme == "argon2":
+        params = {"t": 1, "m": ARGON2_MEMORY_KIB}
+        while True:
+            started = time.perf_counter()
+            _argon2_hasher(params).hash("calibration")
+            elapsed = time.perf_counter() - started
+            if elapsed >= target or params["t"] >= 20:
+                return params
+            params["t"] = max(params["t"] + 1, int(params["t"] * target / max(elapsed, 1e-3)))
+    if scheme == "sha512":
+        return {}
+    ln, p = SCRYPT_MIN_LN, 1
+    while True:
+        started = time.perf_counter()
+        _scrypt("calibration", b"\0" * SALT_BYTES, ln, SCRYPT_R, p)
+        elapsed = time.perf_counter() - started
+        if elapsed * 1.5 > target:
+            # The next step would overshoot by more than the remaining gap
+            return {"ln": ln, "r": SCRYPT_R, "p": p}
+        if 128 * SCRYPT_R * (1 << (ln + 1)) <= SCRYPT_MAX_MEMORY:
+            ln += 1
+        else:
+            p = max(p + 1, int(p * target / max(elapsed, 1e-3)))
+            return {"ln": ln, "r": SCRYPT_R, "p": p}
+
+
+def params():
+    """
+    Cost parameters for new hashes: calibrated once per host and cached in
+    the instance directory, so later starts (and every worker) reuse them.
+    """
+    global _params
+    if _params is not None:
+        return _params
+    with _lock:
+        if _params is not None:
+            return _params
+        try:
+            with open(PARAMS_PATH, "r", encoding="utf-8") as fh:
+                cached = json.load(fh)
+            if cached.get("host") == _host_key():
+                _params = cached["params"]
+                return _params
+        except (OSError, ValueError, AttributeError):
+            pass
+        found = calibrate()
+        try:
+            os.makedirs(INSTANCE_DIR, exist_ok=True)
+            tmp = f"{PARAMS_PATH}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump({"host": _host_key(), "params": found, "calibrated_at": time.time()}, fh)
+            os.replace(tmp, PARAMS_PATH)
+        except OSError:
+            pass
+        _params = found
+        return _params
+
+
+def calibrate_in_background():
+    """Start the calibration at startup so the first login or new user does not pay for it."""
+    if SCHEME == "sha512":
+        return
+    threading.Thread(target=params, name="password-calibration", daemon=True).start()
+
+
+def _executor():
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # Not fork: request threads may hold locks that a forked child would
+                # inherit. The fork server starts single-threaded and only imports
+                # this module (the app is never __main__ under gunicorn or flask)
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+                _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=context)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _submit(func, *args):
+    # Blocks while MAX_PENDING hashes are queued, so a bulk import cannot pile up work
+    _slots.acquire()
+    try:
+        future = _executor().submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _f: _slots.release())
+    return future
+
+
+def hash_password(password):
+    """
+    Hash a password with the configured scheme and calibrated cost.
+
+    Args:
+        password (str): Plain password
+
+    Returns:
+        str: Self-describing hash
+    """
+    if SCHEME == "sha512":
+        return _hash_job(password, SCHEME, {})
+    return _submit(_hash_job, password, SCHEME, params()).result()
+
+
+def hash_many(passwords):
+    """Hash several passwords in parallel; returns the hashes in the same order."""
+    if SCHEME == "sha512":
+        return [_hash_job(p, SCHEME, {}) for p in passwords]
+    current = params()
+    futures = [_submit(_hash_job, p, SCHEME, current) for p in passwords]
+    return [f.result() for f in futures]
+
+
+def needs_rehash(stored):
+    """Whether a stored hash is weaker than what :func:`hash_password` would produce now."""
+    scheme = identify(stored)
+    if SCHEME == "sha512":
+        # Never replace a salted hash by the old format
+        return False
+    if scheme != SCHEME:
+        return True
+    if scheme == "scrypt":
+        ln, r, p = (int(v) for v in _SCRYPT.match(stored).group(1, 2, 3))
+        current = params()
+        return (ln, r, p) < (current["ln"], current["r"], current["p"])
+    if scheme == "argon2":
+        return _argon2_hasher(params()).check_needs_rehash(stored)
+    return False
+
+
+def verify(password, stored):
+    """
+    Check a password against a stored hash of any known scheme.
+
+    Args:
+        password (str): Password given at login
+        stored (str): Hash from the user record
+
+    Returns:
+        tuple: (matches, new hash to store or None). A new hash is returned
+        when the stored one is an old SHA-512 digest or has weaker parameters.
+    """
+    scheme = identify(stored)
+    if scheme is None:
+        return False, None
+    if scheme == "sha512":
+        ok = hmac.compare_digest(hashlib.sha512(password.encode()).hexdigest(), stored)
+    else:
+        ok = _submit(_verify_job, password, stored).result()
+    if ok and needs_rehash(stored):
+        return True, hash_password(password)
+    return ok, None
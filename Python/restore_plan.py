@@ -0,0 +1,436 @@
+"""
+Pre-flight verification and selective restores of backups.
+Before anything is written, the backup is read once and checked: an archive
+against what the backup catalog recorded when it was indexed (member list,
+size and SHA-256, plus the gzip CRC), a snapshot chunk by chunk against the
+hashes in its manifest. A partial restore then extracts only the chosen
+members or Mongo collections: archives are entered at the member offsets from
+the catalog, snapshots are rebuilt from just the chunks of those members.
+
+Runs as its own process (``python restore_plan.py verify|restore plan.json``)
+so the admin app can start it as a background job with sudo. The plan file is
+written by the app; progress lines with throughput go to the job log.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zlib
+
+import snapshots
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+READ_SIZE = 1024 * 1024
+# Stop listing differences after this many
+MAX_ERRORS = 20
+# Files of one collection in a mongodump directory (<db>/<collection><suffix>)
+DUMP_SUFFIXES = (".bson", ".bson.gz", ".metadata.json", ".metadata.json.gz")
+
+# Refuse absolute paths, "..", device files and the like where tarfile supports it
+_EXTRACT_ARGS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+class PlanError(Exception):
+    """Raised when a backup cannot be read or a selection does not fit it."""
+
+
+class Progress:
+    """Counts processed bytes and prints a progress line at most once per PROGRESS_INTERVAL."""
+
+    def __init__(self, phase, total, out=None):
+        self.phase = phase
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self._printed = 0.0
+        self.out = out or sys.stdout
+
+    def advance(self, count):
+        self.done += count
+        now = time.monotonic()
+        if now - self._printed >= PROGRESS_INTERVAL:
+            self._printed = now
+            self.emit()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {"phase": self.phase, "done": self.done, "total": self.total,
+                "seconds": round(elapsed, 3), "rate": int(self.done / elapsed)}
+
+    def emit(self):
+        print("progress " + json.dumps(self.report()), file=self.out, flush=True)
+
+
+class _CountingReader:
+    """Read-only file wrapper that hashes and counts the bytes passing through it."""
+
+    def __init__(self, f, progress):
+        self._f = f
+        self.sha = hashlib.sha256()
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.sha.update(data)
+        self.progress.advance(len(data))
+        return data
+
+    def drain(self):
+        while self.read(READ_SIZE):
+            pass
+
+
+class _IterReader:
+    """File-like view of an iterator of byte strings (a streamed snapshot)."""
+
+    def __init__(self, pieces):
+        self._pieces = iter(pieces)
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            piece = next(self._pieces, None)
+            if piece is None:
+                break
+            self._buffer += piece
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _norm(name):
+    while name.startswith("./"):
+        name = name[2:]
+    return name.strip("/")
+
+
+def collection_of(name):
+    """
+    Return ``db.collection`` for a file of a mongodump directory.
+
+    Args:
+        name (str): Member name, e.g. ``dump/Inventarsystem/items.bson``
+
+    Returns:
+        str: Collection namespace, or None for any other file
+    """
+    base = os.path.basename(name)
+    for suffix in DUMP_SUFFIXES:
+        if base.endswith(suffix):
+            db = os.path.basename(os.path.dirname(_norm(name)))
+            collection = base[:-len(suffix)]
+            return f"{db}.{collection}" if db and collection else None
+    return None
+
+
+def collections_in(members):
+    """Sorted namespaces of all collections dumped in a backup."""
+    return sorted({c for c in (collection_of(m["name"]) for m in members) if c})
+
+
+def select(members, paths=(), collections=()):
+    """
+    Pick the members a partial restore needs.
+
+    Args:
+        members (list): Member dicts with at least ``name`` and ``size``, in archive order
+        paths (list): Member names or directory prefixes to restore as files
+        collections (list): ``db.collection`` namespaces to restore into MongoDB
+
+    Returns:
+        dict: ``files`` and ``dumps`` (selected members), ``bytes`` to extract,
+        and ``missing`` (requested paths or collections the backup does not contain)
+    """
+    paths = [_norm(p) for p in paths if _norm(p)]
+    wanted = set(collections)
+    files, dumps = [], []
+    found_paths, found_collections = set(), set()
+    for member in members:
+        name = _norm(member["name"])
+        hits = [p for p in paths if name == p or name.startswith(p + "/")]
+        if hits:
+            found_paths.update(hits)
+            files.append(member)
+        collection = collection_of(name)
+        if collection in wanted:
+            found_collections.add(collection)
+            dumps.append(member)
+    missing = [p for p in paths if p not in found_paths] + sorted(wanted - found_collections)
+    return {
+        "files": files,
+        "dumps": dumps,
+        "bytes": sum(m["size"] for m in files) + sum(m["size"] for m in dumps),
+        "missing": missing,
+    }
+
+
+def verify_archive(path, expected=None, members=None):
+    """
+    Stream an archive once and check it without extracting anything.
+    gzip checks its CRC and tar its headers on the way; the member list, size
+    and SHA-256 are compared with the catalog entry recorded at indexing time.
+
+    Args:
+        path (str): Path of the .tar.gz archive
+        expected (dict): Catalog entry with ``size`` and ``sha256`` (None: structure only)
+        members (list): Catalog members (``name``, ``size``) in archive order
+
+    Returns:
+        dict: ``ok``, ``errors``, ``members`` checked, plus the progress report
+    """
+    errors = []
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        raise PlanError(f"archive not readable: {e}")
+    if expected and expected.get("size") not in (None, size):
+        errors.append(f"size {size} differs from the catalog ({expected['size']})")
+    progress = Progress("verify", size)
+    count = 0
+    with open(path, "rb") as raw:
+        reader = _CountingReader(raw, progress)
+        try:
+            with gzip.GzipFile(fileobj=reader, mode="rb") as gz:
+                with tarfile.open(fileobj=gz, mode="r|") as tar:
+                    for info in tar:
+                        if members is not None:
+                            if count >= len(members):
+                                errors.append(f"member not in the catalog: {info.name}")
+                            elif (members[count]["name"], members[count]["size"]) != (info.name, info.size):
+                                errors.append(f"member {count} is {info.name} ({info.size} bytes), "
+                                              f"catalog has {members[count]['name']} ({members[count]['size']} bytes)")
+                        count += 1
+                        if len(errors) >= MAX_ERRORS:
+                            break
+                # Reading up to the end makes gzip check its CRC and length
+                while gz.read(READ_SIZE):
+                    pass
+        except (tarfile.TarError, EOFError, OSError, zlib.error) as e:
+            errors.append(f"archive damaged: {e}")
+        reader.drain()
+    if members is not None and count < len(members) and len(errors) < MAX_ERRORS:
+        errors.append(f"{len(members) - count} members of the catalog are missing")
+    digest = reader.sha.hexdigest()
+    if expected and expected.get("sha256") and expected["sha256"] != digest:
+        errors.append(f"SHA-256 {digest} differs from the catalog ({expected['sha256']})")
+    return dict(progress.report(), ok=not errors, errors=errors[:MAX_ERRORS], members=count, sha256=digest)
+
+
+def verify_snapshot(name, store=snapshots.STORE_DIR):
+    """
+    Check that every chunk of a snapshot exists and still matches its hash.
+    Chunks shared by several members are hashed once.
+
+    Returns:
+        dict: ``ok``, ``errors``, ``members`` checked, plus the progress report
+    """
+    manifest = snapshots.load_manifest(name, store)
+    if manifest is None:
+        raise PlanError(f"snapshot {name} not found")
+    progress = Progress("verify", manifest["size"])
+    errors = []
+    checked = {}
+    for entry in manifest["entries"]:
+        total = 0
+        for chunk_id in entry["chunks"]:
+            if chunk_id not in checked:
+                try:
+                    data = snapshots.read_chunk(chunk_id, store)
+                    checked[chunk_id] = len(data) if hashlib.sha256(data).hexdigest() == chunk_id else None
+                except Exception as e:  # missing file or codec error, both mean the chunk is lost
+                    errors.append(f"{entry['name']}: chunk {chunk_id[:12]} unreadable ({e})")
+                    checked[chunk_id] = None
+                    continue
+                if checked[chunk_id] is None:
+                    errors.append(f"{entry['name']}: chunk {chunk_id[:12]} damaged")
+            total += checked[chunk_id] or 0
+            progress.advance(checked[chunk_id] or 0)
+        if total != entry["size"] and all(checked[c] for c in entry["chunks"]):
+            errors.append(f"{entry['name']}: {total} bytes, manifest has {entry['size']}")
+        if len(errors) >= MAX_ERRORS:
+            break
+    return dict(progress.report(), ok=not errors, errors=errors[:MAX_ERRORS], members=len(manifest["entries"]))
+
+
+def extract_archive(path, members, target, progress):
+    """
+    Extract the given catalog members of an archive into ``target``.
+    Members are visited in offset order: seeking forward in the gzip stream
+    only inflates the bytes in between, without parsing or writing them.
+
+    Args:
+        path (str): Path of the .tar.gz archive
+        members (list): Catalog members with ``name`` and ``offset``
+        target (str): Directory to extract into
+        progress (Progress): Advanced by the extracted bytes
+    """
+    os.makedirs(target, exist_ok=True)
+    with gzip.open(path, "rb") as gz, tarfile.open(fileobj=gz, mode="r:") as tar:
+        first = tar.firstmember
+        for member in sorted(members, key=lambda m: m["offset"]):
+            if member["offset"] == 0:
+                info = first
+            else:
+                tar.firstmember = None
+                tar.offset = member["offset"]
+                info = tar.next()
+            if info is None or info.name != member["name"]:
+                raise PlanError(f"{member['name']} is not at offset {member['offset']}; the archive changed since indexing")
+            tar.extract(info, target, **_EXTRACT_ARGS)
+            progress.advance(info.size)
+
+
+def extract_snapshot(name, entries, target, store, progress):
+    """Extract the given manifest entries of a snapshot into ``target``, reading only their chunks."""
+    os.makedirs(target, exist_ok=True)
+    stream = _IterReader(snapshots.iter_tar(name, store, entries=entries, compress=False))
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for info in tar:
+            tar.extract(info, target, **_EXTRACT_ARGS)
+            progress.advance(info.size)
+
+
+def mongorestore(dump_dir, dumps, collections, mongo):
+    """
+    Load the extracted dumps of the chosen collections with mongorestore.
+    Existing documents of those collections are replaced (``--drop``).
+
+    Args:
+        dump_dir (str): Directory the dump members were extracted into
+        dumps (list): The extracted dump members
+        collections (list): ``db.collection`` namespaces
+        mongo (dict): ``host`` and ``port``
+    """
+    binary = shutil.which("mongorestore")
+    if binary is None:
+        raise PlanError("mongorestore not found")
+    # The directory above <db>/ is what mongorestore calls the dump directory
+    roots = sorted({os.path.dirname(os.path.dirname(_norm(m["name"]))) for m in dumps})
+    for root in roots:
+        argv = [binary, "--host", str(mongo.get("host") or "localhost"), "--port", str(mongo.get("port") or 27017),
+                "--drop", "--dir", os.path.join(dump_dir, root)]
+        argv += [f"--nsInclude={c}" for c in collections]
+        if any(m["name"].endswith(".gz") for m in dumps):
+            argv.append("--gzip")
+        print("running " + " ".join(argv), flush=True)
+        subprocess.run(argv, check=True)
+
+
+def verify(plan):
+    """Run the pre-flight check for a plan; returns the verification report."""
+    if plan["kind"] == "snapshot":
+        return verify_snapshot(plan["source"], plan["store"])
+    return verify_archive(plan["source"], plan.get("expected"), plan.get("members"))
+
+
+def restore(plan, check=True):
+    """
+    Verify a backup, then restore the selected files and collections.
+
+    Args:
+        plan (dict): Plan written by the admin app (source, kind, store,
+            expected, members, paths, collections, target, mongo)
+        check (bool): Run the pre-flight verification first
+
+    Returns:
+        dict: Summary with the extracted bytes and the restored collections
+
+    Raises:
+        PlanError: If the verification fails or nothing matches the selection
+    """
+    if check:
+        report = verify(plan)
+        _print_report(report)
+        if not report["ok"]:
+            raise PlanError("verification failed, nothing was restored")
+    if plan["kind"] == "snapshot":
+        manifest = snapshots.load_manifest(plan["source"], plan["store"])
+        if manifest is None:
+            raise PlanError(f"snapshot {plan['source']} not found")
+        members = manifest["entries"]
+    else:
+        members = plan["members"]
+    chosen = select(members, plan.get("paths") or (), plan.get("collections") or ())
+    if chosen["missing"]:
+        raise PlanError("not in the backup: " + ", ".join(chosen["missing"]))
+    if not chosen["files"] and not chosen["dumps"]:
+        raise PlanError("nothing selected")
+    progress = Progress("restore", chosen["bytes"])
+
+    def extract(selected, target):
+        if plan["kind"] == "snapshot":
+            extract_snapshot(plan["source"], selected, target, plan["store"], progress)
+        else:
+            extract_archive(plan["source"], selected, target, progress)
+
+    if chosen["files"]:
+        extract(chosen["files"], plan["target"])
+    if chosen["dumps"]:
+        dump_dir = tempfile.mkdtemp(prefix="inventar-restore-")
+        try:
+            extract(chosen["dumps"], dump_dir)
+            mongorestore(dump_dir, chosen["dumps"], plan["collections"], plan.get("mongo") or {})
+        finally:
+            shutil.rmtree(dump_dir, ignore_errors=True)
+    progress.emit()
+    return dict(progress.report(), files=len(chosen["files"]), collections=plan.get("collections") or [])
+
+
+def _print_report(report):
+    state = "ok" if report["ok"] else "FAILED"
+    print(f"verification {state}: {report['members']} members, {report['done']} bytes "
+          f"in {report['seconds']}s ({report['rate']} bytes/s)", flush=True)
+    for error in report["errors"]:
+        print(f"  {error}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify and selectively restore Inventarsystem backups")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("verify")
+    p.add_argument("plan")
+    p = sub.add_parser("restore")
+    p.add_argument("plan")
+    p.add_argument("--no-verify", action="store_true")
+    args = parser.parse_args(argv)
+
+    with open(args.plan, "r", encoding="utf-8") as fh:
+        plan = json.load(fh)
+    try:
+        if args.command == "verify":
+            report = verify(plan)
+            _print_report(report)
+            return 0 if report["ok"] else 2
+        print(json.dumps(restore(plan, check=not args.no_verify)), flush=True)
+    except (PlanError, subprocess.CalledProcessError) as e:
+        print(f"error: {e}", flush=True)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""
+Retention rules and disk forecast for /var/backups.
+Grandfather-father-son rules keep the newest backup of each of the last N days,
+weeks and months; everything else can be pruned. Backup sizes are recorded
+over time so the disk usage of the coming weeks can be projected with the same
+rules applied.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import datetime
+import os
+import sqlite3
+import time
+
+from backup_catalog import INSTANCE_DIR
+
+HISTORY_PATH = os.path.join(INSTANCE_DIR, "backup_history.sqlite3")
+SCHEMA_VERSION = 1
+# Rows kept in the size history
+HISTORY_KEEP = 1000
+DEFAULT_RULES = {"daily": 7, "weekly": 4, "monthly": 6}
+# Days projected by the forecast
+FORECAST_DAYS = 90
+# Share of the filesystem treated as full (backup.sh needs room for one more archive)
+FULL_THRESHOLD = 0.95
+
+_SCHEMA = """
+DROP TABLE IF EXISTS backups;
+CREATE TABLE backups (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    size INTEGER NOT NULL,
+    stored_bytes INTEGER NOT NULL,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX backups_by_created ON backups (created_at);
+"""
+
+
+def _connect():
+    os.makedirs(os.path.dirname(HISTORY_PATH), exist_ok=True)
+    conn = sqlite3.connect(HISTORY_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript(_SCHEMA)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+    return conn
+
+
+def parse_date(name):
+    """
+    Creation time encoded in a backup name (YYYY-MM-DD or YYYY-MM-DD-HHMMSS).
+
+    Returns:
+        datetime.datetime: Or None if the name carries no date
+    """
+    for fmt, length in (("%Y-%m-%d-%H%M%S", 17), ("%Y-%m-%d", 10)):
+        try:
+            return datetime.datetime.strptime(name[:length], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_rules(rules):
+    """Return daily/weekly/monthly counts as non-negative ints, defaults for missing keys."""
+    rules = rules or {}
+    out = {}
+    for key, default in DEFAULT_RULES.items():
+        try:
+            out[key] = max(0, int(rules.get(key, default)))
+        except (TypeError, ValueError):
+            out[key] = default
+    return out
+
+
+def stored_bytes(backups, chunks=None):
+    """
+    Disk space the given backups occupy together.
+    Snapshots found in ``chunks`` count each chunk they reference once, however
+    many of them share it; other backups count their ``stored_bytes``. A
+    projected backup with a ``base`` snapshot also keeps that one's chunks.
+
+    Args:
+        backups (list): Dicts with ``name``, ``size`` and ``stored_bytes``
+        chunks (dict): Snapshot name -> {chunk id: bytes}, from snapshots.chunk_usage
+
+    Returns:
+        int: Bytes
+    """
+    chunks = chunks or {}
+    total = 0
+    referenced = {}
+    for backup in backups:
+        if backup["name"] in chunks:
+            referenced.update(chunks[backup["name"]])
+            continue
+        total += backup.get("stored_bytes", backup["size"])
+        if backup.get("base") in chunks:
+            referenced.update(chunks[backup["base"]])
+    return total + sum(referenced.values())
+
+
+def plan(backups, rules, chunks=None):
+    """
+    Decide which backups the rules keep (dry run).
+
+    Args:
+        backups (list): Dicts with at least ``name`` and ``size``
+        rules (dict): ``daily``, ``weekly``, ``monthly`` counts; None keeps everything
+        chunks (dict): Chunk sets of the snapshots (see :func:`stored_bytes`);
+            without them ``freed_bytes`` only estimates the snapshots' share
+
+    Returns:
+        dict: ``keep`` and ``prune`` lists (each backup gets a ``reasons``
+        list) and ``freed_bytes``
+    """
+    if rules is None:
+        return {"keep": [dict(b, reasons=["no rules"]) for b in backups], "prune": [], "freed_bytes": 0}
+    rules = normalize_rules(rules)
+    dated, undated = [], []
+    for backup in backups:
+        when = parse_date(backup["name"])
+        (dated if when else undated).append((when, backup))
+    dated.sort(key=lambda item: item[0], reverse=True)
+    reasons = {b["name"]: [] for b in backups}
+    periods = {
+        "daily": lambda d: d.date(),
+        "weekly": lambda d: d.isocalendar()[:2],
+        "monthly": lambda d: (d.year, d.month),
+    }
+    for rule, period_of in periods.items():
+        seen = set()
+        for when, backup in dated:
+            period = period_of(when)
+            if period in seen:
+                continue
+            if len(seen) >= rules[rule]:
+                break
+            seen.add(period)
+            # Newest backup of the period represents it
+            reasons[backup["name"]].append(rule)
+    if dated:
+        reasons[dated[0][1]["name"]].append("latest")
+    for _when, backup in undated:
+        reasons[backup["name"]].append("unknown date")
+    keep, prune = [], []
+    for backup in backups:
+        item = dict(backup, reasons=reasons[backup["name"]])
+        (keep if item["reasons"] else prune).append(item)
+    return {
+        "keep": keep,
+        "prune": prune,
+        # Chunks a kept snapshot still references are not freed
+        "freed_bytes": stored_bytes(backups, chunks) - stored_bytes(keep, chunks) if prune else 0,
+    }
+
+
+def record(backups):
+    """
+    Add the current backups to the size history (existing names are kept as they are).
+
+    Args:
+        backups (list): Dicts with name, kind, size and stored_bytes
+    """
+    now = time.time()
+    rows = []
+    for backup in backups:
+        when = parse_date(backup["name"])
+        if when is None:
+            continue
+        rows.append((backup["name"], backup["kind"], when.timestamp(), backup["size"],
+                     backup.get("stored_bytes", backup["size"]), now))
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO backups (name, kind, created_at, size, stored_bytes, seen_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows,
+            )
+            conn.execute(
+                "DELETE FROM backups WHERE name NOT IN "
+                "(SELECT name FROM backups ORDER BY created_at DESC LIMIT ?)", (HISTORY_KEEP,),
+            )
+    finally:
+        conn.close()
+
+
+def history(limit=HISTORY_KEEP):
+    """Recorded backups, oldest first (also the ones that were pruned since)."""
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT * FROM (SELECT * FROM backups ORDER BY created_at DESC LIMIT ?) ORDER BY created_at", (limit,)
+        ).fetchall()
+        return [dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def _trend(points):
+    """Least-squares line through (x, y) points; returns (slope, intercept)."""
+    n = len(points)
+    if n == 0:
+        return 0.0, 0.0
+    if n == 1:
+        return 0.0, float(points[0][1])
+    mean_x = sum(p[0] for p in points) / n
+    mean_y = sum(p[1] for p in points) / n
+    var = sum((p[0] - mean_x) ** 2 for p in points)
+    if var == 0:
+        return 0.0, mean_y
+    slope = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points) / var
+    return slope, mean_y - slope * mean_x
+
+
+def forecast(backups, rules, interval_hours, disk_total, disk_used, days=FORECAST_DAYS, now=None, chunks=None):
+    """
+    Project disk usage with new backups every ``interval_hours`` and the rules applied.
+    New backup sizes follow the linear trend of the recorded history. Existing
+    snapshots are counted by their chunks; new snapshots add their trend size
+    on top of the chunks of the newest snapshot they build on.
+
+    Args:
+        backups (list): Current backups (name, size, stored_bytes)
+        rules (dict): Retention rules
+        interval_hours (float): Hours between backups
+        disk_total (int): Size of the filesystem in bytes
+        disk_used (int): Bytes used right now
+        days (int): Days to project
+        chunks (dict): Chunk sets of the snapshots (see :func:`stored_bytes`)
+
+    Returns:
+        dict: ``days_until_full`` (None if it does not fill up), ``daily``
+        projected usage per day, and the ``growth_per_backup`` trend
+    """
+    now = now or datetime.datetime.now()
+    points = [(r["created_at"] / 86400.0, r["stored_bytes"]) for r in history()]
+    slope, intercept = _trend(points)
+    current = stored_bytes(backups, chunks)
+    other = disk_used - current
+    simulated = [dict(b) for b in backups]
+    snapshot_names = sorted(n for n in (chunks or {}) if any(b["name"] == n for b in backups))
+    base = snapshot_names[-1] if snapshot_names else None
+    step = datetime.timedelta(hours=max(1.0, float(interval_hours or 24)))
+    next_backup = now + step
+    limit = disk_total * FULL_THRESHOLD
+    daily = []
+    days_until_full = None
+    for day in range(1, days + 1):
+        horizon = now + datetime.timedelta(days=day)
+        while next_backup <= horizon:
+            size = max(0, int(slope * next_backup.timestamp() / 86400.0 + intercept))
+            simulated.append({"name": next_backup.strftime("%Y-%m-%d-%H%M%S"), "size": size, "stored_bytes": size,
+                              "base": base})
+            next_backup += step
+            # Pruning after each backup, as the background job does
+            simulated = plan(simulated, rules)["keep"]
+        used = other + stored_bytes(simulated, chunks)
+        daily.append({"date": horizon.date().isoformat(), "used": used})
+        if days_until_full is None and used > limit:
+            days_until_full = day
+    return {
+        "days_until_full": days_until_full,
+        "daily": daily,
+        "growth_per_backup": slope * step.total_seconds() / 86400.0,
+        "disk_total": disk_total,
+        "disk_used": disk_used,
+    }
+
+
+def disk_usage(path):
+    """Total and used bytes of the filesystem holding ``path``."""
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    return total, total - free
@@ -0,0 +1,166 @@
+"""
+Shared status of the systemd units behind the Inventarsystem.
+All units are queried with one ``systemctl show`` call at most once per
+interval, no matter how many dashboards (or worker processes) are open; the snapshot is cached and
+handed out with an ETag, so a dashboard that polls gets a 304 until a unit changes.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import hashlib
+import json
+import subprocess
+import threading
+import time
+
+import metrics
+import shared_state
+
+# Dashboard name -> systemd unit
+UNITS = {
+    "app": "inventarsystem-gunicorn.service",
+    "admin": "admin-inventarsystem-gunicorn.service",
+    "mongodb": "mongod.service",
+    "nginx": "nginx.service",
+}
+# Seconds a snapshot is served before systemd is asked again
+PROBE_INTERVAL = 5.0
+
+_PROPERTIES = ("Id", "LoadState", "ActiveState", "SubState", "ActiveEnterTimestamp")
+
+
+def systemctl_probe(units):
+    """
+    Query all units with a single ``systemctl show`` call.
+
+    Args:
+        units (list): Unit names
+
+    Returns:
+        dict: unit -> dict with load_state, active_state, sub_state, since
+    """
+    result = metrics.run(
+        ["systemctl", "show", "--no-pager", f"--property={','.join(_PROPERTIES)}", *units],
+        capture_output=True, text=True, check=False, timeout=10,
+    )
+    states = {}
+    # One block of KEY=value lines per unit, separated by blank lines, in argument order
+    for unit, block in zip(units, result.stdout.strip().split("\n\n")):
+        props = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+        states[unit] = {
+            "load_state": props.get("LoadState") or "unknown",
+            "active_state": props.get("ActiveState") or "unknown",
+            "sub_state": props.get("SubState") or "",
+            "since": props.get("ActiveEnterTimestamp") or None,
+        }
+    return states
+
+
+class StatusMonitor:
+    """
+    Cached status snapshot of a set of units.
+
+    Args:
+        units (dict): Display name -> unit name
+        probe (callable): Called with the list of unit names, returns their
+            states like :func:`systemctl_probe`; tests pass a stand-in
+        interval (float): Maximum age of a snapshot in seconds
+        state (shared_state.SharedState): Share snapshots and invalidations
+            with the other worker processes (one probe per interval in total)
+    """
+
+    def __init__(self, units=None, probe=systemctl_probe, interval=PROBE_INTERVAL, state=None):
+        self.units = dict(units or UNITS)
+        self.probe = probe
+        self.interval = interval
+        self.state = state
+        self._snapshot = None
+        self._checked = 0.0
+        self._probe_lock = threading.Lock()
+        self.counters = {"probes": 0, "probe_errors": 0, "served": 0}
+
+    def _build(self, states):
+        units = {}
+        for name, unit in self.units.items():
+            state = states.get(unit) or {"load_state": "unknown", "active_state": "unknown",
+                                         "sub_state": "", "since": None}
+            units[name] = dict(state, unit=unit, active=state["active_state"] == "active")
+        body = json.dumps(units, sort_keys=True).encode()
+        return {
+            "units": units,
+            "running": units.get("app", {}).get("active", False),
+            "etag": hashlib.sha1(body).hexdigest()[:16],
+        }
+
+    def _shared_snapshot(self):
+        # A snapshot another worker probed, if it is recent and not invalidated since
+        snapshot = self.state.get("service_status", "snapshot")
+        if snapshot is None:
+            return None
+        age = time.time() - snapshot["checked_at"]
+        if age >= self.interval or snapshot["checked_at"] <= self.state.get("service_status", "invalidated", 0):
+            return None
+        self._checked = time.monotonic() - max(0.0, age)
+        return snapshot
+
+    def _refresh(self, force=False):
+        # Only one thread probes; the others wait for it and reuse its result.
+        with self._probe_lock:
+            snapshot = None
+            if not force:
+                if self.state is not None:
+                    snapshot = self._shared_snapshot()
+                elif self._snapshot is not None and time.monotonic() - self._checked < self.interval:
+                    return self._snapshot
+            if snapshot is None:
+                self.counters["probes"] += 1
+                try:
+                    states = self.probe(list(self.units.values()))
+                except (OSError, subprocess.SubprocessError):
+                    self.counters["probe_errors"] += 1
+                    states = {}
+                snapshot = self._build(states)
+                snapshot["checked_at"] = time.time()
+                self._checked = time.monotonic()
+                if self.state is not None:
+                    self.state.set("service_status", "snapshot", snapshot)
+            self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self):
+        """
+        Return the current snapshot, probing systemd only if it is older than the interval.
+
+        Returns:
+            dict: ``units`` (name -> state), ``running`` (app unit active),
+            ``etag`` and ``checked_at``
+        """
+        self.counters["served"] += 1
+        return self._refresh()
+
+    def invalidate(self):
+        """Probe on the next request, e.g. after a start/stop script finished."""
+        with self._probe_lock:
+            self._checked = 0.0
+        if self.state is not None:
+            self.state.set("service_status", "invalidated", time.time())
+
+    def is_active(self, name="app"):
+        """Whether the unit with the given display name is active."""
+        unit = self.snapshot()["units"].get(name)
+        return bool(unit and unit["active"])
+
+
+monitor = StatusMonitor(state=shared_state.state)
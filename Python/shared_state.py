@@ -0,0 +1,205 @@
+"""
+State shared by all worker processes of the admin app.
+Small JSON values live in one SQLite file in the instance directory, grouped
+by scope (e.g. ``login_throttle``) and optionally expiring. Read-modify-write
+goes through :meth:`SharedState.update`, which runs inside ``BEGIN IMMEDIATE``,
+so two workers never lose each other's changes. Also holds the session
+secret, which every worker must agree on.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from backup_catalog import INSTANCE_DIR
+
+STATE_DB_PATH = os.path.join(INSTANCE_DIR, "shared_state.sqlite3")
+SECRET_KEY_PATH = os.path.join(INSTANCE_DIR, "secret_key")
+SCHEMA_VERSION = 1
+# Writes per process between two removals of expired entries
+PURGE_EVERY = 200
+
+_SCHEMA = """
+DROP TABLE IF EXISTS state;
+CREATE TABLE state (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (scope, key)
+);
+CREATE INDEX state_by_expiry ON state (expires_at);
+"""
+
+
+class SharedState:
+    """
+    Key/value store in one SQLite file.
+    Connections are opened per thread (and again after a fork), so the
+    object can be created at import time and used from any worker thread.
+
+    Args:
+        path (str): Database file
+    """
+
+    def __init__(self, path=STATE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another worker may have created it while we waited for the lock
+                if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                    for statement in filter(str.strip, _SCHEMA.split(";")):
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _read(self, conn, scope, key, now):
+        row = conn.execute("SELECT value, expires_at FROM state WHERE scope = ? AND key = ?",
+                           (scope, key)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return json.loads(row[0])
+
+    def _write(self, conn, scope, key, value, ttl, now):
+        if value is None:
+            conn.execute("DELETE FROM state WHERE scope = ? AND key = ?", (scope, key))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO state (scope, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (scope, key, json.dumps(value), now + ttl if ttl else None),
+            )
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            conn.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def get(self, scope, key, default=None):
+        """
+        Return a stored value.
+
+        Args:
+            scope (str): Group of keys, usually the name of the caller
+            key (str): Key within the scope
+            default: Returned if the key is missing or expired
+        """
+        value = self._read(self._connect(), scope, key, time.time())
+        return default if value is None else value
+
+    def set(self, scope, key, value, ttl=None):
+        """
+        Store a JSON-serialisable value (None deletes the key).
+
+        Args:
+            ttl (float): Seconds until the value expires (None: never)
+        """
+        self._write(self._connect(), scope, key, value, ttl, time.time())
+
+    def delete(self, scope, key):
+        """Remove a key."""
+        self.set(scope, key, None)
+
+    def update(self, scope, key, change, ttl=None):
+        """
+        Read, change and write one value atomically across processes.
+
+        Args:
+            scope (str): Group of keys
+            key (str): Key within the scope
+            change (callable): Called with the current value (None if missing);
+                returns ``(new value, result)``. A new value of None deletes the key.
+            ttl (float): Seconds until the new value expires (None: never)
+
+        Returns:
+            The ``result`` returned by ``change``
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            value, result = change(self._read(conn, scope, key, now))
+            self._write(conn, scope, key, value, ttl, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def add(self, scope, key, value=True, ttl=None):
+        """
+        Store a value only if the key is not set yet.
+
+        Returns:
+            bool: True if this call stored it, False if it was already there
+        """
+        def change(current):
+            if current is not None:
+                return current, False
+            return value, True
+        return self.update(scope, key, change, ttl)
+
+
+def secret_key():
+    """
+    Session secret shared by all workers.
+    Taken from ``INVENTAR_SECRET_KEY`` or created once in the instance
+    directory (mode 0600); whichever worker starts first writes it.
+
+    Returns:
+        str: The secret
+    """
+    configured = os.environ.get("INVENTAR_SECRET_KEY")
+    if configured:
+        return configured
+    os.makedirs(os.path.dirname(SECRET_KEY_PATH), exist_ok=True)
+    try:
+        fd = os.open(SECRET_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Written by another worker; it may still be finishing the write
+        for _ in range(50):
+            with open(SECRET_KEY_PATH, "r", encoding="utf-8") as fh:
+                key = fh.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{SECRET_KEY_PATH} ist leer")
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        fh.write(key + "\n")
+    return key
+
+
+state = SharedState()
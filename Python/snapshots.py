@@ -0,0 +1,580 @@
+"""
+Incremental, deduplicated backups ("snapshots").
+Files are cut into fixed-size chunks that are stored once under their SHA-256,
+so a snapshot only adds the chunks that changed since any earlier one. Chunks
+are hashed and compressed on several cores (zstd if the ``zstandard`` package
+is installed, gzip otherwise). Every snapshot is a JSON manifest listing its
+entries and chunk ids; a tar.gz is rebuilt from it on demand for downloads
+and restores.
+
+Run as a script for the background jobs::
+
+    python snapshots.py create --source /opt/Inventarsystem [--exclude logs] [--mongo localhost:27017/Inventarsystem]
+    python snapshots.py import /var/backups/Inventarsystem-2025-01-01.tar.gz
+    python snapshots.py export <name> <out.tar.gz>
+    python snapshots.py delete <name> [<name> ...]
+    python snapshots.py gc
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is used without it
+    zstandard = None
+
+STORE_DIR = os.environ.get("INVENTAR_SNAPSHOT_DIR") or "/var/backups/snapshots"
+CHUNK_SIZE = 4 * 1024 * 1024
+# Threads hashing and compressing chunks; zlib and zstd release the GIL
+WORKERS = max(1, min(8, os.cpu_count() or 1))
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+DEFAULT_EXCLUDES = (".git", "logs", "__pycache__", ".venv", "venv", "temp_upload")
+MANIFEST_VERSION = 1
+
+_NAME = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{6}$")
+_CODEC_SUFFIX = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def _chunk_dir(store):
+    return os.path.join(store, "chunks")
+
+
+def _manifest_dir(store):
+    return os.path.join(store, "manifests")
+
+
+def _chunk_path(store, chunk_id, codec):
+    return os.path.join(_chunk_dir(store), chunk_id[:2], chunk_id + _CODEC_SUFFIX[codec])
+
+
+def _manifest_path(store, name):
+    return os.path.join(_manifest_dir(store), f"{name}.json")
+
+
+def _compress(data):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "gzip", zlib.compress(data, GZIP_LEVEL, wbits=31)
+
+
+def _decompress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, wbits=31)
+
+
+def _find_chunk(store, chunk_id):
+    for codec in _CODEC_SUFFIX:
+        path = _chunk_path(store, chunk_id, codec)
+        if os.path.exists(path):
+            return codec, path
+    return None, None
+
+
+def is_valid_name(name):
+    """Whether ``name`` looks like a snapshot name (YYYY-MM-DD-HHMMSS)."""
+    return bool(_NAME.match(name or ""))
+
+
+class _ChunkWriter:
+    """Hashes, compresses and stores chunks in a thread pool, keeping the number in flight bounded."""
+
+    def __init__(self, store):
+        self.store = store
+        self.pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="chunk")
+        self.pending = []
+        self.stats = {"chunks": 0, "new_chunks": 0, "bytes": 0, "stored_bytes": 0}
+
+    def _store(self, data):
+        chunk_id = hashlib.sha256(data).hexdigest()
+        codec, _path = _find_chunk(self.store, chunk_id)
+        if codec is not None:
+            return chunk_id, 0
+        codec, packed = _compress(data)
+        path = _chunk_path(self.store, chunk_id, codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(packed)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+        return chunk_id, len(packed)
+
+    def submit(self, data):
+        """Queue a chunk; returns a future for its id."""
+        # Bound the memory held by queued chunks
+        while len(self.pending) >= WORKERS * 2:
+            self._collect(self.pending.pop(0))
+        self.stats["chunks"] += 1
+        self.stats["bytes"] += len(data)
+        future = self.pool.submit(self._store, data)
+        self.pending.append(future)
+        return future
+
+    def _collect(self, future):
+        _chunk_id, stored = future.result()
+        if stored:
+            self.stats["new_chunks"] += 1
+            self.stats["stored_bytes"] += stored
+
+    def close(self):
+        for future in self.pending:
+            self._collect(future)
+        self.pending = []
+        self.pool.shutdown()
+
+
+def _entry(info):
+    return {
+        "name": info.name,
+        "type": {tarfile.DIRTYPE: "dir", tarfile.SYMTYPE: "symlink", tarfile.LNKTYPE: "hardlink"}.get(info.type, "file"),
+        "mode": info.mode,
+        "mtime": info.mtime,
+        "uid": info.uid,
+        "gid": info.gid,
+        "uname": info.uname,
+        "gname": info.gname,
+        "linkname": info.linkname,
+        "size": info.size if info.isreg() else 0,
+        "chunks": [],
+    }
+
+
+def _add_file(writer, fileobj, size):
+    # At most ``size`` bytes (the size in the tar header): a file that grows
+    # while it is read would otherwise run into the next member of the archive
+    futures = []
+    total = 0
+    while total < size:
+        data = fileobj.read(min(CHUNK_SIZE, size - total))
+        if not data:
+            break
+        total += len(data)
+        futures.append(writer.submit(data))
+    return futures, total
+
+
+def _write_manifest(store, manifest):
+    path = _manifest_path(store, manifest["name"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    # The manifest appears only after all of its chunks are on disk
+    os.replace(tmp, path)
+
+
+def _build(store, name, source, members):
+    """
+    Store the members of a snapshot and write its manifest.
+
+    Args:
+        members: Iterable of (TarInfo, file object or None)
+    """
+    name = name or datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    if not is_valid_name(name):
+        raise ValueError(f"invalid snapshot name: {name}")
+    if os.path.exists(_manifest_path(store, name)):
+        raise FileExistsError(f"snapshot {name} already exists")
+    started = time.time()
+    writer = _ChunkWriter(store)
+    entries = []
+    try:
+        for info, fileobj in members:
+            entry = _entry(info)
+            if fileobj is not None:
+                # A file that shrank is recorded with the bytes that were there
+                entry["chunks"], entry["size"] = _add_file(writer, fileobj, entry["size"])
+            entries.append(entry)
+        writer.close()
+    except BaseException:
+        writer.pool.shutdown(cancel_futures=True)
+        raise
+    for entry in entries:
+        entry["chunks"] = [f.result()[0] for f in entry["chunks"]]
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "name": name,
+        "source": source,
+        "created_at": started,
+        "duration": round(time.time() - started, 3),
+        "size": writer.stats["bytes"],
+        "stored_bytes": writer.stats["stored_bytes"],
+        "chunk_count": writer.stats["chunks"],
+        "new_chunks": writer.stats["new_chunks"],
+        "member_count": len(entries),
+        "entries": entries,
+    }
+    _write_manifest(store, manifest)
+    return manifest
+
+
+def _walk(sources, excludes):
+    excludes = set(excludes)
+    for source in sources:
+        source = os.path.abspath(source)
+        arc_root = os.path.basename(source.rstrip(os.sep)) or "root"
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if d not in excludes)
+            rel = os.path.relpath(root, source)
+            arc_dir = arc_root if rel == "." else os.path.join(arc_root, rel)
+            yield root, arc_dir
+            for name in sorted(files):
+                if name not in excludes:
+                    yield os.path.join(root, name), os.path.join(arc_dir, name)
+
+
+def _path_members(sources, excludes):
+    # Only used for gettarinfo(), which fills in mode, owner and link targets
+    with tarfile.open(os.devnull, "w") as tar:
+        for path, arcname in _walk(sources, excludes):
+            try:
+                info = tar.gettarinfo(path, arcname)
+            except OSError as e:
+                print(f"skipped {path}: {e}", flush=True)
+                continue
+            if info is None or not (info.isreg() or info.isdir() or info.issym()):
+                continue
+            if info.isreg():
+                try:
+                    with open(path, "rb") as fh:
+                        yield info, fh
+                except OSError as e:
+                    print(f"skipped {path}: {e}", flush=True)
+            else:
+                yield info, None
+
+
+def dump_database(out_dir, host, port, db):
+    """
+    Dump one MongoDB database with mongodump, laid out like in backup.sh.
+
+    Args:
+        out_dir (str): Directory that receives ``dump/<db>/``
+
+    Returns:
+        str: Path of the ``dump`` directory
+
+    Raises:
+        RuntimeError: If mongodump is not installed or fails
+    """
+    if shutil.which("mongodump") is None:
+        raise RuntimeError("mongodump not found; install the MongoDB Database Tools")
+    target = os.path.join(out_dir, "dump")
+    result = subprocess.run(["mongodump", "--host", str(host), "--port", str(port), "--db", db, "--out", target],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"mongodump failed ({result.returncode}): {result.stdout.strip()}")
+    return target
+
+
+def create(sources, excludes=DEFAULT_EXCLUDES, name=None, store=STORE_DIR, mongo=None):
+    """
+    Take a snapshot of directories on this machine.
+
+    Args:
+        sources (list): Directories to back up
+        excludes (iterable): File or directory names to skip anywhere
+        name (str): Snapshot name (default: current time, YYYY-MM-DD-HHMMSS)
+        store (str): Snapshot store directory
+        mongo (dict): ``host``, ``port`` and ``db`` to dump first; the dump is
+            stored as ``dump/<db>/`` like in the full backups, so restores of
+            snapshots and archives work the same
+
+    Returns:
+        dict: The manifest that was written
+    """
+    if mongo is None:
+        return _build(store, name, ", ".join(sources), _path_members(sources, excludes))
+    os.makedirs(store, exist_ok=True)
+    # In the store, so the dump lands on the backup filesystem and not in /tmp
+    work = tempfile.mkdtemp(prefix="dump-", dir=store)
+    try:
+        dump = dump_database(work, mongo["host"], mongo["port"], mongo["db"])
+        return _build(store, name, ", ".join(sources), _path_members(list(sources) + [dump], excludes))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def import_archive(path, name=None, store=STORE_DIR):
+    """
+    Turn an existing full backup archive into a snapshot.
+    Later snapshots then only store what changed relative to it.
+
+    Args:
+        path (str): Path of a .tar.gz backup
+        name (str): Snapshot name (default: archive mtime)
+
+    Returns:
+        dict: The manifest that was written
+    """
+    if name is None:
+        name = datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d-%H%M%S")
+
+    def members():
+        with tarfile.open(path, "r|gz") as tar:
+            for info in tar:
+                if info.isreg():
+                    yield info, tar.extractfile(info)
+                elif info.isdir() or info.issym() or info.islnk():
+                    yield info, None
+
+    return _build(store, name, os.path.basename(path), members())
+
+
+def list_snapshots(store=STORE_DIR):
+    """
+    Return a summary of every snapshot (without the entry lists), newest first.
+
+    Returns:
+        list: Dicts with name, created_at, size, stored_bytes, member_count, ...
+    """
+    try:
+        names = os.listdir(_manifest_dir(store))
+    except OSError:
+        return []
+    items = []
+    for fname in names:
+        if not fname.endswith(".json"):
+            continue
+        manifest = load_manifest(fname[:-5], store)
+        if manifest is None:
+            continue
+        manifest.pop("entries", None)
+        items.append(manifest)
+    items.sort(key=lambda m: m["name"], reverse=True)
+    return items
+
+
+def load_manifest(name, store=STORE_DIR):
+    """
+    Read a snapshot manifest.
+
+    Returns:
+        dict: Manifest or None if it does not exist
+    """
+    if not is_valid_name(name):
+        return None
+    try:
+        with open(_manifest_path(store, name), "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def read_chunk(chunk_id, store=STORE_DIR):
+    """Return the uncompressed bytes of a chunk (raises FileNotFoundError if missing)."""
+    codec, path = _find_chunk(store, chunk_id)
+    if codec is None:
+        raise FileNotFoundError(chunk_id)
+    with open(path, "rb") as fh:
+        return _decompress(codec, fh.read())
+
+
+def _tar_info(entry):
+    info = tarfile.TarInfo(entry["name"])
+    info.type = {"dir": tarfile.DIRTYPE, "symlink": tarfile.SYMTYPE, "hardlink": tarfile.LNKTYPE}.get(entry["type"], tarfile.REGTYPE)
+    info.mode = entry["mode"]
+    info.mtime = entry["mtime"]
+    info.uid, info.gid = entry["uid"], entry["gid"]
+    info.uname, info.gname = entry["uname"], entry["gname"]
+    info.linkname = entry["linkname"]
+    info.size = entry["size"]
+    return info
+
+
+def iter_tar(name, store=STORE_DIR, entries=None, compress=True):
+    """
+    Rebuild a snapshot as a (gzip-compressed) tar stream, chunk by chunk.
+    Memory use is bounded by one chunk, so multi-GB snapshots can be streamed
+    to a download or written to disk for restore.sh.
+
+    Args:
+        name (str): Snapshot name
+        entries (list): Only these manifest entries (default: all)
+        compress (bool): gzip the stream
+
+    Yields:
+        bytes: Pieces of the archive
+    """
+    manifest = load_manifest(name, store)
+    if manifest is None:
+        raise FileNotFoundError(name)
+    gz = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+    written = 0
+
+    def out(data):
+        nonlocal written
+        written += len(data)
+        return gz.compress(data) if gz else data
+
+    for entry in manifest["entries"] if entries is None else entries:
+        yield out(_tar_info(entry).tobuf(tarfile.GNU_FORMAT))
+        for chunk_id in entry["chunks"]:
+            yield out(read_chunk(chunk_id, store))
+        remainder = entry["size"] % tarfile.BLOCKSIZE
+        if remainder:
+            yield out(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    # End of archive: two zero blocks, padded to a full record like tarfile does
+    yield out(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    remainder = written % tarfile.RECORDSIZE
+    if remainder:
+        yield out(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+    if gz:
+        yield gz.flush()
+
+
+def export(name, out_path, store=STORE_DIR):
+    """Write a snapshot as a .tar.gz file (e.g. for restore.sh)."""
+    tmp = f"{out_path}.tmp"
+    with open(tmp, "wb") as fh:
+        for piece in iter_tar(name, store):
+            fh.write(piece)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def delete(name, store=STORE_DIR):
+    """Remove a snapshot manifest; its chunks are freed by :func:`gc`."""
+    if not is_valid_name(name):
+        raise FileNotFoundError(name)
+    os.remove(_manifest_path(store, name))
+
+
+def chunk_usage(store=STORE_DIR):
+    """
+    Return the chunks of every snapshot with the bytes each occupies on disk.
+    Snapshots share chunks, so the space deleting some of them frees is only
+    known from these sets (what :func:`gc` would remove), not from their sizes.
+
+    Returns:
+        dict: Snapshot name -> {chunk id: stored bytes}
+    """
+    stored = {}
+    for root, _dirs, files in os.walk(_chunk_dir(store)):
+        for fname in files:
+            if not fname.endswith(".tmp"):
+                stored[fname.split(".", 1)[0]] = os.path.getsize(os.path.join(root, fname))
+    usage = {}
+    for item in list_snapshots(store):
+        manifest = load_manifest(item["name"], store)
+        if manifest is None:
+            continue
+        usage[item["name"]] = {c: stored[c] for entry in manifest["entries"] for c in entry["chunks"] if c in stored}
+    return usage
+
+
+def gc(store=STORE_DIR):
+    """
+    Delete chunks that no manifest references any more.
+
+    Returns:
+        dict: ``removed`` chunks and ``freed_bytes``
+    """
+    referenced = set()
+    for fname in os.listdir(_manifest_dir(store)) if os.path.isdir(_manifest_dir(store)) else []:
+        if fname.endswith(".json"):
+            manifest = load_manifest(fname[:-5], store)
+            if manifest is None:
+                # Unreadable manifest: keep everything rather than lose data
+                return {"removed": 0, "freed_bytes": 0}
+            for entry in manifest["entries"]:
+                referenced.update(entry["chunks"])
+    removed = freed = 0
+    for root, _dirs, files in os.walk(_chunk_dir(store)):
+        for fname in files:
+            chunk_id = fname.split(".", 1)[0]
+            path = os.path.join(root, fname)
+            if chunk_id in referenced:
+                continue
+            # Leftovers of an interrupted write are removed once they are old
+            if fname.endswith(".tmp") and time.time() - os.path.getmtime(path) < 3600:
+                continue
+            freed += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+    return {"removed": removed, "freed_bytes": freed}
+
+
+def _print_summary(manifest):
+    print(f"snapshot {manifest['name']}: {manifest['member_count']} entries, "
+          f"{manifest['size']} bytes, {manifest['new_chunks']}/{manifest['chunk_count']} new chunks, "
+          f"{manifest['stored_bytes']} bytes stored in {manifest['duration']}s", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incremental Inventarsystem snapshots")
+    parser.add_argument("--store", default=STORE_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("create")
+    p.add_argument("--source", action="append", required=True)
+    p.add_argument("--exclude", action="append")
+    p.add_argument("--name")
+    p.add_argument("--mongo", help="host:port/db to dump with mongodump into the snapshot")
+    p = sub.add_parser("import")
+    p.add_argument("archive")
+    p.add_argument("--name")
+    p = sub.add_parser("export")
+    p.add_argument("name")
+    p.add_argument("out")
+    p = sub.add_parser("delete")
+    p.add_argument("names", nargs="+")
+    sub.add_parser("gc")
+    args = parser.parse_args(argv)
+
+    if args.command == "create":
+        mongo = None
+        if args.mongo:
+            address, _, db = args.mongo.partition("/")
+            host, _, port = address.partition(":")
+            mongo = {"host": host or "localhost", "port": int(port or 27017), "db": db}
+        _print_summary(create(args.source, args.exclude or DEFAULT_EXCLUDES, args.name, args.store, mongo))
+    elif args.command == "import":
+        _print_summary(import_archive(args.archive, args.name, args.store))
+    elif args.command == "export":
+        print(export(args.name, args.out, args.store), flush=True)
+    elif args.command == "delete":
+        for name in args.names:
+            delete(name, args.store)
+            print(f"deleted snapshot {name}", flush=True)
+        # Free the chunks only the deleted snapshots used
+        print(json.dumps(gc(args.store)), flush=True)
+    elif args.command == "gc":
+        print(json.dumps(gc(args.store)), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,39 @@
-chatBox = document.getElementById('chatBox');
+const chatBox = document.getElementById('chatBox');
 
-function fetchMessages() {
-    fetch('/messages')
-        .then(response => response.json())
+// Long poll: each request waits on the server until something newer than the last id exists.
+// The id survives page changes in sessionStorage, so nothing published in between is lost.
+const MESSAGE_LIMIT = 100;
+const MESSAGE_WAIT_SECONDS = 20;
+const MESSAGE_RETRY_MS = 5000;
+const MESSAGE_ID_KEY = 'inventar.lastMessageId';
+
+function showMessage(msg) {
+    const messageElement = document.createElement('div');
+    messageElement.className = `flash ${msg.level} message message-${msg.level}`;
+    messageElement.textContent = msg.text;
+    chatBox.appendChild(messageElement);
+    while (chatBox.childElementCount > MESSAGE_LIMIT) {
+        chatBox.removeChild(chatBox.firstElementChild);
+    }
+}
+
+function pollMessages() {
+    const after = sessionStorage.getItem(MESSAGE_ID_KEY) || 0;
+    fetch(`/messages?after=${after}&wait=${MESSAGE_WAIT_SECONDS}`, { credentials: 'same-origin' })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            return response.json();
+        })
         .then(data => {
-            chatBox.innerHTML = '';
-            data.messages.forEach(msg => {
-                const messageElement = document.createElement('div');
-                messageElement.textContent = msg;
-                chatBox.appendChild(messageElement);
-            });
-        });
+            data.messages.forEach(showMessage);
+            sessionStorage.setItem(MESSAGE_ID_KEY, data.last_id);
+            pollMessages();
+        })
+        .catch(() => setTimeout(pollMessages, MESSAGE_RETRY_MS));
 }
 
-setInterval(fetchMessages, 1000);
\ No newline at end of file
+if (chatBox) {
+    pollMessages();
+}
@@ -0,0 +1,514 @@
+"""
+Tests for the admin backend that need neither MongoDB nor systemd:
+
+    python -m unittest test
+
+The SQLite state of the modules goes to a temporary instance directory
+unless INVENTAR_ADMIN_INSTANCE is set.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+import atexit
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# Every module keeps its SQLite files in the instance directory it sees at import
+_INSTANCE = tempfile.mkdtemp(prefix="inventar-test-instance-")
+atexit.register(shutil.rmtree, _INSTANCE, ignore_errors=True)
+os.environ.setdefault("INVENTAR_ADMIN_INSTANCE", _INSTANCE)
+os.environ.setdefault("INVENTAR_BASE", _INSTANCE)
+
+import pyotp
+
+import app
+import backup_catalog
+import backup_upload
+import jobs
+import messages
+import retention
+import snapshots
+import totp_guard
+from config_store import ConfigStore, ConfigError
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp(prefix="inventar-test-")
+        self.addCleanup(shutil.rmtree, self.work, ignore_errors=True)
+        self.source = os.path.join(self.work, "Inventarsystem")
+        self.store = os.path.join(self.work, "store")
+        os.makedirs(self.source)
+
+    def _write(self, name, data):
+        with open(os.path.join(self.source, name), "wb") as fh:
+            fh.write(data)
+
+    def _members(self, name):
+        data = b"".join(snapshots.iter_tar(name, self.store))
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+            return {m.name: tar.extractfile(m).read() for m in tar if m.isreg()}
+
+    def test_file_appended_during_walk(self):
+        self._write("a.log", b"first\n" * 1000)
+        self._write("b.txt", b"second file")
+        log = os.path.join(self.source, "a.log")
+
+        def growing():
+            for info, fileobj in snapshots._path_members([self.source], ()):
+                if info.name.endswith("a.log"):
+                    # After the stat that filled in the tar header, before the read
+                    with open(log, "ab") as fh:
+                        fh.write(b"appended\n" * 5000)
+                yield info, fileobj
+
+        manifest = snapshots._build(self.store, None, self.source, growing())
+        members = self._members(manifest["name"])
+        self.assertEqual(members["Inventarsystem/a.log"], b"first\n" * 1000)
+        self.assertEqual(members["Inventarsystem/b.txt"], b"second file")
+
+    def test_file_shrunk_during_walk(self):
+        self._write("a.log", b"x" * 5000)
+        self._write("b.txt", b"second file")
+        log = os.path.join(self.source, "a.log")
+
+        def shrinking():
+            for info, fileobj in snapshots._path_members([self.source], ()):
+                if info.name.endswith("a.log"):
+                    os.truncate(log, 100)
+                yield info, fileobj
+
+        manifest = snapshots._build(self.store, None, self.source, shrinking())
+        members = self._members(manifest["name"])
+        self.assertEqual(members["Inventarsystem/a.log"], b"x" * 100)
+        self.assertEqual(members["Inventarsystem/b.txt"], b"second file")
+
+    def test_create_includes_database_dump(self):
+        self._write("app.py", b"print('hi')\n")
+
+        def fake_mongodump(argv, **kwargs):
+            out = argv[argv.index("--out") + 1]
+            db = argv[argv.index("--db") + 1]
+            os.makedirs(os.path.join(out, db))
+            with open(os.path.join(out, db, "items.bson"), "wb") as fh:
+                fh.write(b"bson")
+            return mock.Mock(returncode=0, stdout="")
+
+        with mock.patch("shutil.which", return_value="/usr/bin/mongodump"), \
+                mock.patch("subprocess.run", side_effect=fake_mongodump):
+            manifest = snapshots.create([self.source], (), store=self.store,
+                                        mongo={"host": "localhost", "port": 27017, "db": "Inventarsystem"})
+        members = self._members(manifest["name"])
+        self.assertEqual(members["dump/Inventarsystem/items.bson"], b"bson")
+        self.assertIn("Inventarsystem/app.py", members)
+        # The temporary dump is gone again
+        self.assertEqual(sorted(os.listdir(self.store)), ["chunks", "manifests"])
+
+    def test_create_without_mongodump(self):
+        with mock.patch("shutil.which", return_value=None):
+            with self.assertRaises(RuntimeError):
+                snapshots.create([self.source], (), store=self.store,
+                                 mongo={"host": "localhost", "port": 27017, "db": "Inventarsystem"})
+
+
+class SendRangedTest(unittest.TestCase):
+
+    def setUp(self):
+        work = tempfile.mkdtemp(prefix="inventar-test-")
+        self.addCleanup(shutil.rmtree, work, ignore_errors=True)
+        self.path = os.path.join(work, "a.tar.gz")
+        with open(self.path, "wb") as fh:
+            fh.write(b"0123456789")
+
+    def _send(self, headers=None, weak=False):
+        with app.app.test_request_context(headers=headers or {}):
+            response = app.send_ranged(self.path, "abc", "a.tar.gz", "application/gzip", weak=weak)
+        self.addCleanup(response.close)
+        body = b"".join(response.response) if response.status_code in (200, 206) else b""
+        return response, body
+
+    def test_full_download(self):
+        response, body = self._send()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b"0123456789")
+        self.assertEqual(response.headers["ETag"], '"abc"')
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+    def test_single_range(self):
+        response, body = self._send({"Range": "bytes=2-5"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, b"2345")
+        self.assertEqual(response.headers["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(response.content_length, 4)
+
+    def test_suffix_and_open_ranges(self):
+        self.assertEqual(self._send({"Range": "bytes=-3"})[1], b"789")
+        self.assertEqual(self._send({"Range": "bytes=7-"})[1], b"789")
+
+    def test_unsatisfiable_range(self):
+        response, _body = self._send({"Range": "bytes=20-30"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */10")
+
+    def test_if_range(self):
+        response, _body = self._send({"Range": "bytes=2-5", "If-Range": '"abc"'})
+        self.assertEqual(response.status_code, 206)
+        # A changed file: the client gets all of it instead of a spliced download
+        response, body = self._send({"Range": "bytes=2-5", "If-Range": '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b"0123456789")
+
+    def test_if_none_match(self):
+        self.assertEqual(self._send({"If-None-Match": '"abc"'})[0].status_code, 304)
+
+    def test_weak_etag(self):
+        response, _body = self._send(weak=True)
+        self.assertEqual(response.headers["ETag"], 'W/"abc"')
+        self.assertEqual(self._send({"If-None-Match": 'W/"abc"'}, weak=True)[0].status_code, 304)
+        # A weak validator never allows a resumed range
+        self.assertEqual(self._send({"Range": "bytes=2-5", "If-Range": 'W/"abc"'}, weak=True)[0].status_code, 200)
+
+
+class BackupUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp(prefix="inventar-test-")
+        self.addCleanup(shutil.rmtree, self.work, ignore_errors=True)
+        for name, value in (("BACKUP_DIR", self.work), ("STAGING_DIR", os.path.join(self.work, ".incoming")),
+                            ("CHUNK_SIZE", 4)):
+            patcher = mock.patch.object(backup_upload, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _upload(self, data):
+        upload = backup_upload.create("a.tar.gz", len(data))
+        for offset in range(0, len(data), 4):
+            block = data[offset:offset + 4]
+            backup_upload.write_chunk(upload["id"], offset, io.BytesIO(block), len(block))
+        return upload["id"]
+
+    def test_chunks_and_commit(self):
+        upload_id = self._upload(b"0123456789")
+        result = backup_upload.commit(upload_id, "Inventarsystem-2025-01-01.tar.gz")
+        self.assertEqual(result["sha256"], hashlib.sha256(b"0123456789").hexdigest())
+        with open(os.path.join(self.work, "Inventarsystem-2025-01-01.tar.gz"), "rb") as fh:
+            self.assertEqual(fh.read(), b"0123456789")
+        with self.assertRaises(backup_upload.UploadError) as ctx:
+            backup_upload.status(upload_id)
+        self.assertEqual(ctx.exception.status, 404)
+
+    def test_wrong_offset(self):
+        upload = backup_upload.create("a.tar.gz", 10)
+        backup_upload.write_chunk(upload["id"], 0, io.BytesIO(b"0123"), 4)
+        with self.assertRaises(backup_upload.UploadError) as ctx:
+            backup_upload.write_chunk(upload["id"], 8, io.BytesIO(b"89"), 2)
+        self.assertEqual((ctx.exception.status, ctx.exception.offset), (409, 4))
+
+    def test_wrong_chunk_size(self):
+        upload = backup_upload.create("a.tar.gz", 10)
+        with self.assertRaises(backup_upload.UploadError) as ctx:
+            backup_upload.write_chunk(upload["id"], 0, io.BytesIO(b"012"), 3)
+        self.assertEqual(ctx.exception.status, 400)
+
+    def test_incomplete_commit(self):
+        upload = backup_upload.create("a.tar.gz", 10)
+        backup_upload.write_chunk(upload["id"], 0, io.BytesIO(b"0123"), 4)
+        with self.assertRaises(backup_upload.UploadError) as ctx:
+            backup_upload.commit(upload["id"], "Inventarsystem-2025-01-01.tar.gz")
+        self.assertEqual((ctx.exception.status, ctx.exception.offset), (409, 4))
+
+    def test_checksum_mismatch_then_retry(self):
+        upload_id = self._upload(b"0123456789")
+        with self.assertRaises(backup_upload.UploadError) as ctx:
+            backup_upload.commit(upload_id, "Inventarsystem-2025-01-01.tar.gz", "0" * 64)
+        self.assertEqual(ctx.exception.status, 422)
+        expected = hashlib.sha256(b"0123456789").hexdigest()
+        self.assertEqual(backup_upload.commit(upload_id, "Inventarsystem-2025-01-01.tar.gz", expected)["sha256"],
+                         expected)
+
+    def test_commit_hashes_chunks_from_other_workers(self):
+        upload_id = self._upload(b"0123456789")
+        # The chunks arrived at other processes: no running hash here
+        backup_upload._hashers.clear()
+        result = backup_upload.commit(upload_id, "Inventarsystem-2025-01-01.tar.gz")
+        self.assertEqual(result["sha256"], hashlib.sha256(b"0123456789").hexdigest())
+
+    def test_commit_never_overwrites(self):
+        target = os.path.join(self.work, "Inventarsystem-2025-01-01.tar.gz")
+        with open(target, "wb") as fh:
+            fh.write(b"existing")
+        upload_id = self._upload(b"0123456789")
+        with self.assertRaises(backup_upload.UploadError) as ctx:
+            backup_upload.commit(upload_id, "Inventarsystem-2025-01-01.tar.gz")
+        self.assertEqual(ctx.exception.status, 409)
+        with open(target, "rb") as fh:
+            self.assertEqual(fh.read(), b"existing")
+        # The upload is kept for another try
+        self.assertEqual(backup_upload.status(upload_id)["offset"], 10)
+
+
+class RetentionTest(unittest.TestCase):
+
+    def _backup(self, name, size=100, kind="full"):
+        return {"name": name, "kind": kind, "size": size, "stored_bytes": size}
+
+    def test_keeps_newest_per_period(self):
+        backups = [self._backup(f"2025-01-{day:02d}") for day in range(1, 11)]
+        result = retention.plan(backups, {"daily": 3, "weekly": 0, "monthly": 0})
+        self.assertEqual(sorted(b["name"] for b in result["keep"]), ["2025-01-08", "2025-01-09", "2025-01-10"])
+        self.assertEqual(len(result["prune"]), 7)
+        self.assertEqual(result["freed_bytes"], 700)
+
+    def test_weekly_and_monthly(self):
+        backups = [self._backup(n) for n in ("2025-01-31", "2025-02-02", "2025-02-09", "2025-02-10")]
+        result = retention.plan(backups, {"daily": 1, "weekly": 2, "monthly": 2})
+        reasons = {b["name"]: b["reasons"] for b in result["keep"]}
+        self.assertEqual(reasons["2025-02-10"], ["daily", "weekly", "monthly", "latest"])
+        self.assertEqual(reasons["2025-02-09"], ["weekly"])
+        self.assertEqual(reasons["2025-01-31"], ["monthly"])
+        self.assertEqual([b["name"] for b in result["prune"]], ["2025-02-02"])
+
+    def test_undated_and_no_rules(self):
+        backups = [self._backup("2025-01-01"), self._backup("2025-01-02"), self._backup("manual")]
+        result = retention.plan(backups, {"daily": 1, "weekly": 0, "monthly": 0})
+        self.assertIn("unknown date", {b["name"]: b["reasons"] for b in result["keep"]}["manual"])
+        self.assertEqual(retention.plan(backups, None)["prune"], [])
+
+    def test_freed_bytes_of_shared_chunks(self):
+        chunks = {
+            "2025-01-01-000000": {"a": 10, "b": 20},
+            "2025-01-02-000000": {"a": 10, "c": 5},
+        }
+        backups = [self._backup(n, 1000, "snapshot") for n in chunks]
+        result = retention.plan(backups, {"daily": 1, "weekly": 0, "monthly": 0}, chunks)
+        # Only chunk b is referenced by nothing that stays
+        self.assertEqual(result["freed_bytes"], 20)
+
+
+class ConfigStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        work = tempfile.mkdtemp(prefix="inventar-test-")
+        self.addCleanup(shutil.rmtree, work, ignore_errors=True)
+        self.path = os.path.join(work, "config.json")
+        self._write({"mongodb": {"port": 0}, "upload": {"max_size_mb": 5}})
+        os.chmod(self.path, 0o640)
+        self.store = ConfigStore(self.path, check_interval=0)
+
+    def _write(self, cfg):
+        with open(self.path, "w", encoding="utf-8") as fh:
+            json.dump(cfg, fh)
+
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+
+    def test_update_writes_and_keeps_mode(self):
+        cfg, written = self.store.update(lambda c: c["upload"].update(max_size_mb=8))
+        self.assertTrue(written)
+        self.assertEqual(cfg["upload"]["max_size_mb"], 8)
+        self.assertEqual(self._read()["upload"]["max_size_mb"], 8)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+    def test_invalid_change_is_refused(self):
+        with self.assertRaises(ConfigError) as ctx:
+            self.store.update(lambda c: c["upload"].update(max_size_mb=0))
+        self.assertEqual(len(ctx.exception.problems), 1)
+        self.assertIn("upload.max_size_mb", ctx.exception.problems[0])
+        self.assertEqual(self._read()["upload"]["max_size_mb"], 5)
+
+    def test_stored_problems_do_not_block_other_keys(self):
+        _cfg, written = self.store.update(lambda c: c["upload"].update(max_size_mb=8))
+        self.assertTrue(written)
+        # The invalid port was already in the file; it is reported, not enforced
+        self.assertIn("mongodb.port", self.store.error)
+
+    def test_unchanged_is_not_written(self):
+        before = os.stat(self.path).st_mtime_ns
+        _cfg, written = self.store.update(lambda c: c["upload"].update(max_size_mb=5))
+        self.assertFalse(written)
+        self.assertEqual(os.stat(self.path).st_mtime_ns, before)
+
+    def test_edits_made_meanwhile_are_kept(self):
+        self.store.snapshot()
+        self._write({"mongodb": {"port": 0}, "upload": {"max_size_mb": 5}, "key": "by hand"})
+        self.store.update(lambda c: c["upload"].update(max_size_mb=8))
+        self.assertEqual(self._read()["key"], "by hand")
+
+
+class TotpGuardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.secret = pyotp.random_base32()
+        self.now = datetime.datetime(2025, 1, 1, 12, 0, 0)
+        self.code = pyotp.TOTP(self.secret).at(self.now)
+
+    def test_code_is_accepted_once(self):
+        verifier = totp_guard.TotpVerifier(self.secret)
+        self.assertTrue(verifier.verify(self.code, self.now))
+        self.assertFalse(verifier.verify(self.code, self.now))
+        self.assertEqual(verifier.counters["rejected_replay"], 1)
+
+    def test_invalid_codes(self):
+        verifier = totp_guard.TotpVerifier(self.secret)
+        self.assertFalse(verifier.verify("12345", self.now))
+        self.assertFalse(verifier.verify("abcdef", self.now))
+        wrong = f"{(int(self.code) + 1) % 1000000:06d}"
+        self.assertFalse(verifier.verify(wrong, self.now))
+        self.assertEqual(verifier.counters["rejected_invalid"], 3)
+
+    def test_valid_window(self):
+        later = self.now + datetime.timedelta(seconds=30)
+        self.assertFalse(totp_guard.TotpVerifier(self.secret).verify(self.code, later))
+        self.assertTrue(totp_guard.TotpVerifier(self.secret, valid_window=1).verify(self.code, later))
+
+    def test_throttle_burst_and_refill(self):
+        throttle = totp_guard.LoginThrottle(rate=1.0, burst=2)
+        self.assertEqual(throttle.acquire("ip", now=100.0), 0)
+        self.assertEqual(throttle.acquire("ip", now=100.0), 0)
+        self.assertAlmostEqual(throttle.acquire("ip", now=100.0), 1.0)
+        self.assertEqual(throttle.acquire("ip", now=101.0), 0)
+        # Other clients have their own budget
+        self.assertEqual(throttle.acquire("other", now=100.0), 0)
+
+    def test_backoff_after_failures(self):
+        throttle = totp_guard.LoginThrottle(rate=10.0, burst=10, free_failures=2, base_backoff=2.0)
+        for _ in range(2):
+            throttle.failure("ip", now=100.0)
+        self.assertEqual(throttle.acquire("ip", now=100.0), 0)
+        throttle.failure("ip", now=100.0)
+        self.assertAlmostEqual(throttle.acquire("ip", now=100.0), 2.0)
+        throttle.failure("ip", now=100.0)
+        self.assertAlmostEqual(throttle.acquire("ip", now=100.0), 4.0)
+        throttle.success("ip")
+        self.assertEqual(throttle.acquire("ip", now=100.0), 0)
+
+
+class BackupCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp(prefix="inventar-test-")
+        self.addCleanup(shutil.rmtree, self.work, ignore_errors=True)
+        self.path = self._archive("Inventarsystem-2025-01-01.tar.gz", {"a.txt": b"hello", "b.txt": b"world"})
+
+    def _archive(self, name, files):
+        path = os.path.join(self.work, name)
+        with tarfile.open(path, "w:gz") as tar:
+            for member, data in files.items():
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self.addCleanup(backup_catalog.invalidate, path)
+        return path
+
+    def test_index_and_lookup(self):
+        entry = backup_catalog.index_archive(self.path)
+        with open(self.path, "rb") as fh:
+            self.assertEqual(entry["sha256"], hashlib.sha256(fh.read()).hexdigest())
+        self.assertEqual(entry["member_count"], 2)
+        self.assertEqual([m["name"] for m in backup_catalog.member_index(self.path)], ["a.txt", "b.txt"])
+        self.assertEqual(backup_catalog.lookup(self.path)["sha256"], entry["sha256"])
+
+    def test_refresh_without_scan(self):
+        backup_catalog.index_archive(self.path)
+        fresh = self._archive("Inventarsystem-2025-01-02.tar.gz", {"c.txt": b"new"})
+        with mock.patch.object(backup_catalog, "index_in_background") as queued:
+            entries = backup_catalog.refresh([self.path, fresh], scan=False)
+        # Only what is indexed already; the new archive is queued instead of read
+        self.assertEqual([e["path"] for e in entries], [self.path])
+        queued.assert_called_once_with(fresh)
+        self.assertIsNone(backup_catalog.lookup(fresh))
+
+    def test_refresh_drops_deleted_archives(self):
+        backup_catalog.index_archive(self.path)
+        os.remove(self.path)
+        self.assertEqual(backup_catalog.refresh([self.path]), [])
+        self.assertIsNone(backup_catalog.lookup(self.path))
+
+
+class MessagesTest(unittest.TestCase):
+
+    def test_since_returns_what_was_missed(self):
+        first = messages.latest_id()
+        messages.publish("backup", "eins")
+        messages.publish("backup", "zwei", "success")
+        items = messages.since(first)
+        self.assertEqual([m["text"] for m in items], ["eins", "zwei"])
+        self.assertEqual(items[1]["level"], "success")
+        self.assertEqual(messages.since(items[-1]["id"]), [])
+
+    def test_wait_answers_at_once_when_something_is_new(self):
+        after = messages.latest_id()
+        messages.publish("backup", "neu")
+        started = time.monotonic()
+        self.assertEqual([m["text"] for m in messages.wait(after, 5)], ["neu"])
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_wait_times_out_empty(self):
+        started = time.monotonic()
+        self.assertEqual(messages.wait(messages.latest_id(), 0.2), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+
+class JobsTest(unittest.TestCase):
+
+    def _submit(self, resources, seconds=0.0):
+        job = jobs.submit("test", [sys.executable, "-c", f"import time; time.sleep({seconds})"], resources)
+        self.addCleanup(self._wait, job["id"])
+        return job
+
+    def _wait(self, job_id):
+        deadline = time.monotonic() + 10
+        while jobs.get(job_id)["state"] in jobs.ACTIVE_STATES and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return jobs.get(job_id)
+
+    def test_conflicting_resources(self):
+        running = self._submit(["db"], 1)
+        with self.assertRaises(jobs.JobConflict) as ctx:
+            self._submit(["db", "files"])
+        self.assertEqual(ctx.exception.job["id"], running["id"])
+        # Disjoint resources run side by side
+        self.assertEqual(self._wait(self._submit(["logs"])["id"])["state"], "succeeded")
+        self._wait(running["id"])
+        self.assertEqual(self._wait(self._submit(["db"])["id"])["state"], "succeeded")
+
+    def test_job_of_dead_worker_is_interrupted(self):
+        job = self._submit(["restore"])
+        self._wait(job["id"])
+        conn = jobs._connect()
+        try:
+            # As if the worker died before it could record the end
+            conn.execute("UPDATE jobs SET state = 'running', pid = ?, child_pid = NULL WHERE id = ?",
+                         (2 ** 22 + 1, job["id"]))
+        finally:
+            conn.close()
+        self._submit(["restore"])
+        self.assertEqual(jobs.get(job["id"])["state"], "interrupted")
+
+
+if __name__ == "__main__":
+    unittest.main()
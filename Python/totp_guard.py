@@ -0,0 +1,201 @@
+"""
+TOTP verification with replay protection and per-client login throttling.
+Keeps one precomputed TOTP object, remembers recently accepted codes so they
+cannot be used twice, and rate-limits guesses per IP with a token bucket plus
+exponential backoff after repeated failures. Both keep their state in memory
+or, with several worker processes, in a shared_state.SharedState.
+"""
+'''
+   Copyright 2025 Maximilian Gründinger
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+from collections import OrderedDict, deque
+import datetime
+import hmac
+import threading
+import time
+import pyotp
+
+
+class TotpVerifier:
+    """
+    Verify TOTP codes against one secret and reject codes that were already used.
+
+    Args:
+        secret (str): Base32 TOTP secret
+        valid_window (int): Accepted time steps before/after the current one
+        replay_size (int): How many accepted (code, timestep) pairs to remember
+        state (shared_state.SharedState): Remember used codes there instead of
+            in this process, so a code used on one worker is refused by all
+    """
+
+    def __init__(self, secret, valid_window=0, replay_size=64, state=None):
+        self.totp = pyotp.TOTP(secret)
+        self.valid_window = valid_window
+        self.state = state
+        self._used = deque(maxlen=replay_size)
+        self._used_set = set()
+        self._lock = threading.Lock()
+        self.counters = {"attempts": 0, "accepted": 0, "rejected_invalid": 0, "rejected_replay": 0}
+
+    def _matching_step(self, code, now):
+        step = self.totp.timecode(now)
+        for offset in range(-self.valid_window, self.valid_window + 1):
+            if hmac.compare_digest(self.totp.generate_otp(step + offset), code):
+                return step + offset
+        return None
+
+    def verify(self, code, now=None):
+        """
+        Check a code and mark it as used.
+
+        Args:
+            code (str): Code entered by the user
+            now (datetime.datetime): Time to check against (default: now)
+
+        Returns:
+            bool: True if the code is valid and was not used before
+        """
+        code = str(code).strip()
+        with self._lock:
+            self.counters["attempts"] += 1
+            if not code.isdigit() or len(code) != self.totp.digits:
+                self.counters["rejected_invalid"] += 1
+                return False
+            step = self._matching_step(code, now or datetime.datetime.now())
+            if step is None:
+                self.counters["rejected_invalid"] += 1
+                return False
+            if not self._mark_used(code, step):
+                self.counters["rejected_replay"] += 1
+                return False
+            self.counters["accepted"] += 1
+            return True
+
+    def _mark_used(self, code, step):
+        if self.state is not None:
+            # A code is only accepted while its step is within the window
+            ttl = (2 * self.valid_window + 2) * self.totp.interval
+            return self.state.add("totp_used", f"{step}:{code}", ttl=ttl)
+        if (code, step) in self._used_set:
+            return False
+        if len(self._used) == self._used.maxlen:
+            self._used_set.discard(self._used[0])
+        self._used.append((code, step))
+        self._used_set.add((code, step))
+        return True
+
+
+class LoginThrottle:
+    """
+    Per-client token bucket with exponential backoff after repeated failures.
+
+    Args:
+        rate (float): Tokens refilled per second
+        burst (int): Bucket size, i.e. attempts allowed in a row
+        free_failures (int): Failures tolerated before backoff starts
+        base_backoff (float): First backoff in seconds, doubled per further failure
+        max_backoff (float): Upper bound for the backoff
+        max_clients (int): Clients remembered before the least recent is dropped
+        state (shared_state.SharedState): Keep the buckets there instead of in
+            this process, so all workers count against the same budget
+    """
+
+    def __init__(self, rate=0.2, burst=5, free_failures=3, base_backoff=2.0,
+                 max_backoff=900.0, max_clients=10000, state=None):
+        self.rate = rate
+        self.burst = burst
+        self.free_failures = free_failures
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_clients = max_clients
+        self.state = state
+        # Entries outlive this process when shared, so they need a clock every process agrees on
+        self.clock = time.time if state is not None else time.monotonic
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"allowed": 0, "throttled": 0}
+
+    def _new_entry(self, now):
+        return {"tokens": float(self.burst), "updated": now, "failures": 0, "blocked_until": 0.0}
+
+    def _client(self, key, now):
+        entry = self._clients.get(key)
+        if entry is None:
+            entry = self._new_entry(now)
+            self._clients[key] = entry
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(key)
+        return entry
+
+    def _with_entry(self, key, now, step):
+        # Runs step(entry) -> result on the client's entry, locally or in the shared store
+        if self.state is None:
+            with self._lock:
+                return step(self._client(key, now))
+
+        def change(entry):
+            entry = entry or self._new_entry(now)
+            return entry, step(entry)
+        # Idle long enough to be full again and past any backoff: forgotten
+        ttl = self.max_backoff + self.burst / self.rate
+        return self.state.update("login_throttle", key, change, ttl=ttl)
+
+    def acquire(self, key, now=None):
+        """
+        Take one attempt from a client's budget.
+
+        Args:
+            key (str): Client identifier, usually the remote IP
+
+        Returns:
+            float: 0 if the attempt may proceed, otherwise seconds to wait
+        """
+        now = now if now is not None else self.clock()
+
+        def step(entry):
+            if now < entry["blocked_until"]:
+                return entry["blocked_until"] - now
+            entry["tokens"] = min(self.burst, entry["tokens"] + (now - entry["updated"]) * self.rate)
+            entry["updated"] = now
+            if entry["tokens"] < 1:
+                return (1 - entry["tokens"]) / self.rate
+            entry["tokens"] -= 1
+            return 0.0
+        wait = self._with_entry(key, now, step)
+        with self._lock:
+            self.counters["throttled" if wait else "allowed"] += 1
+        return wait
+
+    def failure(self, key, now=None):
+        """Record a failed attempt; past ``free_failures`` the client is blocked with doubling backoff."""
+        now = now if now is not None else self.clock()
+
+        def step(entry):
+            entry["failures"] += 1
+            extra = entry["failures"] - self.free_failures
+            if extra > 0:
+                backoff = min(self.max_backoff, self.base_backoff * (2 ** (extra - 1)))
+                entry["blocked_until"] = now + backoff
+        self._with_entry(key, now, step)
+
+    def success(self, key):
+        """Forget the failures of a client after a successful login."""
+        if self.state is not None:
+            self.state.delete("login_throttle", key)
+            return
+        with self._lock:
+            self._clients.pop(key, None)
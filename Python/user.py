@@ -17,22 +17,184 @@ Provides methods for creating, validating, and retrieving user information.
    See the License for the specific language governing permissions and
    limitations under the License.
 '''
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+import datetime
 import hashlib
+import io
+import json
+import os
+import threading
 import time
 import pyotp
 import qrcode
+import re
+import sys
+import totp_guard
+import metrics
+import passwords
+import shared_state
 
 totp_key = "Hsdfisdf4n34234dfiseLoasjfj3asnnvhxbbfgrzzuewwndcodrweokyn"
+totp_verifier = totp_guard.TotpVerifier(totp_key, state=shared_state.state)
+TOTP_ISSUER = 'Lehrmittelgs3'
 
+MONGO_DEFAULTS = {
+    "host": "localhost",
+    "port": 27017,
+    "db": "Inventarsystem",
+    "max_pool_size": 10,
+    "timeout_ms": 5000,
+}
 
-def generate_totp_qrcode():
-    uri = pyotp.totp.TOTP(totp_key).provisioning_uri(name='',issuer_name='Lehrmittelgs3')
-    qrcode.make(uri).save("qr.png")
+# Rows per insert_many/update batch for bulk operations
+BULK_CHUNK_SIZE = 500
+
+# Fields the user listing may return; the password hash is never one of them
+LISTABLE_FIELDS = ('Username', 'Admin', 'Active', 'active_ausleihung')
+USERNAME_MIGRATION = 'normalize_username_field'
+
+_client = None
+_client_pid = None
+_db_name = None
+_indexes_ready = False
+_client_lock = threading.Lock()
+# (secret, issuer) -> (png bytes, etag); only the current pair is kept
+_qr_cache = {}
+_qr_lock = threading.Lock()
+
+
+def _mongo_config():
+    """
+    Read the ``mongodb`` section of config.json on top of MONGO_DEFAULTS.
+    Looks in INVENTAR_BASE, /opt/Inventarsystem and next to this module.
+
+    Returns:
+        dict: host, port, db, max_pool_size and timeout_ms
+    """
+    cfg = dict(MONGO_DEFAULTS)
+    candidates = [
+        os.environ.get("INVENTAR_BASE"),
+        "/opt/Inventarsystem",
+        os.path.dirname(os.path.abspath(__file__)),
+    ]
+    for base in candidates:
+        if not base:
+            continue
+        path = os.path.join(base, "config.json")
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as fh:
+                    cfg.update({k: v for k, v in json.load(fh).get("mongodb", {}).items() if v})
+            except (OSError, ValueError, AttributeError):
+                pass
+            break
+    return cfg
+
+
+class _CommandMetrics(monitoring.CommandListener):
+    """Records the duration of every command the client sends, per command name."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        metrics.MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+        metrics.MONGO_FAILURES.inc(command=event.command_name)
+
+
+def get_db():
+    """
+    Return the application database on the shared, process-wide client.
+    The client is created on first use and again after a fork, because
+    pymongo clients must not be shared between processes.
+
+    Returns:
+        pymongo.database.Database: Configured database
+    """
+    global _client, _client_pid, _db_name
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                cfg = _mongo_config()
+                timeout = int(cfg["timeout_ms"])
+                _client = MongoClient(
+                    cfg["host"],
+                    int(cfg["port"]),
+                    maxPoolSize=int(cfg["max_pool_size"]),
+                    serverSelectionTimeoutMS=timeout,
+                    connectTimeoutMS=timeout,
+                    socketTimeoutMS=timeout,
+                    event_listeners=[_CommandMetrics()],
+                )
+                _db_name = cfg["db"]
+                _client_pid = os.getpid()
+    db = _client[_db_name]
+    if not _indexes_ready:
+        try:
+            ensure_indexes(db)
+        except PyMongoError:
+            # Database not reachable yet; the next call tries again.
+            pass
+    return db
+
+
+def ensure_indexes(db):
+    """
+    Prepare the users collection once per process: migrate old ``username``
+    fields to ``Username`` and create the unique index every lookup uses.
+
+    Args:
+        db (pymongo.database.Database): Application database
+    """
+    global _indexes_ready
+    users = db['users']
+    migrations = db['admin_migrations']
+    if not migrations.find_one({'_id': USERNAME_MIGRATION}):
+        users.update_many(
+            {'username': {'$exists': True}},
+            [{'$set': {'Username': {'$ifNull': ['$Username', '$username']}}}, {'$unset': 'username'}],
+        )
+        migrations.update_one({'_id': USERNAME_MIGRATION}, {'$set': {'done_at': time.time()}}, upsert=True)
+    try:
+        users.create_index([('Username', ASCENDING)], unique=True, name='username_unique')
+    except OperationFailure as e:
+        # Existing duplicates prevent a unique index; still index the field.
+        print(f"Warnung: Benutzernamen sind nicht eindeutig, der eindeutige Index fehlt ({e}). "
+              "Doppelte Benutzer entfernen und den Dienst neu starten.", file=sys.stderr, flush=True)
+        users.create_index([('Username', ASCENDING)], name='username')
+    _indexes_ready = True
+
+
+def get_totp_qrcode(secret=None, issuer=None):
+    """
+    Return the provisioning QR code as PNG bytes, rendered once per secret/issuer.
+
+    Args:
+        secret (str): TOTP secret (default: totp_key)
+        issuer (str): Issuer shown in the authenticator app (default: TOTP_ISSUER)
+
+    Returns:
+        tuple: (png bytes, etag)
+    """
+    key = (secret or totp_key, issuer or TOTP_ISSUER)
+    with _qr_lock:
+        cached = _qr_cache.get(key)
+        if cached is None:
+            uri = pyotp.totp.TOTP(key[0]).provisioning_uri(name='', issuer_name=key[1])
+            buf = io.BytesIO()
+            qrcode.make(uri).save(buf)
+            png = buf.getvalue()
+            cached = (png, hashlib.sha256(png).hexdigest()[:32])
+            _qr_cache.clear()
+            _qr_cache[key] = cached
+        return cached
 
 def check_totp(key):
-    totp = pyotp.TOTP(totp_key)
-    return totp.verify(key)
+    return totp_verifier.verify(key)
 
 
 def check_password_strength(password):
@@ -52,15 +214,48 @@ def check_password_strength(password):
 
 def hashing(password):
     """
-    Hash a password using SHA-512.
+    Hash a password with the configured scheme (see passwords.py).
+    A KDF runs in the hashing process pool; the calling thread only waits for it.
     
     Args:
         password (str): Password to hash
         
     Returns:
-        str: Hexadecimal digest of the hashed password
+        str: SHA-512 hex digest by default, or a self-describing hash such as
+        ``$scrypt$ln=..,r=8,p=1$salt$hash`` if scrypt/argon2 is configured
     """
-    return hashlib.sha512(password.encode()).hexdigest()
+    return passwords.hash_password(password)
+
+
+def verify_user_password(username, password):
+    """
+    Check a user's password.
+    Old SHA-512 records (and hashes with weaker parameters than the current
+    calibration) are replaced by a new hash on success. The update only
+    applies if the record still holds the hash that was checked, so a
+    password changed meanwhile is never overwritten.
+    The admin login is TOTP-only, so nothing here calls this yet; it is the
+    check for the main app's password login once that imports this module.
+    
+    Args:
+        username (str): Username of the account
+        password (str): Password to check
+        
+    Returns:
+        bool: True if the password matches
+    """
+    users = get_db()['users']
+    found = users.find_one({'Username': username}, {'Password': 1})
+    if not found or not found.get('Password'):
+        return False
+    ok, upgraded = passwords.verify(password, found['Password'])
+    if ok and upgraded:
+        users.update_one({'_id': found['_id'], 'Password': found['Password']}, {'$set': {'Password': upgraded}})
+    return ok
+
+
+def _new_user_doc(username, password_hash):
+    return {'Username': username, 'Password': password_hash, 'Admin': True, 'active_ausleihung': None}
 
 
 def add_user(username, password):
@@ -74,29 +269,23 @@ def add_user(username, password):
     Returns:
         bool: True if user was added successfully, False if password was too weak
     """
-    client = MongoClient('localhost', 27017)
-    db = client['Inventarsystem']
-    users = db['users']
+    users = get_db()['users']
     if not check_password_strength(password):
         return False
-    users.insert_one({'Username': username, 'Password': hashing(password), 'Admin': True, 'active_ausleihung': None})
-    client.close()
+    users.insert_one(_new_user_doc(username, hashing(password)))
     return True
 
 def get_all_users():
     """
-    Retrieve all users from the database.
-    Administrative function for user management.
+    Retrieve all users from the database, without password hashes.
+    Administrative function for user management; prefer list_users for pages.
     
     Returns:
         list: List of all user documents
     """
     try:
-        client = MongoClient('localhost', 27017)
-        db = client['Inventarsystem']  # Match your actual database name
-        users = db['users']
-        all_users = list(users.find())
-        client.close()
+        users = get_db()['users']
+        all_users = list(users.find({}, {'Password': 0}))
         return all_users
     except Exception as e:
         return []
@@ -112,11 +301,8 @@ def get_user(username):
     Returns:
         dict: User document or None if not found
     """
-    client = MongoClient('localhost', 27017)
-    db = client['Inventarsystem']
-    users = db['users']
+    users = get_db()['users']
     users_return = users.find_one({'Username': username})
-    client.close()
     return users_return
 
 def delete_user(username):
@@ -130,23 +316,157 @@ def delete_user(username):
     Returns:
         bool: True if user was deleted successfully, False otherwise
     """
-    client = MongoClient('localhost', 27017)
-    db = client['Inventarsystem']
-    users = db['users']
-    result = users.delete_one({'username': username})
-    client.close()
-    if result.deleted_count == 0:
-        # Try with different field name
-        client = MongoClient('localhost', 27017)
-        db = client['Inventarsystem']
-        users = db['users']
-        result = users.delete_one({'Username': username})
-        client.close()
-    
+    users = get_db()['users']
+    result = users.delete_one({'Username': username})
+
     return result.deleted_count > 0
 
 def delete_all_user():
-    client = MongoClient('localhost', 27017)
-    db = client['Inventarsystem']
+    global _indexes_ready
+    db = get_db()
     db.drop_collection("users")
-    
\ No newline at end of file
+    # The drop took username_unique with it
+    _indexes_ready = False
+    ensure_indexes(db)
+    
+
+
+def import_users(rows):
+    """
+    Create many users at once.
+    Passwords are hashed in parallel and documents are written with unordered
+    insert_many in chunks, so one bad row does not stop the rest.
+
+    Args:
+        rows (list): Dicts with ``row`` (position in the upload), ``username``
+            and ``password``; expected to be validated already
+
+    Returns:
+        dict: ``inserted`` count and ``errors`` as a list of
+        ``{'row', 'username', 'error'}``
+    """
+    users = get_db()['users']
+    errors = []
+    inserted = 0
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        chunk = rows[start:start + BULK_CHUNK_SIZE]
+        names = [r['username'] for r in chunk]
+        existing = {u['Username'] for u in users.find({'Username': {'$in': names}}, {'Username': 1})}
+        fresh = []
+        for r in chunk:
+            if r['username'] in existing:
+                errors.append({'row': r['row'], 'username': r['username'], 'error': 'User already exists'})
+            else:
+                fresh.append(r)
+        if not fresh:
+            continue
+        hashes = passwords.hash_many([r['password'] for r in fresh])
+        docs = [_new_user_doc(r['username'], h) for r, h in zip(fresh, hashes)]
+        try:
+            inserted += len(users.insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            inserted += e.details.get('nInserted', 0)
+            for err in e.details.get('writeErrors', []):
+                r = fresh[err['index']]
+                errors.append({'row': r['row'], 'username': r['username'], 'error': err.get('errmsg', 'Write failed')})
+    return {'inserted': inserted, 'errors': sorted(errors, key=lambda e: e['row'])}
+
+
+def iter_users(batch_size=BULK_CHUNK_SIZE):
+    """
+    Stream all users without their password hashes.
+
+    Args:
+        batch_size (int): Documents fetched per round trip
+
+    Yields:
+        dict: User with Username, Admin and Active
+    """
+    cursor = get_db()['users'].find({}, {'_id': 0, 'Password': 0}).batch_size(batch_size)
+    for doc in cursor:
+        yield {
+            'Username': doc.get('Username'),
+            'Admin': bool(doc.get('Admin', False)),
+            'Active': doc.get('Active', True) is not False,
+        }
+
+
+def delete_users(usernames):
+    """
+    Delete many users by username.
+
+    Args:
+        usernames (list): Usernames to delete
+
+    Returns:
+        int: Number of deleted users
+    """
+    users = get_db()['users']
+    deleted = 0
+    for start in range(0, len(usernames), BULK_CHUNK_SIZE):
+        chunk = usernames[start:start + BULK_CHUNK_SIZE]
+        deleted += users.delete_many({'Username': {'$in': chunk}}).deleted_count
+    return deleted
+
+
+def set_users_active(usernames, active):
+    """
+    Activate or deactivate many users by username.
+    Users without an ``Active`` field count as active.
+
+    Args:
+        usernames (list): Usernames to change
+        active (bool): New state
+
+    Returns:
+        int: Number of users that were changed
+    """
+    users = get_db()['users']
+    modified = 0
+    for start in range(0, len(usernames), BULK_CHUNK_SIZE):
+        chunk = usernames[start:start + BULK_CHUNK_SIZE]
+        modified += users.update_many({'Username': {'$in': chunk}}, {'$set': {'Active': active}}).modified_count
+    return modified
+
+
+def _jsonable(value):
+    # Loans reference ObjectIds and dates, which jsonify cannot encode
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def list_users(after=None, prefix=None, limit=50, fields=LISTABLE_FIELDS):
+    """
+    Return one page of users ordered by username, served from the username index.
+
+    Args:
+        after (str): Cursor; only usernames greater than this are returned
+        prefix (str): Only usernames starting with this
+        limit (int): Page size
+        fields (tuple): Fields to include; anything not in LISTABLE_FIELDS is ignored
+
+    Returns:
+        dict: ``items`` and ``next_cursor`` (None on the last page)
+    """
+    query = {}
+    if prefix:
+        # An anchored, case-sensitive regex is answered by an index range scan.
+        query['Username'] = {'$regex': '^' + re.escape(prefix)}
+    if after:
+        query.setdefault('Username', {})['$gt'] = after
+    projection = {f: 1 for f in fields if f in LISTABLE_FIELDS}
+    projection.update({'_id': 0, 'Username': 1})
+    cursor = get_db()['users'].find(query, projection).sort('Username', ASCENDING).limit(limit + 1)
+    items = [_jsonable(item) for item in cursor]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1]['Username']
+    return {'items': items, 'next_cursor': next_cursor}
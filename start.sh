@@ -331,6 +331,12 @@ echo "✓ SSL cert: $CERT_PATH"
 echo "========================================================"
 echo " Writing systemd unit for Gunicorn"
 echo "========================================================"
+# Several processes with a few threads each: a slow archive scan or script no
+# longer blocks other admins. Shared state (sessions, jobs, login throttle)
+# lives in the instance directory, so any count works.
+CPU_COUNT=$(nproc 2>/dev/null || echo 1)
+ADMIN_WORKERS=${ADMIN_WORKERS:-$(( CPU_COUNT < 4 ? CPU_COUNT : 4 ))}
+ADMIN_THREADS=${ADMIN_THREADS:-8}
 cat <<EOF | sudo tee /etc/systemd/system/admin-inventarsystem-gunicorn.service >/dev/null
 [Unit]
 Description=Admin Inventarsystem Gunicorn daemon
@@ -345,9 +351,13 @@ Environment="PATH=$VENV_DIR/bin:/usr/local/bin:/usr/bin:/bin"
 # The admin UI should report the status of the main Inventarsystem service
 # (not itself). Override with ENV INVENTAR_SERVICE if different.
 Environment="INVENTAR_SERVICE=admin-inventarsystem-gunicorn.service"
+# Worker count for gunicorn; passwords.py also reads it to split its hashing pool
+Environment="WEB_CONCURRENCY=$ADMIN_WORKERS"
 ExecStart=$VENV_DIR/bin/gunicorn app:app \
     --bind unix:/tmp/admin-inventarsystem.sock \
-    --workers 1 \
+    --worker-class gthread \
+    --threads $ADMIN_THREADS \
+    --timeout 120 \
     --access-logfile $LOG_DIR/access.log \
     --error-logfile $LOG_DIR/error.log
 Restart=always
@@ -358,6 +368,9 @@ SyslogIdentifier=admin-inventarsystem-gunicorn
 WantedBy=multi-user.target
 EOF
 
+# Upload staging and the snapshot store live next to the archives (same filesystem, service user owns them)
+sudo install -d -m 0750 -o "${SUDO_USER:-$USER}" -g "$(id -gn ${SUDO_USER:-$USER})" /var/backups/.incoming /var/backups/snapshots
+
 echo "========================================================"
 echo " Writing Nginx config"
 echo "========================================================"
@@ -377,6 +390,16 @@ server {
         expires 30d;
     }
 
+    # Hand upload chunks to the app as they arrive instead of spooling them first
+    location /backups/uploads {
+        include /etc/nginx/proxy_params;
+        proxy_pass http://unix:/tmp/admin-inventarsystem.sock;
+        proxy_request_buffering off;
+        proxy_read_timeout 300;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto \$scheme;
+    }
+
     location / {
         include /etc/nginx/proxy_params;
         proxy_pass http://unix:/tmp/admin-inventarsystem.sock;